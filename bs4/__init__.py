@@ -21,13 +21,14 @@ __version__ = "4.3.0"
 __copyright__ = "Copyright (c) 2004-2013 Leonard Richardson"
 __license__ = "MIT"
 
-__all__ = ['BeautifulSoup']
+__all__ = ['BeautifulSoup', 'parse_many']
 
+from collections import deque
 import os
 import re
 import warnings
 
-from .builder import builder_registry, ParserRejectedMarkup
+from .builder import builder_pool, builder_registry, ParserRejectedMarkup
 from .dammit import UnicodeDammit
 from .element import (
     CData,
@@ -35,6 +36,8 @@ from .element import (
     DEFAULT_OUTPUT_ENCODING,
     Declaration,
     Doctype,
+    EMPTY_ATTRIBUTES,
+    EMPTY_CONTENTS,
     NavigableString,
     PageElement,
     ProcessingInstruction,
@@ -72,16 +75,41 @@ class BeautifulSoup(Tag):
     ROOT_TAG_NAME = u'[document]'
 
     # If the end-user gives no indication which tree builder they
-    # want, look for one with these features.
+    # want, look for one with these features. If bs4.benchmark has
+    # saved a parser profile, 'fast' means the fastest HTML builder
+    # it measured.
     DEFAULT_BUILDER_FEATURES = ['html', 'fast']
 
     ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
 
     def __init__(self, markup="", features=None, builder=None,
-                 parse_only=None, from_encoding=None, **kwargs):
+                 parse_only=None, from_encoding=None, compact=False,
+                 stream=False, pooled=False, **kwargs):
         """The Soup object is initialized as the 'root tag', and the
         provided markup (which can be a string or a file-like object)
-        is fed into the underlying parser."""
+        is fed into the underlying parser.
+
+        If `compact` is true, tags without attributes share a single
+        empty attribute dictionary, and empty tags share a single
+        empty contents list. This saves memory when you're keeping a
+        lot of trees around, but those shared objects can't be
+        modified in place: use tag[key] = value and tag.append()
+        instead of tag.attrs[key] = value and tag.contents.append().
+
+        If `stream` is true and the markup is a file-like object, the
+        tree builder reads it a chunk at a time instead of reading the
+        whole file into memory first. The encoding is detected from the
+        start of the file. If the rest of the file can't be decoded
+        using that encoding, the file is rewound and parsed the usual
+        way; if it can't be rewound, undecodable bytes are replaced
+        with REPLACEMENT CHARACTER.
+
+        If `pooled` is true, and no `builder` is given, the tree
+        builder comes from a pool kept for the current thread, and
+        goes back to it once the document has been parsed. This
+        saves setting up a new builder and parser for every document,
+        which is a big part of the time it takes to parse a small one.
+        """
 
         if 'convertEntities' in kwargs:
             warnings.warn(
@@ -140,25 +168,30 @@ class BeautifulSoup(Tag):
                 "__init__() got an unexpected keyword argument '%s'" % arg)
 
         if builder is None:
-            if isinstance(features, basestring):
-                features = [features]
-            if features is None or len(features) == 0:
-                features = self.DEFAULT_BUILDER_FEATURES
-            builder_class = builder_registry.lookup(*features)
-            if builder_class is None:
+            features = self._feature_list(features)
+            if pooled:
+                builder = builder_pool.acquire(*features)
+            else:
+                builder_class = builder_registry.lookup(*features)
+                if builder_class is not None:
+                    builder = builder_class()
+            if builder is None:
                 raise FeatureNotFound(
                     "Couldn't find a tree builder with the features you "
                     "requested: %s. Do you need to install a parser library?"
                     % ",".join(features))
-            builder = builder_class()
+        else:
+            pooled = False
         self.builder = builder
         self.is_xml = builder.is_xml
         self.builder.soup = self
 
         self.parse_only = parse_only
+        self.compact = compact
 
         if hasattr(markup, 'read'):        # It's a file-type object.
-            markup = markup.read()
+            if not (stream and self.builder.accepts_file_objects):
+                markup = markup.read()
         elif len(markup) <= 256:
             # Print out warnings for a couple beginner problems
             # involving passing non-markup to Beautiful Soup.
@@ -189,29 +222,151 @@ class BeautifulSoup(Tag):
         # reference to this object.
         self.markup = None
         self.builder.soup = None
+        if pooled:
+            builder_pool.release(self.builder)
+
+    @classmethod
+    def _feature_list(cls, features):
+        if isinstance(features, basestring):
+            features = [features]
+        if features is None or len(features) == 0:
+            features = cls.DEFAULT_BUILDER_FEATURES
+        return features
+
+    @classmethod
+    def iterparse(cls, markup, parse_only, features=None, builder=None,
+                  from_encoding=None, **kwargs):
+        """Parse a document, yielding the parts of it that match
+        `parse_only` as soon as they're complete.
+
+        `parse_only` is a SoupStrainer, and works as it does for the
+        constructor: only matching tags and strings are kept. Each
+        match is yielded once its end tag has been parsed, and it has
+        already been removed from the tree, so the rest of the document
+        doesn't keep it alive. Call decompose() on a match once you're
+        done with it, and memory use will stay flat no matter how big
+        the document is.
+
+        A file-like object is read a chunk at a time if the tree
+        builder can do that, so matches are yielded while the rest of
+        the file is still being read. html5lib doesn't support
+        parse_only, so with html5lib the whole document is parsed
+        before the first match is yielded.
+        """
+        pooled = kwargs.pop('pooled', False) and builder is None
+        if pooled:
+            # The builder has to stay out of the pool until the
+            # iteration is over.
+            builder = builder_pool.acquire(*cls._feature_list(features))
+            pooled = builder is not None
+        soup = cls("", features, builder, parse_only, from_encoding,
+                   **kwargs)
+        return soup._iterparse(markup, from_encoding, pooled)
+
+    def _iterparse(self, markup, from_encoding, pooled=False):
+        if hasattr(markup, 'read') and not self.builder.accepts_file_objects:
+            markup = markup.read()
+
+        self.builder.soup = self
+        yielded = False
+        try:
+            for (self.markup, self.original_encoding,
+                 self.declared_html_encoding,
+                 self.contains_replacement_characters) in (
+                self.builder.prepare_markup(markup, from_encoding)):
+                self.reset()
+                try:
+                    for ignore in self._feed_chunks():
+                        for match in self._finished_matches():
+                            yielded = True
+                            yield match
+                    break
+                except ParserRejectedMarkup:
+                    # We can try another strategy, but only if we
+                    # haven't already yielded anything.
+                    if yielded:
+                        raise
+        finally:
+            self.markup = None
+            self.builder.soup = None
+            if pooled:
+                builder_pool.release(self.builder)
+
+    def _finished_matches(self):
+        """Extract the finished parts of the document that match
+        parse_only from the tree, and yield them.
+        """
+        if len(self.tagStack) > 1:
+            still_open = self.tagStack[1]
+        else:
+            still_open = None
+        for element in list(self.contents):
+            if element is still_open:
+                continue
+            # With a builder that honors parse_only, every element
+            # here is a match. With one that doesn't, the matches are
+            # somewhere inside.
+            candidates = [element]
+            while candidates:
+                candidate = candidates.pop()
+                if self.parse_only is None or self.parse_only.search(candidate):
+                    self._extract_match(candidate)
+                    yield candidate
+                elif isinstance(candidate, Tag):
+                    candidates.extend(reversed(candidate.contents))
+            if element.parent is self:
+                # This was a container for matches, not a match.
+                if isinstance(element, Tag):
+                    element.decompose()
+                else:
+                    element.extract()
+
+    def _extract_match(self, element):
+        previous_element = element.previous_element
+        last_descendant = element._last_descendant()
+        element.extract()
+        # Make sure the next object to be parsed isn't connected to
+        # the extracted element.
+        if self._most_recent_element is last_descendant:
+            self._most_recent_element = previous_element
 
     def _feed(self):
+        for ignore in self._feed_chunks():
+            pass
+
+    def _feed_chunks(self):
+        """Parse the markup, yielding after each chunk the builder
+        passes to its parser."""
         # Convert the document to Unicode.
         self.builder.reset()
 
-        self.builder.feed(self.markup)
+        for ignore in self.builder.feed_chunks(self.markup):
+            yield
         # Close out any unfinished strings and close all the open tags.
         self.endData()
         while self.currentTag.name != self.ROOT_TAG_NAME:
             self.popTag()
+        yield
 
     def reset(self):
         Tag.__init__(self, self, self.builder, self.ROOT_TAG_NAME)
         self.hidden = 1
+        # Set this up front, or looking it up before the first element
+        # is parsed would go through Tag.__getattr__ and search the tree.
+        self._most_recent_element = None
         self.builder.reset()
         self.current_data = []
         self.currentTag = None
         self.tagStack = []
+        # How many tags with each (name, prefix) are on tagStack.
+        self.open_tag_counter = {}
         self.preserve_whitespace_tag_stack = []
         self.pushTag(self)
 
     def new_tag(self, name, namespace=None, nsprefix=None, **attrs):
         """Create a new tag associated with this soup."""
+        if self.compact and not attrs:
+            attrs = EMPTY_ATTRIBUTES
         return Tag(None, self.builder, name, namespace, nsprefix, attrs)
 
     def new_string(self, s, subclass=NavigableString):
@@ -228,6 +383,9 @@ class BeautifulSoup(Tag):
 
     def popTag(self):
         tag = self.tagStack.pop()
+        self.open_tag_counter[(tag.name, tag.prefix)] -= 1
+        if self.compact and not tag.contents:
+            tag.contents = EMPTY_CONTENTS
         if self.preserve_whitespace_tag_stack and tag == self.preserve_whitespace_tag_stack[-1]:
             self.preserve_whitespace_tag_stack.pop()
         #print "Pop", tag.name
@@ -241,29 +399,32 @@ class BeautifulSoup(Tag):
             self.currentTag.contents.append(tag)
         self.tagStack.append(tag)
         self.currentTag = self.tagStack[-1]
+        counter = self.open_tag_counter
+        key = (tag.name, tag.prefix)
+        counter[key] = counter.get(key, 0) + 1
         if tag.name in self.builder.preserve_whitespace_tags:
             self.preserve_whitespace_tag_stack.append(tag)
 
     def endData(self, containerClass=NavigableString):
         if self.current_data:
-            current_data = u''.join(self.current_data)
+            # Most strings arrive in a single chunk, and don't need
+            # to be joined.
+            if len(self.current_data) == 1:
+                current_data = self.current_data[0]
+            else:
+                current_data = u''.join(self.current_data)
             # If whitespace is not preserved, and this string contains
             # nothing but ASCII spaces, replace it with a single space
             # or newline.
-            if not self.preserve_whitespace_tag_stack:
-                strippable = True
-                for i in current_data:
-                    if i not in self.ASCII_SPACES:
-                        strippable = False
-                        break
-                if strippable:
-                    if '\n' in current_data:
-                        current_data = '\n'
-                    else:
-                        current_data = ' '
+            if (not self.preserve_whitespace_tag_stack
+                and not current_data.strip(self.ASCII_SPACES)):
+                if '\n' in current_data:
+                    current_data = '\n'
+                else:
+                    current_data = ' '
 
             # Reset the data collector.
-            self.current_data = []
+            del self.current_data[:]
 
             # Should we add this string to the tree at all?
             if self.parse_only and len(self.tagStack) <= 1 and \
@@ -293,6 +454,10 @@ class BeautifulSoup(Tag):
         if name == self.ROOT_TAG_NAME:
             # The BeautifulSoup object itself can never be popped.
             return
+        if not self.open_tag_counter.get((name, nsprefix)):
+            # There's no open tag with this name and prefix. Ignore
+            # the end tag, rather than closing every tag that is open.
+            return
 
         most_recently_popped = None
 
@@ -324,6 +489,8 @@ class BeautifulSoup(Tag):
                  or not self.parse_only.search_tag(name, attrs))):
             return None
 
+        if self.compact and not attrs:
+            attrs = EMPTY_ATTRIBUTES
         tag = Tag(self, self.builder, name, namespace, nsprefix, attrs,
                   self.currentTag, self._most_recent_element)
         if tag is None:
@@ -347,21 +514,36 @@ class BeautifulSoup(Tag):
                formatter="minimal"):
         """Returns a string or Unicode representation of this document.
         To get Unicode, pass None for encoding."""
+        if not pretty_print:
+            indent_level = None
+        else:
+            indent_level = 0
+        return super(BeautifulSoup, self).decode(
+            indent_level, eventual_encoding, formatter)
+
+    def write(self, fileobj, encoding=DEFAULT_OUTPUT_ENCODING,
+              formatter="minimal", pretty_print=False,
+              errors="xmlcharrefreplace", buffer_size=None):
+        """Writes this document to a file-like object, a piece at a time.
+
+        See Tag.write() for details.
+        """
+        if not pretty_print:
+            indent_level = None
+        else:
+            indent_level = 0
+        self._write(fileobj, indent_level, encoding, formatter, errors,
+                    buffer_size)
 
+    def _serialize(self, buffer, indent_level, eventual_encoding, formatter):
         if self.is_xml:
             # Print the XML declaration
             encoding_part = ''
             if eventual_encoding != None:
                 encoding_part = ' encoding="%s"' % eventual_encoding
-            prefix = u'<?xml version="1.0"%s?>\n' % encoding_part
-        else:
-            prefix = u''
-        if not pretty_print:
-            indent_level = None
-        else:
-            indent_level = 0
-        return prefix + super(BeautifulSoup, self).decode(
-            indent_level, eventual_encoding, formatter)
+            buffer.append(u'<?xml version="1.0"%s?>\n' % encoding_part)
+        super(BeautifulSoup, self)._serialize(
+            buffer, indent_level, eventual_encoding, formatter)
 
 # Alias to make it easier to type import: 'from bs4 import _soup'
 _s = BeautifulSoup
@@ -385,6 +567,138 @@ class FeatureNotFound(ValueError):
     pass
 
 
+class ParseFailure(Exception):
+    """What parse_many() yields for a document it couldn't handle.
+
+    The original exception may not survive being sent back from a
+    worker process, so this describes it instead.
+    """
+
+    def __init__(self, index, error_class, message, traceback):
+        super(ParseFailure, self).__init__(
+            index, error_class, message, traceback)
+        self.index = index
+        self.error_class = error_class
+        self.message = message
+        self.traceback = traceback
+
+    def __str__(self):
+        return "Document %d: %s: %s" % (
+            self.index, self.error_class, self.message)
+
+
+class _ParseJob(object):
+    """Parses one document for parse_many() and extracts from it."""
+
+    def __init__(self, features, parse_only, extract, kwargs):
+        self.features = features
+        self.parse_only = parse_only
+        self.extract = extract
+        self.kwargs = kwargs
+
+    def __call__(self, task):
+        index, markup = task
+        try:
+            soup = BeautifulSoup(
+                markup, self.features, parse_only=self.parse_only,
+                pooled=True, **self.kwargs)
+            if self.extract is None:
+                # A snapshot is much quicker to send back than a
+                # pickled tree.
+                from bs4.snapshot import Snapshot
+                return Snapshot.from_soup(soup)
+            return self.extract(soup)
+        except Exception, e:
+            import traceback
+            return ParseFailure(
+                index, e.__class__.__name__, self._message(e),
+                traceback.format_exc())
+
+    @staticmethod
+    def _message(e):
+        """An exception's message as Unicode."""
+        try:
+            return unicode(e)
+        except UnicodeError:
+            # The message is a bytestring that isn't ASCII.
+            return str(e).decode("utf-8", "replace")
+
+# The job a parse_many() worker process is doing.
+_worker_job = None
+
+def _start_worker(job):
+    global _worker_job
+    _worker_job = job
+
+def _run_worker_job(task):
+    return _worker_job(task)
+
+
+def parse_many(documents, features=None, parse_only=None, extract=None,
+               workers=None, **kwargs):
+    """Parse a lot of documents in a pool of worker processes.
+
+    Parsing is CPU-bound Python code, so threads can't do it in
+    parallel, but processes can. Each worker builds a tree for a
+    document, calls `extract` on it, and sends back only what
+    `extract` returned, which should be something small and picklable,
+    such as a list of strings. (`extract` itself has to be picklable,
+    so it must be a function defined at the top level of a module.)
+
+    :param documents: An iterable of markup strings.
+    :param features, parse_only: As for the BeautifulSoup constructor.
+        Any other keyword arguments are passed into the constructor as
+        well.
+    :param extract: A function that takes a BeautifulSoup object. If
+        this is None, the whole tree is sent back, as efficiently as
+        possible, and the results are BeautifulSoup objects.
+    :param workers: The number of worker processes. By default, one
+        per CPU. If this is 0, the documents are parsed in this
+        process, one after another.
+
+    :yield: One result per document, in the same order as the
+        documents, as soon as it and all the results before it are
+        ready. If a document couldn't be parsed, or `extract` raised
+        an exception, the result for that document is a ParseFailure,
+        and the rest of the documents are processed as usual.
+    """
+    job = _ParseJob(features, parse_only, extract, kwargs)
+    tasks = enumerate(documents)
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+
+    if workers == 0:
+        results = (job(task) for task in tasks)
+    else:
+        results = _parse_in_pool(job, tasks, workers)
+
+    for result in results:
+        if extract is None and not isinstance(result, ParseFailure):
+            result = result.to_soup()
+        yield result
+
+def _parse_in_pool(job, tasks, workers):
+    # Most programs never call parse_many(), so they shouldn't have to
+    # import multiprocessing.
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, _start_worker, (job,))
+    try:
+        # Keep a few documents per worker in flight. That keeps the
+        # workers busy without reading in the whole iterable at once.
+        in_flight = deque()
+        for task in tasks:
+            in_flight.append(pool.apply_async(_run_worker_job, (task,)))
+            if len(in_flight) >= workers * 4:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 #By default, act as an HTML pretty-printer.
 if __name__ == '__main__':
     import sys
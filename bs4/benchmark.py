@@ -0,0 +1,216 @@
+"""Measure the installed tree builders, and save the results.
+
+Every registered tree builder parses documents of several different
+shapes--small and large, flat and deeply nested, valid and invalid,
+UTF-8 and Windows-1252--and its throughput and peak memory use are
+recorded. Run this module to save the results as the parser profile:
+
+    python -m bs4.benchmark [profile path]
+
+The profile goes to bs4.builder.DEFAULT_PARSER_PROFILE_PATH by
+default. It isn't used until the BS4_PARSER_PROFILE environment
+variable names it, or a program calls builder_registry.use_profile().
+Then a lookup that asks for the 'fast' feature--including
+BeautifulSoup's default lookup for a fast HTML builder--gets
+whichever matching builder did best, instead of whichever was
+registered last, as long as the profile has a score for every
+matching builder.
+"""
+
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Peak memory use can't be measured on this platform.
+    resource = None
+
+from bs4 import BeautifulSoup, __version__
+from bs4.builder import builder_registry, DEFAULT_PARSER_PROFILE_PATH
+from bs4.diagnose import link_doc, rdoc
+
+__all__ = [
+    'benchmark',
+    'document_shapes',
+    'measure',
+    'save_profile',
+    ]
+
+
+def nested_doc(num_elements=1000, depth=100):
+    """Generate a valid HTML document made of deeply nested tags."""
+    nest = "<div><span>" * (depth // 2) + "text" + "</span></div>" * (depth // 2)
+    return "<html><body>" + nest * (num_elements // depth or 1) + "</body></html>"
+
+
+def windows_1252_doc(num_elements=1000):
+    """Generate a Windows-1252 document that doesn't declare its
+    encoding, so the encoding has to be detected."""
+    text = link_doc(num_elements).decode("ascii").replace(
+        u"external", u"\N{LEFT DOUBLE QUOTATION MARK}external"
+        u"\N{RIGHT DOUBLE QUOTATION MARK} caf\N{LATIN SMALL LETTER E WITH ACUTE}")
+    return text.encode("windows-1252")
+
+
+def document_shapes(num_elements=5000):
+    """Generate one document of each shape the benchmark uses.
+
+    :return: A list of (shape name, bytestring) 2-tuples.
+    """
+    # Generate the same random documents every time.
+    random.seed(0)
+    return [
+        ("small", link_doc(num_elements // 100 or 1)),
+        ("large", link_doc(num_elements)),
+        ("nested", nested_doc(num_elements)),
+        ("malformed", rdoc(num_elements)),
+        ("windows-1252", windows_1252_doc(num_elements)),
+        ]
+
+
+def _max_rss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Bytes on Mac OS X, kilobytes everywhere else.
+        return usage
+    return usage * 1024
+
+
+def peak_memory(builder_class, markup):
+    """Measure how much parsing a document raises peak memory use.
+
+    The document is parsed in a child process, so that neither the
+    parent's high-water mark nor the child's tree gets in the way.
+
+    :return: A number of bytes, or None if it can't be measured here.
+    """
+    if resource is None or not hasattr(os, 'fork'):
+        return None
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_end)
+            before = _max_rss()
+            soup = BeautifulSoup(markup, builder=builder_class())
+            os.write(write_end, str(_max_rss() - before).encode("ascii"))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    try:
+        data = os.read(read_end, 64)
+    finally:
+        os.close(read_end)
+        os.waitpid(pid, 0)
+    if not data:
+        return None
+    return int(data)
+
+
+def measure(builder_class, markup, times=3):
+    """Measure how fast a tree builder parses a document.
+
+    :return: A dictionary with the best of `times` runs, as
+        'bytes_per_second', and 'peak_memory' in bytes. If the builder
+        couldn't parse the document, the dictionary just has an
+        'error'.
+    """
+    best = None
+    try:
+        for i in range(times):
+            a = time.time()
+            BeautifulSoup(markup, builder=builder_class())
+            elapsed = time.time() - a
+            if best is None or elapsed < best:
+                best = elapsed
+    except Exception, e:
+        return dict(error="%s: %s" % (e.__class__.__name__, e))
+    return dict(
+        bytes_per_second=len(markup) / max(best, 1e-6),
+        peak_memory=peak_memory(builder_class, markup))
+
+
+def benchmark(num_elements=5000, times=3, builders=None):
+    """Measure every registered tree builder on every document shape.
+
+    :param builders: The tree builder classes to measure. By default,
+        every builder in the registry.
+    :return: A parser profile: a dictionary that can be saved with
+        save_profile(). Each builder's 'score' is the geometric mean
+        of its throughput over all the shapes. A builder that couldn't
+        parse one of the documents gets no score.
+    """
+    if builders is None:
+        builders = builder_registry.builders
+    shapes = document_shapes(num_elements)
+    profile = dict(
+        bs4_version=__version__, python=platform.python_version(),
+        num_elements=num_elements, builders={})
+    for builder_class in builders:
+        results = {}
+        for shape, markup in shapes:
+            results[shape] = measure(builder_class, markup, times)
+        throughputs = [result.get('bytes_per_second')
+                       for result in results.values()]
+        if None in throughputs:
+            score = None
+        else:
+            score = math.exp(
+                sum(math.log(t) for t in throughputs) / len(throughputs))
+        profile['builders'][builder_class.NAME] = dict(
+            features=list(builder_class.features), shapes=results,
+            score=score)
+    return profile
+
+
+def save_profile(profile, path=DEFAULT_PARSER_PROFILE_PATH):
+    """Save a parser profile.
+
+    If the builder registry is already using the profile at `path`,
+    it picks up the new one straight away.
+    """
+    with open(path, 'w') as fh:
+        json.dump(profile, fh, indent=2, sort_keys=True)
+    if path == builder_registry.profile_path:
+        builder_registry.profile = profile
+
+
+def print_profile(profile):
+    names = sorted(profile['builders'],
+                   key=lambda name: -(profile['builders'][name]['score'] or 0))
+    for name in names:
+        results = profile['builders'][name]
+        if results['score'] is None:
+            print "%s: no score" % name
+        else:
+            print "%s: score %.0f bytes/s" % (name, results['score'])
+        for shape, result in sorted(results['shapes'].items()):
+            if 'error' in result:
+                print "  %s: %s" % (shape, result['error'])
+                continue
+            line = "  %s: %.0f bytes/s" % (shape, result['bytes_per_second'])
+            if result['peak_memory'] is not None:
+                line += ", peak memory +%d KB" % (result['peak_memory'] // 1024)
+            print line
+
+
+def main(argv=sys.argv):
+    if len(argv) > 1:
+        path = argv[1]
+    else:
+        path = DEFAULT_PARSER_PROFILE_PATH
+    print "Benchmarking tree builders on Beautiful Soup %s" % __version__
+    profile = benchmark()
+    print_profile(profile)
+    save_profile(profile, path)
+    print "Saved the parser profile to %s." % path
+    print "Set BS4_PARSER_PROFILE=%s to use it." % path
+
+if __name__ == '__main__':
+    main()
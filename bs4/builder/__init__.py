@@ -1,16 +1,23 @@
 from collections import defaultdict
+import importlib
 import itertools
+import json
+import os
 import sys
+import threading
+import types
 from bs4.element import (
     CharsetMetaAttributeValue,
     ContentMetaAttributeValue,
     whitespace_re
     )
+from bs4.dammit import EncodingDetectingReader
 
 __all__ = [
     'HTMLTreeBuilder',
     'SAXTreeBuilder',
     'TreeBuilder',
+    'TreeBuilderPool',
     'TreeBuilderRegistry',
     ]
 
@@ -23,27 +30,232 @@ HTML = 'html'
 HTML_5 = 'html5'
 
 
+# Where bs4.benchmark saves its measurements of the installed tree
+# builders, unless it's told otherwise.
+DEFAULT_PARSER_PROFILE_PATH = os.path.join(
+    os.path.expanduser('~'), '.bs4_parser_profile.json')
+
+# The parser profile consulted by lookups that ask for the 'fast'
+# feature. No profile is used unless the BS4_PARSER_PROFILE
+# environment variable names one, or a program calls
+# builder_registry.use_profile().
+PARSER_PROFILE_PATH = os.environ.get('BS4_PARSER_PROFILE') or None
+
+
+class _LazyTreeBuilder(object):
+    """Stands in for a treebuilder class whose module hasn't been
+    imported yet.
+
+    It knows everything a lookup needs to choose a builder--its name,
+    its features, and whether it builds XML--so the module is only
+    imported once the builder has been chosen.
+    """
+
+    def __init__(self, module_name, class_name, name, features,
+                 is_xml=False):
+        self.module_name = module_name
+        self.__name__ = class_name
+        self.NAME = name
+        self.features = features
+        self.is_xml = is_xml
+
+    def load(self):
+        """Import the module and return the real treebuilder class.
+
+        :raise ImportError: If the module, or a library it needs,
+            isn't installed.
+        """
+        module = importlib.import_module(self.module_name)
+        return getattr(module, self.__name__)
+
+
 class TreeBuilderRegistry(object):
 
-    def __init__(self):
+    def __init__(self, profile_path=None):
         self.builders_for_feature = defaultdict(list)
-        self.builders = []
+        self._builders = []
+        self.profile_path = profile_path
+        self._profile = None
+        # Loading a builder changes the lists above, and more than one
+        # thread may be doing lookups at once.
+        self._lock = threading.Lock()
+
+    @property
+    def profile(self):
+        """The parser profile saved by bs4.benchmark, or None.
+
+        The profile is read from `profile_path` the first time it's
+        needed. A missing or unreadable profile counts as no profile.
+        """
+        if self._profile is None:
+            self._profile = {}
+            if self.profile_path is not None:
+                try:
+                    with open(self.profile_path) as fh:
+                        profile = json.load(fh)
+                    if isinstance(profile.get('builders'), dict):
+                        self._profile = profile
+                except (IOError, OSError, ValueError, AttributeError):
+                    pass
+        return self._profile or None
+
+    @profile.setter
+    def profile(self, profile):
+        self._profile = profile
+
+    def use_profile(self, path):
+        """Consult the parser profile saved at `path` in lookups that
+        ask for the 'fast' feature. Pass None to stop using a profile.
+        """
+        self.profile_path = path
+        self._profile = None
+
+    def score(self, treebuilder_class):
+        """How fast the profile says a treebuilder is, or None if it
+        wasn't measured."""
+        profile = self.profile
+        if profile is None:
+            return None
+        results = profile['builders'].get(
+            getattr(treebuilder_class, 'NAME', None))
+        if not results:
+            return None
+        return results.get('score')
 
     def register(self, treebuilder_class):
         """Register a treebuilder based on its advertised features."""
-        for feature in treebuilder_class.features:
-            self.builders_for_feature[feature].insert(0, treebuilder_class)
-        self.builders.insert(0, treebuilder_class)
+        with self._lock:
+            for feature in treebuilder_class.features:
+                self.builders_for_feature[feature].insert(0, treebuilder_class)
+            self._builders.insert(0, treebuilder_class)
+
+    def register_lazy(self, module_name, class_name, name, features,
+                      is_xml=False):
+        """Register a treebuilder without importing its module.
+
+        The module is imported the first time a lookup chooses the
+        builder. If that fails, the builder is unregistered and the
+        lookup carries on as though it had never been registered.
+
+        :param name: The builder's NAME.
+        :param features: The builder's features, exactly as the class
+            advertises them.
+        """
+        self.register(_LazyTreeBuilder(
+                module_name, class_name, name, features, is_xml))
+
+    @property
+    def builders(self):
+        """All the registered treebuilder classes, most recently
+        registered first.
+
+        Any builders that haven't been loaded yet are loaded now.
+        """
+        for builder in list(self._builders):
+            self._load(builder)
+        return list(self._builders)
+
+    def _load(self, builder):
+        """Turn a builder chosen by a lookup into a real class.
+
+        :return: A treebuilder class, or None if its module couldn't
+            be imported.
+        """
+        if not isinstance(builder, _LazyTreeBuilder):
+            return builder
+        # Imports have a lock of their own, so this one isn't held
+        # during the import.
+        try:
+            treebuilder_class = builder.load()
+        except ImportError:
+            # They don't have the library this builder needs.
+            treebuilder_class = None
+        with self._lock:
+            if builder in self._builders:
+                # Put the class where the stand-in was, so it keeps
+                # its priority.
+                for feature in builder.features:
+                    self._replace(
+                        self.builders_for_feature[feature], builder,
+                        treebuilder_class)
+                self._replace(self._builders, builder, treebuilder_class)
+            # Otherwise another thread got here first.
+        return treebuilder_class
+
+    def _replace(self, builders, old, new):
+        if new is None:
+            builders.remove(old)
+        else:
+            builders[builders.index(old)] = new
 
     def lookup(self, *features):
-        if len(self.builders) == 0:
-            # There are no builders at all.
+        while True:
+            builder = self._choose(*features)
+            if builder is None:
+                return None
+            treebuilder_class = self._load(builder)
+            if treebuilder_class is not None:
+                return treebuilder_class
+            # That builder couldn't be loaded, and has been
+            # unregistered. Choose again.
+
+    def _choose(self, *features):
+        if FAST in features and self.profile is not None:
+            # The profile knows which builders are fast, whether or
+            # not they advertise the 'fast' feature.
+            fastest = self.fastest(
+                *[feature for feature in features if feature != FAST])
+            if fastest is not None:
+                return fastest
+        candidates = self.candidates(*features)
+        if len(candidates) == 0:
             return None
+        return candidates[0]
+
+    def fastest(self, *features):
+        """Find the builder with all the given features that the
+        profile says is fastest.
+
+        Only builders for the same kind of markup (HTML or XML) as
+        the one lookup() would otherwise have picked are considered.
+        The profile only gets a say if it has a score for every one of
+        them. A builder that wasn't benchmarked, or couldn't parse all
+        the benchmark documents, may be installed now, and the profile
+        can't say how it compares.
+
+        :return: A treebuilder class, or None if the profile can't
+            decide.
+        """
+        candidates = self.candidates(*features)
+        if len(candidates) == 0:
+            return None
+        is_xml = getattr(candidates[0], 'is_xml', False)
+        best = best_score = None
+        for candidate in candidates:
+            if getattr(candidate, 'is_xml', False) != is_xml:
+                continue
+            score = self.score(candidate)
+            if score is None:
+                return None
+            if best_score is None or score > best_score:
+                best, best_score = candidate, score
+        return best
+
+    def candidates(self, *features):
+        """List the builders that have all the given features, most
+        recently registered first.
+
+        Builders registered with register_lazy() that haven't been
+        loaded yet show up as stand-ins with the same NAME, features
+        and is_xml as the real class.
+        """
+        with self._lock:
+            return self._candidates(features)
 
+    def _candidates(self, features):
         if len(features) == 0:
-            # They didn't ask for any features. Give them the most
-            # recently registered builder.
-            return self.builders[0]
+            # They didn't ask for any features. Any builder will do.
+            return list(self._builders)
 
         # Go down the list of features in order, and eliminate any builders
         # that don't match every feature.
@@ -64,22 +276,68 @@ class TreeBuilderRegistry(object):
                         set(we_have_the_feature))
 
         # The only valid candidates are the ones in candidate_set.
-        # Go through the original list of candidates and pick the first one
-        # that's in candidate_set.
+        # Go through the original list of candidates and keep the ones
+        # that are in candidate_set.
         if candidate_set is None:
-            return None
-        for candidate in candidates:
-            if candidate in candidate_set:
-                return candidate
-        return None
+            return []
+        return [candidate for candidate in candidates
+                if candidate in candidate_set]
 
 # The BeautifulSoup class will take feature lists from developers and use them
 # to look up builders in this registry.
-builder_registry = TreeBuilderRegistry()
+builder_registry = TreeBuilderRegistry(PARSER_PROFILE_PATH)
+
+
+class TreeBuilderPool(threading.local):
+    """Keeps tree builders around between documents.
+
+    A tree builder, and the parser object underneath it, can be used
+    for one document after another. A TreeBuilderPool hands out
+    builders and takes them back when they're done, so parsing lots
+    of small documents doesn't pay for setting up a builder and a
+    parser every time.
+
+    A builder can only parse one document at a time, so each thread
+    gets a pool of its own.
+    """
+
+    # Most code parses one document at a time, but a thread might be
+    # in the middle of more than one--for instance, if it's iterating
+    # over BeautifulSoup.iterparse().
+    MAX_IDLE_BUILDERS = 4
+
+    def __init__(self, registry=builder_registry):
+        self.registry = registry
+        self.idle = defaultdict(list)
+
+    def acquire(self, *features):
+        """Get a builder with the given features.
+
+        :return: A TreeBuilder, or None if no registered builder has
+            those features.
+        """
+        builder_class = self.registry.lookup(*features)
+        if builder_class is None:
+            return None
+        idle = self.idle[builder_class]
+        if idle:
+            return idle.pop()
+        return builder_class()
+
+    def release(self, builder):
+        """Take back a builder that has finished with a document."""
+        builder.soup = None
+        idle = self.idle[builder.__class__]
+        if len(idle) < self.MAX_IDLE_BUILDERS and builder not in idle:
+            idle.append(builder)
+
+# The BeautifulSoup class uses this pool when it's asked to.
+builder_pool = TreeBuilderPool()
 
 class TreeBuilder(object):
     """Turn a document into a Beautiful Soup object tree."""
 
+    NAME = "[Unknown tree builder]"
     features = []
 
     is_xml = False
@@ -91,6 +349,9 @@ class TreeBuilder(object):
     # comma-separated list of CDATA, rather than a single CDATA.
     cdata_list_attributes = {}
 
+    # Can prepare_markup() and feed() take a file-like object, and
+    # read it a chunk at a time?
+    accepts_file_objects = False
 
     def __init__(self):
         self.soup = None
@@ -122,10 +383,60 @@ class TreeBuilder(object):
     def feed(self, markup):
         raise NotImplementedError()
 
+    def feed_chunks(self, markup):
+        """Feed markup to the parser a piece at a time.
+
+        This is a generator that yields after each piece, so the caller
+        can look at the tree as it's built. This implementation feeds
+        the whole document at once.
+        """
+        self.feed(markup)
+        yield
+
     def prepare_markup(self, markup, user_specified_encoding=None,
                        document_declared_encoding=None):
         return markup, None, None, False
 
+    def prepare_file(self, fileobj, user_specified_encoding=None,
+                     document_declared_encoding=None, decode=True):
+        """Prepare a file-like object to be parsed without reading it
+        all into memory.
+
+        :yield: A series of 4-tuples, like prepare_markup(). The first
+        strategy reads the file through an EncodingDetectingReader. If
+        that one fails and the file can be rewound, the rest are the
+        prepare_markup() strategies for the file's entire contents.
+        """
+        try:
+            position = fileobj.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            position = None
+
+        # If we can't go back and try again, it's better to replace
+        # the odd undecodable character than to give up.
+        if position is None:
+            errors = "replace"
+        else:
+            errors = "strict"
+        try_encodings = [user_specified_encoding, document_declared_encoding]
+        try:
+            reader = EncodingDetectingReader(
+                fileobj, try_encodings, not self.is_xml, decode, errors)
+        except UnicodeError:
+            reader = None
+        if reader is not None:
+            yield (reader, reader.original_encoding,
+                   reader.declared_html_encoding,
+                   reader.contains_replacement_characters)
+
+        if position is None:
+            return
+        fileobj.seek(position)
+        for strategy in self.prepare_markup(
+            fileobj.read(), user_specified_encoding,
+            document_declared_encoding):
+            yield strategy
+
     def test_fragment_to_document(self, fragment):
         """Wrap an HTML fragment to make it look like a document.
 
@@ -305,17 +616,50 @@ class ParserRejectedMarkup(Exception):
 # builder registrations will take precedence. In general, we want lxml
 # to take precedence over html5lib, because it's faster. And we only
 # want to use HTMLParser as a last result.
-from . import _htmlparser
-register_treebuilders_from(_htmlparser)
-try:
-    from . import _html5lib
-    register_treebuilders_from(_html5lib)
-except ImportError:
-    # They don't have html5lib installed.
-    pass
-try:
-    from . import _lxml
-    register_treebuilders_from(_lxml)
-except ImportError:
-    # They don't have lxml installed.
-    pass
+#
+# A builder's module isn't imported until a lookup chooses it.
+# Importing lxml or html5lib takes longer than importing all of
+# Beautiful Soup, and most programs only ever use one builder.
+_BUNDLED_BUILDERS = [
+    ('bs4.builder._htmlparser', 'HTMLParserTreeBuilder', 'html.parser',
+     ['html.parser', HTML, STRICT], False),
+    ('bs4.builder._html5lib', 'HTML5TreeBuilder', 'html5lib',
+     ['html5lib', PERMISSIVE, HTML_5, HTML], False),
+    ('bs4.builder._lxml', 'LXMLTreeBuilderForXML', 'lxml-xml',
+     ['lxml-xml', 'lxml', XML, FAST, PERMISSIVE], True),
+    ('bs4.builder._lxml', 'LXMLTreeBuilder', 'lxml',
+     ['lxml', HTML, FAST, PERMISSIVE], False),
+    ]
+for _bundled in _BUNDLED_BUILDERS:
+    builder_registry.register_lazy(*_bundled)
+del _bundled
+
+
+class _BuilderModule(types.ModuleType):
+    """This module, with the bundled treebuilder classes available as
+    attributes, so that `from bs4.builder import LXMLTreeBuilder`
+    still works. The builder's module is imported when the class is
+    first asked for.
+
+    Python 2 has no module-level __getattr__, so the module's contents
+    are moved into an instance of this class.
+    """
+
+    def __getattr__(self, name):
+        for module_name, class_name, _, _, _ in _BUNDLED_BUILDERS:
+            if class_name == name:
+                try:
+                    module = importlib.import_module(module_name)
+                except ImportError:
+                    break
+                return getattr(module, name)
+        raise AttributeError(
+            "'module' object has no attribute '%s'" % name)
+
+_module = _BuilderModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+# When a module object goes away, Python 2 clears its globals--which
+# the functions defined here are still using.
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
+del _module
@@ -12,6 +12,7 @@ from bs4.builder import (
 from bs4.element import NamespacedAttribute
 import html5lib
 from html5lib.constants import namespaces
+from html5lib.inputstream import HTMLBinaryInputStream
 from bs4.element import (
     Comment,
     Doctype,
@@ -22,7 +23,13 @@ from bs4.element import (
 class HTML5TreeBuilder(HTMLTreeBuilder):
     """Use html5lib to build a tree."""
 
-    features = ['html5lib', PERMISSIVE, HTML_5, HTML]
+    NAME = "html5lib"
+
+    features = [NAME, PERMISSIVE, HTML_5, HTML]
+
+    # html5lib reads file-like objects a chunk at a time, and does its
+    # own encoding detection.
+    accepts_file_objects = True
 
     def prepare_markup(self, markup, user_specified_encoding):
         # Store the user-specified encoding for use later on.
@@ -30,20 +37,45 @@ class HTML5TreeBuilder(HTMLTreeBuilder):
         yield (markup, None, None, False)
 
     # These methods are defined by Beautiful Soup.
+    # Setting up an html5lib parser takes about as long as parsing a
+    # small document, so a parser that finishes a document is kept
+    # for the next one.
+    _idle_parser = None
+
     def feed(self, markup):
         if self.soup.parse_only is not None:
             warnings.warn("You provided a value for parse_only, but the html5lib tree builder doesn't support parse_only. The entire document will be parsed.")
-        parser = html5lib.HTMLParser(tree=self.create_treebuilder)
+        parser = self._idle_parser
+        self._idle_parser = None
+        if parser is None:
+            parser = html5lib.HTMLParser(tree=self.create_treebuilder)
+        else:
+            self.underlying_builder.soup = self.soup
         doc = parser.parse(markup, encoding=self.user_specified_encoding)
 
         # Set the character encoding detected by the tokenizer.
-        if isinstance(markup, unicode):
+        if not isinstance(parser.tokenizer.stream, HTMLBinaryInputStream):
             # We need to special-case this because html5lib sets
             # charEncoding to UTF-8 if it gets Unicode input.
             doc.original_encoding = None
         else:
             doc.original_encoding = parser.tokenizer.stream.charEncoding[0]
 
+        # Let go of this document before keeping the parser around.
+        tree = self.underlying_builder
+        tree.soup = tree.document = tree.headPointer = tree.formPointer = None
+        tree.openElements = []
+        tree.activeFormattingElements = []
+        parser.tokenizer = None
+        self._idle_parser = parser
+
+    def __getstate__(self):
+        # A copy of this builder will make its own parser.
+        state = dict(self.__dict__)
+        state.pop('_idle_parser', None)
+        state.pop('underlying_builder', None)
+        return state
+
     def create_treebuilder(self, namespaceHTMLElements):
         self.underlying_builder = TreeBuilderForHtml5lib(
             self.soup, namespaceHTMLElements)
@@ -58,13 +90,16 @@ class TreeBuilderForHtml5lib(html5lib.treebuilders._base.TreeBuilder):
 
     def __init__(self, soup, namespaceHTMLElements):
         self.soup = soup
+        self.soup._html5lib_string_run = None
         super(TreeBuilderForHtml5lib, self).__init__(namespaceHTMLElements)
 
     def documentClass(self):
         self.soup.reset()
+        self.soup._html5lib_string_run = None
         return Element(self.soup, self.soup, None)
 
     def insertDoctype(self, token):
+        end_string_run(self.soup)
         name = token["name"]
         publicId = token["publicId"]
         systemId = token["systemId"]
@@ -82,18 +117,34 @@ class TreeBuilderForHtml5lib(html5lib.treebuilders._base.TreeBuilder):
     def fragmentClass(self):
         self.soup = BeautifulSoup("")
         self.soup.name = "[document_fragment]"
+        self.soup._html5lib_string_run = None
         return Element(self.soup, self.soup, None)
 
     def appendChild(self, node):
         # XXX This code is not covered by the BS4 tests.
+        end_string_run(self.soup)
         self.soup.append(node.element)
 
     def getDocument(self):
+        end_string_run(self.soup)
         return self.soup
 
     def getFragment(self):
+        end_string_run(self.soup)
         return html5lib.treebuilders._base.TreeBuilder.getFragment(self).element
 
+def end_string_run(soup):
+    """Turn any pieces of text collected by Element.appendChild() into
+    a single NavigableString."""
+    run = soup._html5lib_string_run
+    if run is None:
+        return
+    soup._html5lib_string_run = None
+    old_element, pieces = run
+    new_element = soup.new_string(u''.join(pieces))
+    old_element.replace_with(new_element)
+    soup._most_recent_element = new_element
+
 class AttrList(object):
     def __init__(self, element):
         self.element = element
@@ -141,14 +192,20 @@ class Element(html5lib.treebuilders._base.Node):
 
         if (string_child and self.element.contents
             and self.element.contents[-1].__class__ == NavigableString):
-            # We are appending a string onto another string.
-            # TODO This has O(n^2) performance, for input like
-            # "a</a>a</a>a</a>..."
+            # We are appending a string onto another string. Creating
+            # a new NavigableString every time would have O(n^2)
+            # performance for input like "a</a>a</a>a</a>...", so
+            # collect the pieces, and create a single string once
+            # something else happens to the tree.
             old_element = self.element.contents[-1]
-            new_element = self.soup.new_string(old_element + string_child)
-            old_element.replace_with(new_element)
-            self.soup._most_recent_element = new_element            
+            run = self.soup._html5lib_string_run
+            if run is None or run[0] is not old_element:
+                end_string_run(self.soup)
+                run = self.soup._html5lib_string_run = (
+                    old_element, [old_element])
+            run[1].append(string_child)
         else:
+            end_string_run(self.soup)
             if isinstance(node, basestring):
                 # Create a brand new NavigableString from this string.
                 child = self.soup.new_string(node)
@@ -188,6 +245,7 @@ class Element(html5lib.treebuilders._base.Node):
             self.appendChild(data)
 
     def insertBefore(self, node, refNode):
+        end_string_run(self.soup)
         index = self.element.index(refNode.element)
         if (node.element.__class__ == NavigableString and self.element.contents
             and self.element.contents[index-1].__class__ == NavigableString):
@@ -200,10 +258,12 @@ class Element(html5lib.treebuilders._base.Node):
             node.parent = self
 
     def removeChild(self, node):
+        end_string_run(self.soup)
         node.element.extract()
         pass
 
     def reparentChildren(self, newParent):
+        end_string_run(self.soup)
         while self.element.contents:
             child = self.element.contents[0]
             child.extract()
@@ -36,6 +36,7 @@ from bs4.dammit import EntitySubstitution, UnicodeDammit
 from bs4.builder import (
     HTML,
     HTMLTreeBuilder,
+    ParserRejectedMarkup,
     STRICT,
     )
 
@@ -120,12 +121,28 @@ class BeautifulSoupHTMLParser(HTMLParser):
 class HTMLParserTreeBuilder(HTMLTreeBuilder):
 
     is_xml = False
-    features = [HTML, STRICT, HTMLPARSER]
+    NAME = HTMLPARSER
+    features = [NAME, HTML, STRICT]
+
+    accepts_file_objects = True
+
+    # When parsing a file-like object, feed() passes this many
+    # characters at a time to HTMLParser.
+    CHUNK_SIZE = 64 * 1024
 
     def __init__(self, *args, **kwargs):
         if CONSTRUCTOR_TAKES_STRICT:
             kwargs['strict'] = False
         self.parser_args = (args, kwargs)
+        # A parser that finished a document, ready to be reset and
+        # used again.
+        self._idle_parser = None
+
+    def __getstate__(self):
+        # A copy of this builder will make its own parser.
+        state = dict(self.__dict__)
+        state['_idle_parser'] = None
+        return state
 
     def prepare_markup(self, markup, user_specified_encoding=None,
                        document_declared_encoding=None):
@@ -138,6 +155,12 @@ class HTMLParserTreeBuilder(HTMLTreeBuilder):
             yield (markup, None, None, False)
             return
 
+        if hasattr(markup, 'read'):
+            for strategy in self.prepare_file(
+                markup, user_specified_encoding, document_declared_encoding):
+                yield strategy
+            return
+
         try_encodings = [user_specified_encoding, document_declared_encoding]
         dammit = UnicodeDammit(markup, try_encodings, is_html=True)
         yield (dammit.markup, dammit.original_encoding,
@@ -145,15 +168,41 @@ class HTMLParserTreeBuilder(HTMLTreeBuilder):
                dammit.contains_replacement_characters)
 
     def feed(self, markup):
-        args, kwargs = self.parser_args
-        parser = BeautifulSoupHTMLParser(*args, **kwargs)
+        for ignore in self.feed_chunks(markup):
+            pass
+
+    def feed_chunks(self, markup):
+        """See `TreeBuilder`."""
+        parser = self._idle_parser
+        self._idle_parser = None
+        if parser is None:
+            args, kwargs = self.parser_args
+            parser = BeautifulSoupHTMLParser(*args, **kwargs)
         parser.soup = self.soup
         try:
-            parser.feed(markup)
+            if hasattr(markup, 'read'):
+                data = self._read_chunk(markup)
+                while len(data) != 0:
+                    parser.feed(data)
+                    yield
+                    data = self._read_chunk(markup)
+            else:
+                parser.feed(markup)
         except HTMLParseError, e:
             warnings.warn(RuntimeWarning(
                 "Python's built-in HTMLParser cannot parse the given document. This is not a bug in Beautiful Soup. The best solution is to install an external parser (lxml or html5lib), and use Beautiful Soup with that parser. See http://www.crummy.com/software/BeautifulSoup/bs4/doc/#installing-a-parser for help."))
             raise e
+        parser.reset()
+        parser.soup = None
+        self._idle_parser = parser
+
+    def _read_chunk(self, fileobj):
+        try:
+            return fileobj.read(self.CHUNK_SIZE)
+        except UnicodeDecodeError, e:
+            # The file turned out not to be in the encoding that was
+            # detected from its first few kilobytes.
+            raise ParserRejectedMarkup(str(e))
 
 # Patch 3.2 versions of HTMLParser earlier than 3.2.3 to use some
 # 3.2.3 code. This ensures they don't treat markup like <p></p> as a
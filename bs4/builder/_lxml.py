@@ -6,6 +6,7 @@ __all__ = [
 from io import BytesIO
 from StringIO import StringIO
 import collections
+import os
 from lxml import etree
 from bs4.element import Comment, Doctype, NamespacedAttribute
 from bs4.builder import (
@@ -25,10 +26,21 @@ class LXMLTreeBuilderForXML(TreeBuilder):
 
     is_xml = True
 
+    NAME = "lxml-xml"
+
     # Well, it's permissive by XML parser standards.
-    features = [LXML, XML, FAST, PERMISSIVE]
+    features = [NAME, LXML, XML, FAST, PERMISSIVE]
+
+    accepts_file_objects = True
 
+    # feed() passes the markup to lxml in chunks. Unless a builder is
+    # given a chunk size, the chunks get bigger as the document gets
+    # bigger, so that a large document doesn't take thousands of
+    # calls to feed(), but they're never smaller than CHUNK_SIZE or
+    # bigger than MAX_CHUNK_SIZE.
     CHUNK_SIZE = 512
+    MAX_CHUNK_SIZE = 64 * 1024
+    CHUNKS_PER_DOCUMENT = 16
 
     # This namespace mapping is specified in the XML Namespace
     # standard.
@@ -43,6 +55,11 @@ class LXMLTreeBuilderForXML(TreeBuilder):
             target=self, strip_cdata=False, recover=True, encoding=encoding)
 
     def parser_for(self, encoding):
+        # Reuse a parser from an earlier document if there is one.
+        parser = self._idle_parsers.pop(encoding, None)
+        if parser is not None:
+            return parser
+
         # Use the default parser.
         parser = self.default_parser(encoding)
 
@@ -51,16 +68,29 @@ class LXMLTreeBuilderForXML(TreeBuilder):
             parser = parser(target=self, strip_cdata=False, encoding=encoding)
         return parser
 
-    def __init__(self, parser=None, empty_element_tags=None):
+    def __init__(self, parser=None, empty_element_tags=None,
+                 chunk_size=None):
         # TODO: Issue a warning if parser is present but not a
         # callable, since that means there's no way to create new
         # parsers for different encodings.
         self._default_parser = parser
+        self.chunk_size = chunk_size
+        # Parsers that finished a document, by encoding. lxml resets
+        # a parser when it's closed, so it can be used again.
+        self._idle_parsers = {}
         if empty_element_tags is not None:
             self.empty_element_tags = set(empty_element_tags)
         self.soup = None
         self.nsmaps = [self.DEFAULT_NSMAPS]
 
+    def __getstate__(self):
+        # lxml parsers can't be pickled or copied. A copy of this
+        # builder will make its own.
+        state = dict(self.__dict__)
+        state['_idle_parsers'] = {}
+        state['parser'] = None
+        return state
+
     def _getNsTag(self, tag):
         # Split the namespace URL out of a fully-qualified lxml tag
         # name. Copied from lxml's src/lxml/sax.py.
@@ -78,6 +108,15 @@ class LXMLTreeBuilderForXML(TreeBuilder):
 
         Each 4-tuple represents a strategy for parsing the document.
         """
+        if hasattr(markup, 'read'):
+            # Detect the encoding from the start of the file, but let
+            # lxml do the decoding.
+            for strategy in self.prepare_file(
+                markup, user_specified_encoding, document_declared_encoding,
+                decode=False):
+                yield strategy
+            return
+
         if isinstance(markup, unicode):
             # We were given Unicode. Maybe lxml can parse Unicode on
             # this system?
@@ -99,26 +138,70 @@ class LXMLTreeBuilderForXML(TreeBuilder):
         for encoding in detector.encodings:
             yield (detector.markup, encoding, document_declared_encoding, False)
 
+    def chunk_size_for(self, markup):
+        """How many bytes or characters to feed lxml at a time.
+
+        :param markup: A string, or a file-like object.
+        """
+        if self.chunk_size is not None:
+            return self.chunk_size
+        if hasattr(markup, 'read'):
+            try:
+                length = os.fstat(markup.fileno()).st_size
+            except (AttributeError, IOError, OSError, ValueError):
+                # We don't know how big this file is, so read it in
+                # the biggest chunks we're willing to use.
+                return self.MAX_CHUNK_SIZE
+        else:
+            length = len(markup)
+        return max(self.CHUNK_SIZE, min(
+                self.MAX_CHUNK_SIZE, length // self.CHUNKS_PER_DOCUMENT))
+
     def feed(self, markup):
+        for ignore in self.feed_chunks(markup):
+            pass
+
+    def feed_chunks(self, markup):
+        """See `TreeBuilder`."""
+        chunk_size = self.chunk_size_for(markup)
         if isinstance(markup, bytes):
             markup = BytesIO(markup)
         elif isinstance(markup, unicode):
             markup = StringIO(markup)
 
-        # Call feed() at least once, even if the markup is empty,
-        # or the parser won't be initialized.
-        data = markup.read(self.CHUNK_SIZE)
+        encoding = self.soup.original_encoding
         try:
-            self.parser = self.parser_for(self.soup.original_encoding)
-            self.parser.feed(data)
-            while len(data) != 0:
-                # Now call feed() on the rest of the data, chunk by chunk.
-                data = markup.read(self.CHUNK_SIZE)
-                if len(data) != 0:
-                    self.parser.feed(data)
+            self.parser = self.parser_for(encoding)
+            for ignore in self._feed_file(markup, chunk_size):
+                yield
             self.parser.close()
         except (UnicodeDecodeError, LookupError, etree.ParserError), e:
             raise ParserRejectedMarkup(str(e))
+        self._parser_finished(encoding)
+
+    def _parser_finished(self, encoding):
+        # Only a parser that got all the way through a document goes
+        # back for reuse. One that failed, or was abandoned partway
+        # through, is in an unknown state.
+        self._idle_parsers[encoding] = self.parser
+        self.parser = None
+
+    def _feed_file(self, markup, chunk_size):
+        """Feed the contents of a file-like object to the parser.
+
+        This is a generator that yields after each chunk.
+        """
+        # Call feed() at least once, even if the markup is empty,
+        # or the parser won't be initialized.
+        data = markup.read(chunk_size)
+        self.parser.feed(data)
+        yield
+        while len(data) != 0:
+            # Now call feed() on the rest of the data, chunk by chunk.
+            data = markup.read(chunk_size)
+            if len(data) != 0:
+                self.parser.feed(data)
+                yield
 
     def close(self):
         self.nsmaps = [self.DEFAULT_NSMAPS]
@@ -212,20 +295,28 @@ class LXMLTreeBuilderForXML(TreeBuilder):
 
 class LXMLTreeBuilder(HTMLTreeBuilder, LXMLTreeBuilderForXML):
 
-    features = [LXML, HTML, FAST, PERMISSIVE]
+    NAME = LXML
+    features = [NAME, HTML, FAST, PERMISSIVE]
     is_xml = False
 
     def default_parser(self, encoding):
         return etree.HTMLParser
 
-    def feed(self, markup):
+    def feed_chunks(self, markup):
+        """See `TreeBuilder`."""
         encoding = self.soup.original_encoding
         try:
             self.parser = self.parser_for(encoding)
-            self.parser.feed(markup)
+            if hasattr(markup, 'read'):
+                for ignore in self._feed_file(
+                    markup, self.chunk_size_for(markup)):
+                    yield
+            else:
+                self.parser.feed(markup)
             self.parser.close()
         except (UnicodeDecodeError, LookupError, etree.ParserError), e:
             raise ParserRejectedMarkup(str(e))
+        self._parser_finished(encoding)
 
 
     def test_fragment_to_document(self, fragment):
@@ -8,6 +8,7 @@ encoding; that's the tree builder's job.
 """
 
 import codecs
+import hashlib
 from htmlentitydefs import codepoint2name
 import re
 import logging
@@ -46,6 +47,7 @@ xml_encoding_re = re.compile(
     '^<\?.*encoding=[\'"](.*?)[\'"].*\?>'.encode(), re.I)
 html_meta_re = re.compile(
     '<\s*meta[^>]+charset\s*=\s*["\']?([^>]*?)[ /;\'">]'.encode(), re.I)
+non_ascii_re = re.compile('[\\x80-\\xff]'.encode())
 
 class EntitySubstitution(object):
 
@@ -54,6 +56,7 @@ class EntitySubstitution(object):
     def _populate_class_variables():
         lookup = {}
         reverse_lookup = {}
+        references = {}
         characters_for_re = []
         for codepoint, name in list(codepoint2name.items()):
             character = unichr(codepoint)
@@ -63,12 +66,15 @@ class EntitySubstitution(object):
                 # is handled elsewhere.
                 characters_for_re.append(character)
                 lookup[character] = name
+                references[character] = "&%s;" % name
             # But we do want to turn &quot; into the quotation mark.
             reverse_lookup[name] = character
         re_definition = "[%s]" % "".join(characters_for_re)
-        return lookup, reverse_lookup, re.compile(re_definition)
+        return (lookup, reverse_lookup, references, re.compile(re_definition),
+                re.compile("(%s)" % re_definition))
     (CHARACTER_TO_HTML_ENTITY, HTML_ENTITY_TO_CHARACTER,
-     CHARACTER_TO_HTML_ENTITY_RE) = _populate_class_variables()
+     CHARACTER_TO_HTML_ENTITY_REFERENCE, CHARACTER_TO_HTML_ENTITY_RE,
+     _SPLIT_ON_HTML_ENTITY_CHARACTERS_RE) = _populate_class_variables()
 
     CHARACTER_TO_XML_ENTITY = {
         "'": "apos",
@@ -78,6 +84,10 @@ class EntitySubstitution(object):
         ">": "gt",
         }
 
+    CHARACTER_TO_XML_ENTITY_REFERENCE = dict(
+        (character, "&%s;" % name)
+        for character, name in CHARACTER_TO_XML_ENTITY.items())
+
     BARE_AMPERSAND_OR_BRACKET = re.compile("([<>]|"
                                            "&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;)"
                                            ")")
@@ -86,15 +96,13 @@ class EntitySubstitution(object):
 
     @classmethod
     def _substitute_html_entity(cls, matchobj):
-        entity = cls.CHARACTER_TO_HTML_ENTITY.get(matchobj.group(0))
-        return "&%s;" % entity
+        return cls.CHARACTER_TO_HTML_ENTITY_REFERENCE[matchobj.group(0)]
 
     @classmethod
     def _substitute_xml_entity(cls, matchobj):
         """Used with a regular expression to substitute the
         appropriate XML entity for an XML special character."""
-        entity = cls.CHARACTER_TO_XML_ENTITY[matchobj.group(0)]
-        return "&%s;" % entity
+        return cls.CHARACTER_TO_XML_ENTITY_REFERENCE[matchobj.group(0)]
 
     @classmethod
     def quoted_attribute_value(self, value):
@@ -146,9 +154,15 @@ class EntitySubstitution(object):
         :param make_quoted_attribute: If True, then the string will be
          quoted, as befits an attribute value.
         """
-        # Escape angle brackets and ampersands.
-        value = cls.AMPERSAND_OR_BRACKET.sub(
-            cls._substitute_xml_entity, value)
+        # Escape angle brackets and ampersands. Chained replace()
+        # calls are much faster than a regular expression with a
+        # callback, and a string with nothing to escape isn't copied.
+        if "&" in value:
+            value = value.replace("&", "&amp;")
+        if "<" in value:
+            value = value.replace("<", "&lt;")
+        if ">" in value:
+            value = value.replace(">", "&gt;")
 
         if make_quoted_attribute:
             value = cls.quoted_attribute_value(value)
@@ -188,8 +202,15 @@ class EntitySubstitution(object):
         character with "&eacute;" will make it more readable to some
         people.
         """
-        return cls.CHARACTER_TO_HTML_ENTITY_RE.sub(
-            cls._substitute_html_entity, s)
+        # Splitting on a group puts the characters to be replaced
+        # at the odd-numbered positions. Looking them all up at once
+        # is much faster than calling back into Python for each one.
+        if cls.CHARACTER_TO_HTML_ENTITY_RE.search(s) is None:
+            return s
+        pieces = cls._SPLIT_ON_HTML_ENTITY_CHARACTERS_RE.split(s)
+        references = cls.CHARACTER_TO_HTML_ENTITY_REFERENCE
+        pieces[1::2] = [references[character] for character in pieces[1::2]]
+        return "".join(pieces)
 
 
 class EncodingDetector:
@@ -205,18 +226,51 @@ class EncodingDetector:
     document), or in a <meta> tag (if the bytestring is to be
     interpreted as an HTML document.)
 
-    3. An encoding detected through textual analysis by chardet,
-    cchardet, or a similar external library.
+    3. UTF-8, if the entire bytestring is valid UTF-8 (which includes
+    plain ASCII). This is checked in a single pass, which is much
+    faster than the next step.
+
+    4. An encoding detected through textual analysis by chardet,
+    cchardet, or a similar external library. To save time, this only
+    looks at a sample of the bytestring.
 
-    4. UTF-8.
+    5. UTF-8.
 
-    5. Windows-1252.
+    6. Windows-1252.
     """
-    def __init__(self, markup, override_encodings=None, is_html=False):
+
+    # chardet is only shown this many bytes, starting from the first
+    # non-ASCII byte.
+    CHARDET_SAMPLE_SIZE = 64 * 1024
+
+    # Set this to a dictionary (or anything else with get() and
+    # __setitem__()) to remember chardet's guesses. A guess is stored
+    # under the fingerprint() of the bytestring, so the next document
+    # that starts the same way--another copy of the same page, say--
+    # doesn't need to go through chardet.
+    chardet_cache = None
+
+    # fingerprint() looks at this many bytes.
+    FINGERPRINT_SIZE = 1024
+
+    # When checking whether a document is UTF-8 without keeping the
+    # decoded text, decode this many bytes at a time.
+    UTF8_CHECK_CHUNK_SIZE = 64 * 1024
+
+    # Set to False if the markup might end partway through a character.
+    complete = True
+
+    def __init__(self, markup, override_encodings=None, is_html=False,
+                 keep_utf8_markup=False):
         self.override_encodings = override_encodings or []
         self.chardet_encoding = None
         self.is_html = is_html
         self.declared_encoding = None
+        # If keep_utf8_markup is true and the bytestring turns out to
+        # be valid UTF-8, its Unicode version ends up here. Otherwise
+        # the decoded text is thrown away as the check goes along.
+        self.keep_utf8_markup = keep_utf8_markup
+        self.utf8_markup = None
 
         # First order of business: strip a byte-order mark.
         self.markup, self.sniffed_encoding = self.strip_byte_order_mark(markup)
@@ -250,10 +304,20 @@ class EncodingDetector:
         if self._usable(self.declared_encoding, tried):
             yield self.declared_encoding
 
+        # If the document decodes as UTF-8, there's no need to guess.
+        if isinstance(self.markup, bytes) and 'utf-8' not in tried:
+            if self.keep_utf8_markup:
+                self.utf8_markup = self._decode_utf8(self.markup)
+                is_utf8 = self.utf8_markup is not None
+            else:
+                is_utf8 = self._is_utf8(self.markup)
+            if is_utf8 and self._usable('utf-8', tried):
+                yield 'utf-8'
+
         # Use third-party character set detection to guess at the
         # encoding.
         if self.chardet_encoding is None:
-            self.chardet_encoding = chardet_dammit(self.markup)
+            self.chardet_encoding = self._chardet()
         if self._usable(self.chardet_encoding, tried):
             yield self.chardet_encoding
 
@@ -262,6 +326,63 @@ class EncodingDetector:
             if self._usable(e, tried):
                 yield e
 
+    def _decode_utf8(self, markup):
+        try:
+            if self.complete:
+                return markup.decode('utf-8')
+            return codecs.getincrementaldecoder('utf-8')().decode(markup)
+        except UnicodeDecodeError:
+            return None
+
+    def _is_utf8(self, markup):
+        """Check that a bytestring is valid UTF-8, without ever having
+        all of it decoded at once."""
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        size = self.UTF8_CHECK_CHUNK_SIZE
+        try:
+            for start in xrange(0, len(markup), size):
+                decoder.decode(markup[start:start + size])
+            decoder.decode(b'', self.complete)
+        except UnicodeDecodeError:
+            return False
+        return True
+
+    def _chardet(self):
+        cache = self.chardet_cache
+        if cache is not None and isinstance(self.markup, bytes):
+            key = self.fingerprint(self.markup)
+            encoding = cache.get(key)
+            if encoding is not None:
+                return encoding
+        else:
+            cache = None
+        encoding = chardet_dammit(self.chardet_sample(self.markup))
+        if cache is not None and encoding is not None:
+            cache[key] = encoding
+        return encoding
+
+    @classmethod
+    def chardet_sample(cls, markup):
+        """Choose the part of a bytestring to show to chardet.
+
+        The ASCII at the start of a document (usually markup) says
+        nothing about its encoding, so the sample starts with the first
+        non-ASCII byte.
+        """
+        match = non_ascii_re.search(markup)
+        if match is None:
+            start = 0
+        else:
+            # Round down so as not to start partway through a UTF-16
+            # or UTF-32 character.
+            start = match.start() & ~3
+        return markup[start:start + cls.CHARDET_SAMPLE_SIZE]
+
+    @classmethod
+    def fingerprint(cls, markup):
+        """A key for chardet_cache: a hash of the start of a bytestring."""
+        return hashlib.sha1(markup[:cls.FINGERPRINT_SIZE]).hexdigest()
+
     @classmethod
     def strip_byte_order_mark(cls, data):
         """If a byte-order mark is present, strip it and return the encoding it implies."""
@@ -311,6 +432,12 @@ class EncodingDetector:
             return declared_encoding.lower()
         return None
 
+class PrefixEncodingDetector(EncodingDetector):
+    """An EncodingDetector for the start of a document, which may end
+    partway through a character."""
+
+    complete = False
+
 class UnicodeDammit:
     """A class for detecting the encoding of a *ML document and
     converting it to a Unicode string. If the source encoding is
@@ -337,7 +464,8 @@ class UnicodeDammit:
         self.contains_replacement_characters = False
         self.is_html = is_html
 
-        self.detector = EncodingDetector(markup, override_encodings, is_html)
+        self.detector = EncodingDetector(
+            markup, override_encodings, is_html, keep_utf8_markup=True)
 
         # Is the data in Unicode to begin with?
         if isinstance(markup, unicode) or markup == '':
@@ -375,22 +503,45 @@ class UnicodeDammit:
         if not u:
             self.original_encoding = None
 
-    def _sub_ms_char(self, match):
+    SMART_QUOTES_RE = re.compile(b"[\x80-\x9f]")
+
+    # Decoding tables built by _smart_quotes_table(), keyed by
+    # (encoding, smart_quotes_to).
+    _smart_quotes_tables = {}
+
+    @classmethod
+    def _ms_char_replacement(cls, orig, smart_quotes_to):
         """Changes a MS smart quote character to an XML or HTML
         entity, or an ASCII character."""
-        orig = match.group(1)
-        if self.smart_quotes_to == 'ascii':
-            sub = self.MS_CHARS_TO_ASCII.get(orig).encode()
-        else:
-            sub = self.MS_CHARS.get(orig)
-            if type(sub) == tuple:
-                if self.smart_quotes_to == 'xml':
-                    sub = '&#x'.encode() + sub[1].encode() + ';'.encode()
-                else:
-                    sub = '&'.encode() + sub[0].encode() + ';'.encode()
-            else:
-                sub = sub.encode()
-        return sub
+        if smart_quotes_to == 'ascii':
+            return unicode(cls.MS_CHARS_TO_ASCII[orig])
+        sub = cls.MS_CHARS[orig]
+        if type(sub) == tuple:
+            if smart_quotes_to == 'xml':
+                return u'&#x%s;' % sub[1]
+            return u'&%s;' % sub[0]
+        return unicode(sub)
+
+    @classmethod
+    def _smart_quotes_table(cls, encoding, smart_quotes_to):
+        """A table for codecs.charmap_decode() that decodes a
+        single-byte encoding and replaces MS smart quotes in the same
+        pass."""
+        key = (encoding, smart_quotes_to)
+        table = cls._smart_quotes_tables.get(key)
+        if table is None:
+            table = {}
+            for byte in range(256):
+                try:
+                    table[byte] = chr(byte).decode(encoding)
+                except UnicodeDecodeError:
+                    # Leave it to the error handler.
+                    pass
+            for byte in range(0x80, 0xa0):
+                table[byte] = cls._ms_char_replacement(
+                    chr(byte), smart_quotes_to)
+            cls._smart_quotes_tables[key] = table
+        return table
 
     def _convert_from(self, proposed, errors="strict"):
         proposed = self.find_codec(proposed)
@@ -398,18 +549,26 @@ class UnicodeDammit:
             return None
         self.tried_encodings.append((proposed, errors))
         markup = self.markup
-        # Convert smart quotes to HTML if coming from an encoding
-        # that might have them.
-        if (self.smart_quotes_to is not None
-            and proposed in self.ENCODINGS_WITH_SMART_QUOTES):
-            smart_quotes_re = b"([\x80-\x9f])"
-            smart_quotes_compiled = re.compile(smart_quotes_re)
-            markup = smart_quotes_compiled.sub(self._sub_ms_char, markup)
-
         try:
             #print "Trying to convert document to %s (errors=%s)" % (
             #    proposed, errors)
-            u = self._to_unicode(markup, proposed, errors)
+            if (self.smart_quotes_to is not None
+                and proposed in self.ENCODINGS_WITH_SMART_QUOTES
+                and self.SMART_QUOTES_RE.search(markup) is not None):
+                # Convert smart quotes to HTML if coming from an
+                # encoding that might have them.
+                u = codecs.charmap_decode(
+                    markup, errors, self._smart_quotes_table(
+                        proposed, self.smart_quotes_to))[0]
+            elif (proposed == 'utf-8' and markup is self.detector.markup
+                and self.detector.utf8_markup is not None):
+                # The detector already had to decode the document
+                # to find out it was UTF-8. There's no need for it to
+                # hold on to a second reference.
+                u = self.detector.utf8_markup
+                self.detector.utf8_markup = None
+            else:
+                u = self._to_unicode(markup, proposed, errors)
             self.markup = u
             self.original_encoding = proposed
         except Exception as e:
@@ -761,6 +920,22 @@ class UnicodeDammit:
     FIRST_MULTIBYTE_MARKER = MULTIBYTE_MARKERS_AND_SIZES[0][0]
     LAST_MULTIBYTE_MARKER = MULTIBYTE_MARKERS_AND_SIZES[-1][1]
 
+    # A UTF-8 multibyte character is a start byte followed by however
+    # many bytes its size calls for. Like detwingle() always has, this
+    # takes the following bytes on trust, and accepts a character
+    # that's cut off by the end of the string.
+    MULTIBYTE_CHARACTER_RE = re.compile('|'.join(
+            '[\\x%02x-\\x%02x][\\x00-\\xff]{0,%d}' % (start, end, size - 1)
+            for start, end, size in MULTIBYTE_MARKERS_AND_SIZES).encode())
+
+    # Matches either a run of UTF-8 multibyte characters, with the
+    # last character of the run in group 1, or (in group 2) a single
+    # non-ASCII byte that can't be part of one. The lookahead lets the
+    # regex engine skip over ASCII quickly.
+    DETWINGLE_RE = re.compile(
+        '(?=[\\x80-\\xff])(?:('.encode() + MULTIBYTE_CHARACTER_RE.pattern
+        + ')+|([\\x80-\\xff]))'.encode())
+
     @classmethod
     def detwingle(cls, in_bytes, main_encoding="utf8",
                   embedded_encoding="windows-1252"):
@@ -776,6 +951,30 @@ class UnicodeDammit:
         characters have been converted to their `main_encoding`
         equivalents.
         """
+        cls._check_detwingle_encodings(main_encoding, embedded_encoding)
+        return cls._detwingle(in_bytes)[0]
+
+    @classmethod
+    def detwingle_chunks(cls, chunks, main_encoding="utf8",
+                         embedded_encoding="windows-1252"):
+        """Like detwingle(), but for a document that arrives in pieces.
+
+        :param chunks: An iterable of bytestrings.
+        :yield: Fixed-up bytestrings. If a chunk ends partway through
+        a multibyte character, that character is held back and
+        included with the next chunk.
+        """
+        cls._check_detwingle_encodings(main_encoding, embedded_encoding)
+        leftover = b''
+        for chunk in chunks:
+            fixed, leftover = cls._detwingle(leftover + chunk, final=False)
+            if fixed:
+                yield fixed
+        if leftover:
+            yield cls._detwingle(leftover)[0]
+
+    @classmethod
+    def _check_detwingle_encodings(cls, main_encoding, embedded_encoding):
         if embedded_encoding.replace('_', '-').lower() not in (
             'windows-1252', 'windows_1252'):
             raise NotImplementedError(
@@ -786,41 +985,190 @@ class UnicodeDammit:
             raise NotImplementedError(
                 "UTF-8 is the only currently supported main encoding.")
 
-        byte_chunks = []
+    @classmethod
+    def _detwingle(cls, in_bytes, final=True):
+        """Fix up Windows-1252 characters in a UTF-8 bytestring.
 
+        :return: A 2-tuple (fixed bytestring, leftover). If `final` is
+        false and the bytestring ends partway through a multibyte
+        character, that character is left out of the fixed bytestring
+        and returned as the leftover.
+        """
+        byte_chunks = []
         chunk_start = 0
-        pos = 0
-        while pos < len(in_bytes):
-            byte = in_bytes[pos]
-            if not isinstance(byte, int):
-                # Python 2.x
-                byte = ord(byte)
-            if (byte >= cls.FIRST_MULTIBYTE_MARKER
-                and byte <= cls.LAST_MULTIBYTE_MARKER):
-                # This is the start of a UTF-8 multibyte character. Skip
-                # to the end.
-                for start, end, size in cls.MULTIBYTE_MARKERS_AND_SIZES:
-                    if byte >= start and byte <= end:
-                        pos += size
-                        break
-            elif byte >= 0x80 and byte in cls.WINDOWS_1252_TO_UTF8:
-                # We found a Windows-1252 character!
-                # Save the string up to this point as a chunk.
-                byte_chunks.append(in_bytes[chunk_start:pos])
-
-                # Now translate the Windows-1252 character into UTF-8
-                # and add it as another, one-byte chunk.
-                byte_chunks.append(cls.WINDOWS_1252_TO_UTF8[byte])
-                pos += 1
-                chunk_start = pos
-            else:
-                # Go on to the next character.
-                pos += 1
+        end = len(in_bytes)
+        leftover_start = end
+
+        # The regular expression skips over ASCII, and over UTF-8
+        # multibyte characters a run at a time, so Python code only
+        # runs for bytes that might be Windows-1252 characters.
+        for match in cls.DETWINGLE_RE.finditer(in_bytes):
+            byte = match.group(2)
+            if byte is None:
+                if not final and match.end() == end:
+                    leftover_start = cls._incomplete_character_start(
+                        in_bytes, match.start(1))
+                continue
+            replacement = cls.WINDOWS_1252_TO_UTF8.get(ord(byte))
+            if replacement is None:
+                continue
+            # We found a Windows-1252 character! Save the string up to
+            # this point as a chunk, then the character translated
+            # into UTF-8 as another chunk.
+            pos = match.start(2)
+            byte_chunks.append(in_bytes[chunk_start:pos])
+            byte_chunks.append(replacement)
+            chunk_start = pos + 1
+
+        leftover = in_bytes[leftover_start:]
         if chunk_start == 0:
             # The string is unchanged.
-            return in_bytes
+            if leftover_start == end:
+                return in_bytes, leftover
+            return in_bytes[:leftover_start], leftover
+        # Store the final chunk.
+        byte_chunks.append(in_bytes[chunk_start:leftover_start])
+        return b''.join(byte_chunks), leftover
+
+    @classmethod
+    def _incomplete_character_start(cls, in_bytes, last_start):
+        """Find out whether a bytestring ends partway through a UTF-8
+        multibyte character.
+
+        :param last_start: Where the bytestring's last multibyte
+        character starts. Only that character is looked at, so this
+        doesn't depend on how long the run of multibyte characters is.
+
+        :return: `last_start` if the character is incomplete, or the
+        length of the bytestring if it's complete.
+        """
+        end = len(in_bytes)
+        lead = ord(in_bytes[last_start:last_start + 1])
+        for start, stop, size in cls.MULTIBYTE_MARKERS_AND_SIZES:
+            if lead >= start and lead <= stop:
+                if end - last_start < size:
+                    return last_start
+                break
+        return end
+
+
+class EncodingDetectingReader(UnicodeDammit):
+    """A file-like object that detects the encoding of another
+    file-like object and passes along its contents.
+
+    Only the first `prefix_size` bytes of the file are used to
+    detect the encoding. They're run through an EncodingDetector,
+    and the first suggested encoding that can decode them is chosen.
+    After that, read() returns the rest of the file a chunk at a
+    time, decoded into Unicode--or, if `decode` is false, as the
+    original bytes with any byte-order mark removed--so the whole
+    document never has to be in memory at once.
+
+    Since the encoding is chosen before most of the document has been
+    seen, the rest of the document might turn out not to be valid in
+    that encoding. What happens then depends on `errors`, which works
+    the same way as the `errors` argument to bytes.decode().
+    """
+
+    # An encoding declaration should be right at the start of a
+    # document, and this is plenty of text for chardet to work with.
+    PREFIX_SIZE = 8 * 1024
+
+    def __init__(self, fileobj, override_encodings=[], is_html=False,
+                 decode=True, errors="strict", prefix_size=None):
+        self.fileobj = fileobj
+        self.is_html = is_html
+        self.tried_encodings = []
+        self.contains_replacement_characters = False
+        self.original_encoding = None
+        self.decoder = None
+
+        prefix = fileobj.read(prefix_size or self.PREFIX_SIZE)
+        if isinstance(prefix, unicode):
+            # The file has already been decoded.
+            self.detector = EncodingDetector(b'', is_html=is_html)
+            self.buffer = prefix
+            return
+
+        self.detector = PrefixEncodingDetector(
+            prefix, override_encodings, is_html)
+        self.buffer = self.detector.markup
+
+        codecs_to_try = []
+        for encoding in self.detector.encodings:
+            if encoding == 'ascii':
+                # chardet says the prefix is ASCII, but that says
+                # nothing about the rest of the document. UTF-8 can
+                # decode everything ASCII can, and more besides.
+                encoding = 'utf-8'
+            codec = self.find_codec(encoding)
+            if codec is None or codec in codecs_to_try:
+                continue
+            codecs_to_try.append(codec)
+            if self._start_decoding(codec, "strict"):
+                break
         else:
-            # Store the final chunk.
-            byte_chunks.append(in_bytes[chunk_start:])
-        return b''.join(byte_chunks)
+            # None of the encodings can decode the prefix.
+            if errors == "strict":
+                raise UnicodeError(
+                    "Couldn't find an encoding that can decode the start "
+                    "of this document.")
+            # As in UnicodeDammit, try them again with character
+            # replacement.
+            for codec in codecs_to_try:
+                if self._start_decoding(codec, errors):
+                    self.contains_replacement_characters = True
+                    break
 
+        if self.decoder is not None and errors != "strict":
+            # Decode the rest of the document with the requested
+            # error handling.
+            self._start_decoding(self.original_encoding, errors)
+        if not decode:
+            self.buffer = self.detector.markup
+            self.decoder = None
+
+    def _start_decoding(self, codec, errors):
+        """Try to decode the prefix with the given codec.
+
+        :return: True if the codec worked and has become the encoding
+        of this document.
+        """
+        self.tried_encodings.append((codec, errors))
+        try:
+            decoder = codecs.getincrementaldecoder(codec)(errors)
+            decoded = decoder.decode(self.detector.markup)
+        except (LookupError, UnicodeDecodeError):
+            return False
+        self.original_encoding = codec
+        self.decoder = decoder
+        self.buffer = decoded
+        return True
+
+    def _decode(self, data, final=False):
+        if self.decoder is None:
+            return data
+        return self.decoder.decode(data, final)
+
+    def read(self, size=-1):
+        if size == 0:
+            return self.buffer[:0]
+        if size is None or size < 0:
+            # Read the whole rest of the file.
+            data = self.buffer + self._decode(self.fileobj.read(), True)
+            self.buffer = self.buffer[:0]
+            return data
+        if self.buffer:
+            # Return the decoded prefix first. This may be more than
+            # was asked for, which is fine for a parser.
+            data = self.buffer
+            self.buffer = self.buffer[:0]
+            return data
+        while True:
+            data = self.fileobj.read(size)
+            decoded = self._decode(data, not data)
+            # A chunk may end partway through a multi-byte
+            # character, and decode to nothing. Don't mistake that
+            # for the end of the file.
+            if decoded or not data:
+                return decoded
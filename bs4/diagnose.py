@@ -5,12 +5,18 @@ from HTMLParser import HTMLParser
 import bs4
 from bs4 import BeautifulSoup, __version__
 from bs4.builder import builder_registry
+from bs4.element import SoupStrainer, Tag
 
+from io import BytesIO
+import gc
+import itertools
 import os
 import pstats
 import random
+import re
 import tempfile
 import time
+import timeit
 import traceback
 import sys
 import cProfile
@@ -154,6 +160,60 @@ def rdoc(num_elements=1000):
             elements.append("</%s>" % tag_name)
     return "<html>" + "\n".join(elements) + "</html>"
 
+def entity_doc(num_elements=1000):
+    """Generate a UTF-8 document whose text is full of characters that
+    get turned into entities on output."""
+    text = u" ".join(
+        rsentence(random.randint(1, 4)).replace(u"a", u"\N{LATIN SMALL LETTER A WITH GRAVE}")
+        .replace(u"e", u"\N{LATIN SMALL LETTER E WITH ACUTE}")
+        + random.choice(
+            [u" &amp; ", u" &lt;&gt; ", u" \N{EM DASH} ", u" \N{COPYRIGHT SIGN} "])
+        for i in range(num_elements))
+    return (u"<html><body><p>%s</p></body></html>" % text).encode("utf8")
+
+def benchmark_malformed(num_elements=100000, times=3):
+    """Time the tree construction code on documents full of unclosed
+    tags and end tags that don't match anything.
+
+    html5lib closes tags itself, so it isn't included.
+    """
+    print "Malformed document benchmark on Beautiful Soup %s" % __version__
+    deep = ("<html>" + "<div><span>text " * (num_elements // 20)
+            + "</p></b>more text " * (num_elements // 4) + "</html>")
+    for description, data in (
+        ("a large invalid HTML document", rdoc(num_elements)),
+        ("a deep document with stray end tags", deep)):
+        print "Generated %s (%d bytes)." % (description, len(data))
+        for parser in ["html.parser", "lxml"]:
+            if builder_registry.lookup(parser) is None:
+                continue
+            try:
+                a = time.time()
+                for i in range(times):
+                    soup = BeautifulSoup(data, parser)
+                b = time.time()
+            except Exception, e:
+                print "%s could not parse the markup: %s" % (parser, e)
+                continue
+            print "BS4+%s parsed it in %.3fs." % (parser, (b-a)/times)
+
+def benchmark_import(times=10):
+    """Time how long it takes a new Python process to import bs4."""
+    print "Import benchmark on Beautiful Soup %s" % __version__
+    import subprocess
+    import sys
+    for code in ("pass", "import bs4",
+                 "import bs4; bs4.BeautifulSoup('', 'html.parser')",
+                 "import bs4; bs4.BeautifulSoup('')"):
+        best = None
+        for i in range(times):
+            a = time.time()
+            subprocess.check_call([sys.executable, "-c", code])
+            elapsed = time.time() - a
+            if best is None or elapsed < best:
+                best = elapsed
+        print "python -c %r: %.1fms" % (code, best * 1000)
+
 def benchmark_parsers(num_elements=100000):
     """Very basic head-to-head performance benchmark."""
     print "Comparative parser benchmark on Beautiful Soup %s" % __version__
@@ -186,6 +246,433 @@ def benchmark_parsers(num_elements=100000):
     b = time.time()
     print "Raw html5lib parsed the markup in %.2fs." % (b-a)
 
+def whitespace_doc(num_elements=1000):
+    """Generate an indented HTML document, in which most of the
+    strings are whitespace, like the HTML served for a wiki page."""
+    items = []
+    for i in range(num_elements):
+        items.append(
+            '\n      <li>\n        <a class="internal present" href="#">'
+            '%s</a>\n      </li>' % rsentence(random.randint(1,4)))
+    return ("<html>\n  <body>\n    <ul>%s\n    </ul>\n  </body>\n</html>"
+            % "".join(items))
+
+def benchmark_whitespace(num_elements=100000):
+    """Time how long it takes to parse a whitespace-heavy document."""
+    print "Whitespace benchmark on Beautiful Soup %s" % __version__
+    data = whitespace_doc(num_elements)
+    print "Generated an indented HTML document (%d bytes)." % len(data)
+    for parser in ["lxml", "html5lib", "html.parser"]:
+        try:
+            a = time.time()
+            soup = BeautifulSoup(data, parser)
+            b = time.time()
+        except Exception, e:
+            print "%s could not parse the markup." % parser
+            traceback.print_exc()
+        else:
+            print "BS4+%s parsed the markup in %.2fs." % (parser, b-a)
+
+def benchmark_serialization(num_elements=100000, parser="html.parser",
+                            times=5):
+    """Time how long it takes to serialize a large document."""
+    print "Serialization benchmark on Beautiful Soup %s" % __version__
+    for description, data in (
+        ("a large invalid HTML document", rdoc(num_elements)),
+        ("a document full of entities", entity_doc(num_elements))):
+        soup = BeautifulSoup(data, parser)
+        print "Generated %s (%d bytes)." % (description, len(data))
+
+        for formatter in ["minimal", "html", None]:
+            a = time.time()
+            for i in range(times):
+                soup.decode(formatter=formatter)
+            b = time.time()
+            print "Serialized the document %d times with formatter=%r in %.2fs." % (
+                times, formatter, b-a)
+
+def tree_size(soup):
+    """Estimate how many bytes a parsed tree takes up in memory.
+
+    Counts every element, plus the dictionaries and lists it refers
+    to directly (its attributes, contents, and __dict__). Objects
+    shared between elements are counted once.
+    """
+    seen = set()
+    size = 0
+    for element in itertools.chain([soup], soup.descendants):
+        size += sys.getsizeof(element)
+        for referent in gc.get_referents(element):
+            if (isinstance(referent, (dict, list))
+                and id(referent) not in seen):
+                seen.add(id(referent))
+                size += sys.getsizeof(referent)
+    return size
+
+def benchmark_memory(num_elements=100000, parser="html.parser"):
+    """Compare the size of a tree in normal and compact mode."""
+    print "Memory benchmark on Beautiful Soup %s" % __version__
+    data = rdoc(num_elements)
+    print "Generated a large invalid HTML document (%d bytes)." % len(data)
+    for compact in (False, True):
+        soup = BeautifulSoup(data, parser, compact=compact)
+        elements = len(list(soup.descendants))
+        size = tree_size(soup)
+        print "compact=%s: %d elements take up about %d bytes (%d per element)." % (
+            compact, elements, size, size / elements)
+
+def link_doc(num_elements=1000):
+    """Generate a document full of links, some of them interesting."""
+    elements = []
+    for i in range(num_elements):
+        elements.append(
+            '<div><a class="internal present" href="/%d">%d</a> '
+            '<a href="http://example.com/">external</a></div>' % (i, i))
+    return "<html><body>" + "\n".join(elements) + "</body></html>"
+
+def live_tags():
+    """Count the Tag objects that haven't been garbage collected."""
+    gc.collect()
+    return len([o for o in gc.get_objects() if isinstance(o, Tag)])
+
+def benchmark_iterparse(num_elements=100000, parser="lxml"):
+    """Compare find_all() on a whole tree with BeautifulSoup.iterparse()."""
+    print "iterparse benchmark on Beautiful Soup %s" % __version__
+    data = link_doc(num_elements)
+    print "Generated a document with %d links (%d bytes)." % (
+        num_elements * 2, len(data))
+    strainer = SoupStrainer("a", class_="internal present")
+
+    a = time.time()
+    soup = BeautifulSoup(BytesIO(data), parser)
+    found = len(soup.find_all(strainer))
+    b = time.time()
+    print "Parsed the whole tree and found %d links in %.2fs, with %d tags in memory." % (
+        found, b-a, live_tags())
+    del soup
+
+    most_tags = 0
+    found = 0
+    counting = 0
+    a = time.time()
+    for link in BeautifulSoup.iterparse(BytesIO(data), strainer, parser):
+        found += 1
+        link.decompose()
+        if found % (num_elements // 10 or 1) == 0:
+            c = time.time()
+            most_tags = max(most_tags, live_tags())
+            counting += time.time() - c
+    b = time.time()
+    print "iterparse() found %d links in %.2fs, with at most %d tags in memory." % (
+        found, b-a-counting, most_tags)
+
+def benchmark_html5lib_strings(num_elements=100000):
+    """Time html5lib on a document made of many adjacent strings.
+
+    html5lib drops the stray end tags in "a</a>a</a>..." and passes in
+    the text one piece at a time. The pieces should be combined in
+    linear time.
+    """
+    print "html5lib string benchmark on Beautiful Soup %s" % __version__
+    for n in (num_elements // 4, num_elements // 2, num_elements):
+        data = "a</a>" * n
+        a = time.time()
+        soup = BeautifulSoup(data, "html5lib")
+        b = time.time()
+        print "%d pieces of text combined into a %d-character string in %.2fs." % (
+            n, len(soup.body.string), b-a)
+
+def benchmark_encoding_detection(num_elements=10000, times=3):
+    """Time UnicodeDammit on large documents with no declared encoding."""
+    print "Encoding detection benchmark on Beautiful Soup %s" % __version__
+    from bs4.dammit import UnicodeDammit, chardet_dammit
+    if chardet_dammit(b"a") is None:
+        print "Note: no chardet library is installed."
+    text = rdoc(num_elements).decode("ascii").replace(
+        u"<p>", u"<p>Sacr\N{LATIN SMALL LETTER E WITH ACUTE} bleu! ")
+    for encoding in ("ascii", "utf-8", "windows-1252"):
+        data = text.encode(encoding, "ignore")
+        a = time.time()
+        for i in range(times):
+            dammit = UnicodeDammit(data)
+        b = time.time()
+        print "%s (%d bytes): detected %s in %.3fs." % (
+            encoding, len(data), dammit.original_encoding, (b-a)/times)
+
+    # A Windows-1252 document that claims to be UTF-8, decoded with
+    # smart quotes turned into entities.
+    data = text.replace(
+        u"Sacr", u"\N{LEFT DOUBLE QUOTATION MARK}Sacr").encode("windows-1252")
+    for smart_quotes_to in (None, "html"):
+        a = time.time()
+        for i in range(times):
+            dammit = UnicodeDammit(
+                data, ["utf-8"], smart_quotes_to=smart_quotes_to)
+        b = time.time()
+        print "mislabelled windows-1252 (%d bytes), smart_quotes_to=%r: decoded as %s in %.3fs." % (
+            len(data), smart_quotes_to, dammit.original_encoding, (b-a)/times)
+
+def detwingle_bytewise(in_bytes):
+    """The original byte-at-a-time implementation of
+    UnicodeDammit.detwingle(), kept for comparison."""
+    from bs4.dammit import UnicodeDammit
+    byte_chunks = []
+    chunk_start = 0
+    pos = 0
+    while pos < len(in_bytes):
+        byte = ord(in_bytes[pos])
+        if (byte >= UnicodeDammit.FIRST_MULTIBYTE_MARKER
+            and byte <= UnicodeDammit.LAST_MULTIBYTE_MARKER):
+            for start, end, size in UnicodeDammit.MULTIBYTE_MARKERS_AND_SIZES:
+                if byte >= start and byte <= end:
+                    pos += size
+                    break
+        elif byte >= 0x80 and byte in UnicodeDammit.WINDOWS_1252_TO_UTF8:
+            byte_chunks.append(in_bytes[chunk_start:pos])
+            byte_chunks.append(UnicodeDammit.WINDOWS_1252_TO_UTF8[byte])
+            pos += 1
+            chunk_start = pos
+        else:
+            pos += 1
+    if chunk_start == 0:
+        return in_bytes
+    byte_chunks.append(in_bytes[chunk_start:])
+    return b''.join(byte_chunks)
+
+def benchmark_detwingle(num_elements=10000, times=3):
+    """Compare UnicodeDammit.detwingle() with detwingle_bytewise()."""
+    print "detwingle benchmark on Beautiful Soup %s" % __version__
+    from bs4.dammit import UnicodeDammit
+    text = rdoc(num_elements).decode("ascii")
+    utf8 = text.replace(
+        u"<p>", u"<p>\N{SNOWMAN}\N{SNOWMAN} Sacr\N{LATIN SMALL LETTER E WITH ACUTE} bleu! ").encode("utf8")
+    mixed = utf8.replace(b"<b>", u"<b>\N{LEFT DOUBLE QUOTATION MARK}".encode("windows-1252"))
+    for name, data in (("ASCII", text.encode("ascii")), ("UTF-8", utf8),
+                       ("UTF-8 and Windows-1252", mixed)):
+        print "%s (%d bytes):" % (name, len(data))
+        for function in (detwingle_bytewise, UnicodeDammit.detwingle):
+            a = time.time()
+            for i in range(times):
+                result = function(data)
+            b = time.time()
+            print " %s: %.4fs" % (function.__name__, (b-a)/times)
+        assert result == detwingle_bytewise(data)
+
+def benchmark_snapshot(num_elements=100000, parser="lxml"):
+    """Compare reparsing and pickling a document with snapshotting it."""
+    print "Snapshot benchmark on Beautiful Soup %s" % __version__
+    import cPickle
+    from bs4.snapshot import Snapshot
+    data = rdoc(num_elements)
+    a = time.time()
+    soup = BeautifulSoup(data, parser)
+    b = time.time()
+    print "Parsed %d bytes with %s in %.2fs." % (len(data), parser, b-a)
+
+    try:
+        a = time.time()
+        pickled = cPickle.dumps(soup, cPickle.HIGHEST_PROTOCOL)
+        b = time.time()
+        cPickle.loads(pickled)
+        c = time.time()
+        print "Pickle: %d bytes, dumped in %.2fs, loaded in %.2fs." % (
+            len(pickled), b-a, c-b)
+        del pickled
+    except RuntimeError, e:
+        print "Pickle failed: %s" % e
+
+    a = time.time()
+    snapshot = Snapshot.from_soup(soup)
+    b = time.time()
+    loaded = snapshot.to_soup()
+    c = time.time()
+    print "Snapshot: %d bytes, taken in %.2fs, loaded in %.2fs." % (
+        len(snapshot), b-a, c-b)
+    assert loaded.decode() == soup.decode()
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        snapshot.save(filename)
+        a = time.time()
+        mapped = Snapshot.load(filename, mmap=True)
+        mapped.to_soup()
+        b = time.time()
+        mapped.close()
+        print "Memory-mapped snapshot loaded in %.2fs." % (b-a)
+    finally:
+        os.unlink(filename)
+
+def benchmark_pooled(num_documents=5000):
+    """Compare parsing lots of small documents with and without
+    pooled tree builders."""
+    print "Pooled builder benchmark on Beautiful Soup %s" % __version__
+    data = link_doc(5)
+    print "Parsing a %d-byte document %d times." % (len(data), num_documents)
+    for parser in ["lxml", "html5lib", "html.parser"]:
+        if builder_registry.lookup(parser) is None:
+            continue
+        for pooled in (False, True):
+            a = time.time()
+            for i in range(num_documents):
+                BeautifulSoup(data, parser, pooled=pooled)
+            b = time.time()
+            print "%s, pooled=%s: %.1f microseconds per document." % (
+                parser, pooled, (b-a) / num_documents * 1000000)
+
+FIND_ALL_QUERIES = [
+    ("all tags", (True,), {}),
+    ("tag name", ("a",), {}),
+    ("list of names", (["a", "b"],), {}),
+    ("regular expression", (re.compile("^a$"),), {}),
+    ("function", (lambda tag: tag.name == "a",), {}),
+    ("one class", ("a",), dict(class_="internal")),
+    ("two classes", ("a",), dict(class_="internal present")),
+    ("attribute", (), dict(href=re.compile("/1"))),
+    ("string", (), dict(text="external")),
+    ]
+
+def benchmark_find_all(num_elements=10000, times=5):
+    """Time find_all() on a variety of queries."""
+    print "find_all() benchmark on Beautiful Soup %s" % __version__
+    soup = BeautifulSoup(link_doc(num_elements), "html.parser")
+    print "Searching a document with %d links." % num_elements
+    for description, args, kwargs in FIND_ALL_QUERIES:
+        best = None
+        for i in range(times):
+            a = time.time()
+            found = soup.find_all(*args, **kwargs)
+            elapsed = time.time() - a
+            if best is None or elapsed < best:
+                best = elapsed
+        print "%s: found %d in %.1fms." % (description, len(found), best * 1000)
+
+def benchmark_mutation(num_children=10000):
+    """Time removing, replacing and unwrapping the children of a wide
+    tag."""
+    print "Tree mutation benchmark on Beautiful Soup %s" % __version__
+    data = "<div>" + "<span>x</span>" * num_children + "</div>"
+    print "Modifying a tag with %d children." % num_children
+
+    def run(description, mutate):
+        soup = BeautifulSoup(data, "html.parser")
+        spans = soup.div.contents[::2]
+        a = time.time()
+        for span in spans:
+            mutate(soup, span)
+        b = time.time()
+        print "%s %d children in %.2fs." % (description, len(spans), b-a)
+
+    run("Extracted", lambda soup, span: span.extract())
+    run("Replaced", lambda soup, span: span.replace_with(soup.new_tag("b")))
+    run("Unwrapped", lambda soup, span: span.unwrap())
+    run("Inserted a tag after",
+        lambda soup, span: span.insert_after(soup.new_tag("b")))
+
+    soup = BeautifulSoup("<body><div></div><p>after</p></body>", "html.parser")
+    new_tags = [soup.new_tag("span") for i in range(num_children)]
+    a = time.time()
+    for tag in new_tags:
+        soup.div.append(tag)
+    b = time.time()
+    print "Appended %d children one at a time in %.2fs." % (num_children, b-a)
+    for tag in new_tags:
+        tag.extract()
+    a = time.time()
+    soup.div.extend(new_tags)
+    b = time.time()
+    print "Appended %d children with extend() in %.2fs." % (num_children, b-a)
+    a = time.time()
+    soup.div.replace_children(reversed(new_tags))
+    b = time.time()
+    print "Reversed %d children with replace_children() in %.2fs." % (
+        num_children, b-a)
+
+def benchmark_hashing(num_elements=10000, times=3):
+    """Time putting every tag of a document into a set."""
+    print "Tag hashing benchmark on Beautiful Soup %s" % __version__
+    soup = BeautifulSoup(link_doc(num_elements), "html.parser")
+    tags = soup.find_all(True)
+    print "Hashing %d tags from a document with %d links." % (
+        len(tags), num_elements)
+    for i in range(times):
+        a = time.time()
+        unique = set(tags)
+        b = time.time()
+        print "Run %d: found %d unique tags in %.2fs." % (
+            i + 1, len(unique), b-a)
+
+def decompose_attributewise(tag):
+    """The original implementation of Tag.decompose(), which deletes
+    every attribute of every element, kept for comparison."""
+    from bs4.element import _slot_names
+    tag.extract()
+    i = tag
+    while i is not None:
+        next = i.next_element
+        i.__dict__.clear()
+        for name in _slot_names(i.__class__):
+            try:
+                delattr(i, name)
+            except AttributeError:
+                pass
+        i.contents = []
+        i = next
+
+def benchmark_decompose(num_elements=5000, parser="lxml"):
+    """Compare Tag.decompose() with decompose_attributewise(), and
+    with extracting a subtree and leaving it to the garbage collector."""
+    print "decompose benchmark on Beautiful Soup %s" % __version__
+    data = ("<html><body>" + ("<nav>%s</nav>" % link_doc(num_elements)) * 4
+            + "<main><p>Content</p></main></body></html>")
+    print "Removing four large <nav> tags from a %d-byte document." % len(data)
+    for description, remove in (
+        ("decompose_attributewise()", decompose_attributewise),
+        ("extract() and gc.collect()", lambda tag: tag.extract()),
+        ("Tag.decompose()", lambda tag: tag.decompose())):
+        soup = BeautifulSoup(data, parser)
+        gc.collect()
+        a = time.time()
+        for nav in soup.find_all("nav"):
+            remove(nav)
+        gc.collect()
+        b = time.time()
+        print "%s: %.2fs." % (description, b-a)
+
+def benchmark_get_text(num_elements=10000, times=3, parser="lxml"):
+    """Time get_text() and the ways of getting text in pieces."""
+    print "get_text() benchmark on Beautiful Soup %s" % __version__
+    data = link_doc(num_elements).replace(
+        "</div>", "<script>var i = 0;</script></div>")
+    soup = BeautifulSoup(data, parser)
+    print "Getting the text of a document with %d links and %d scripts." % (
+        num_elements * 2, num_elements)
+    for description, get in (
+        ("get_text()", lambda: soup.get_text()),
+        ("get_text(strip=True)", lambda: soup.get_text(u" ", strip=True)),
+        ("get_text(skip=['script'])",
+         lambda: soup.get_text(skip=['script'])),
+        ("strings", lambda: list(soup.strings)),
+        ("write_text()", lambda: soup.write_text(StringIO(), encoding=None)),
+        ):
+        best = min(timeit.repeat(get, number=1, repeat=times))
+        print "%s: %.1fms." % (description, best * 1000)
+
+def benchmark_navigation(num_elements=1000, times=10000):
+    """Time navigating a tree with attribute access, like soup.body.div.a."""
+    print "Navigation benchmark on Beautiful Soup %s" % __version__
+    soup = BeautifulSoup(link_doc(num_elements), "html.parser")
+    # A miss has to look at the whole document, so it's timed fewer
+    # times.
+    for description, navigate, number in (
+        ("soup.body.div.a", lambda: soup.body.div.a, times),
+        ("soup.a", lambda: soup.a, times),
+        ("soup.nosuchtag", lambda: soup.nosuchtag, max(times // 100, 1)),
+        ("soup.find('a')", lambda: soup.find('a'), times),
+        ):
+        best = min(timeit.repeat(navigate, number=number, repeat=3))
+        print "%s: %.1f microseconds." % (description, best / number * 1000000)
+
 def profile(num_elements=100000, parser="lxml"):
 
     filehandle = tempfile.NamedTemporaryFile()
@@ -1,3 +1,5 @@
+from bisect import bisect_left
+import codecs
 import collections
 import re
 import sys
@@ -5,6 +7,7 @@ import warnings
 from bs4.dammit import EntitySubstitution
 
 DEFAULT_OUTPUT_ENCODING = "utf-8"
+DEFAULT_WRITE_BUFFER_SIZE = 64 * 1024
 PY3K = (sys.version_info[0] > 2)
 
 whitespace_re = re.compile("\s+")
@@ -21,6 +24,55 @@ def _alias(attr):
     return alias
 
 
+def _slot_names(cls, _cache={}):
+    """List the names of all the __slots__ defined by a class and its
+    superclasses."""
+    names = _cache.get(cls)
+    if names is None:
+        names = []
+        for klass in cls.__mro__:
+            for name in klass.__dict__.get('__slots__', ()):
+                if name not in names:
+                    names.append(name)
+        _cache[cls] = names
+    return names
+
+
+class _EmptyAttributes(dict):
+    """The attribute dictionary shared by all attribute-less tags in a
+    compact tree. It can't be modified in place; tag[key] = value
+    gives the tag a dictionary of its own."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(
+            "This tag's attribute dictionary is shared. "
+            "Use tag[key] = value to set an attribute.")
+    __setitem__ = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return 'EMPTY_ATTRIBUTES'
+
+EMPTY_ATTRIBUTES = _EmptyAttributes()
+
+
+class _EmptyContents(list):
+    """The contents list shared by all empty tags in a compact
+    tree. It can't be modified in place; tag.append() and
+    tag.insert() give the tag a list of its own."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(
+            "This tag's contents list is shared. "
+            "Use tag.append() or tag.insert() to add a child.")
+    (append, extend, insert, __setitem__, __setslice__,
+     __iadd__) = (_immutable,) * 6
+
+    def __reduce__(self):
+        return 'EMPTY_CONTENTS'
+
+EMPTY_CONTENTS = _EmptyContents()
+
+
 class NamespacedAttribute(unicode):
 
     def __new__(cls, prefix, name, namespace=None):
@@ -116,6 +168,110 @@ class HTMLAwareEntitySubstitution(EntitySubstitution):
         return cls._substitute_if_appropriate(
             ns, EntitySubstitution.substitute_xml)
 
+class Formatter(object):
+    """A precompiled version of one of the named formatters.
+
+    Calling a Formatter on a string does the same thing as calling the
+    corresponding EntitySubstitution method. Those methods return a
+    string with nothing to substitute as-is, so the Formatter doesn't
+    check for that itself.
+
+    If `cdata_containing_tags` is given, strings that are the direct
+    children of those tags are left alone, as with
+    HTMLAwareEntitySubstitution.
+    """
+
+    def __init__(self, name, substitute=None, cdata_containing_tags=()):
+        self.name = name
+        self.substitute = substitute
+        self.cdata_containing_tags = frozenset(cdata_containing_tags)
+
+    def __call__(self, s):
+        if (self.cdata_containing_tags
+            and isinstance(s, NavigableString)
+            and s.parent is not None
+            and s.parent.name in self.cdata_containing_tags):
+            return s
+        return self.substitute_string(s)
+
+    def substitute_string(self, s):
+        """Substitute entities in a string, without looking at its parent."""
+        if self.substitute is None:
+            return s
+        return self.substitute(s)
+
+    def string_substitution_for(self, tag):
+        """Find the function to run on the strings directly inside `tag`.
+
+        :return: None if the strings should be left alone.
+        """
+        if tag.name in self.cdata_containing_tags:
+            return None
+        if self.substitute is None:
+            return None
+        return self.substitute_string
+
+
+class SerializationBuffer(object):
+    """Collects the Unicode pieces of a tree as it's being serialized.
+
+    With no file object, the pieces are kept until getvalue() is
+    called. With a file object, the pieces are encoded and written out
+    whenever more than `buffer_size` characters have piled up, so
+    memory use stays bounded no matter how big the tree is.
+    """
+
+    def __init__(self, fileobj=None, encoding=None,
+                 errors="xmlcharrefreplace", buffer_size=None):
+        self.fileobj = fileobj
+        self.encoding = encoding
+        self.errors = errors
+        if fileobj is not None and encoding is not None:
+            # The output is encoded a piece at a time. An incremental
+            # encoder keeps the state of encodings like UTF-16, which
+            # would otherwise start every piece with a byte-order mark.
+            self.encoder = codecs.getincrementalencoder(encoding)(errors)
+        else:
+            self.encoder = None
+        self.buffer_size = buffer_size or DEFAULT_WRITE_BUFFER_SIZE
+        self.pieces = []
+        self.size = 0
+        # The number of non-empty pieces ever appended, and the most
+        # recent one. Pretty-printing needs to know whether a tag's
+        # contents were empty and whether they ended with a newline.
+        self.count = 0
+        self.last = u''
+
+    def append(self, s):
+        if not s:
+            return
+        self.pieces.append(s)
+        self.count += 1
+        self.last = s
+        if self.fileobj is not None:
+            self.size += len(s)
+            if self.size >= self.buffer_size:
+                self.flush()
+
+    def getvalue(self):
+        return ''.join(self.pieces)
+
+    def flush(self, final=False):
+        """Write all the collected pieces to the file object.
+
+        :param final: Set this when nothing more will be appended, so
+            the encoder can write out anything it's holding on to.
+        """
+        if self.fileobj is None:
+            return
+        data = ''.join(self.pieces)
+        if self.encoder is not None:
+            data = self.encoder.encode(data, final)
+        if data:
+            self.fileobj.write(data)
+        self.pieces = []
+        self.size = 0
+
 class PageElement(object):
     """Contains the navigational information for some part of the page
     (either a tag or a piece of text)"""
@@ -139,15 +295,19 @@ class PageElement(object):
     # an XML document, all tags will be given the same treatment.
 
     HTML_FORMATTERS = {
-        "html" : HTMLAwareEntitySubstitution.substitute_html,
-        "minimal" : HTMLAwareEntitySubstitution.substitute_xml,
-        None : None
+        "html" : Formatter(
+            "html", EntitySubstitution.substitute_html,
+            HTMLAwareEntitySubstitution.cdata_containing_tags),
+        "minimal" : Formatter(
+            "minimal", EntitySubstitution.substitute_xml,
+            HTMLAwareEntitySubstitution.cdata_containing_tags),
+        None : Formatter(None),
         }
 
     XML_FORMATTERS = {
-        "html" : EntitySubstitution.substitute_html,
-        "minimal" : EntitySubstitution.substitute_xml,
-        None : None
+        "html" : Formatter("html", EntitySubstitution.substitute_html),
+        "minimal" : Formatter("minimal", EntitySubstitution.substitute_xml),
+        None : Formatter(None),
         }
 
     def format_string(self, s, formatter='minimal'):
@@ -180,10 +340,31 @@ class PageElement(object):
         "Look up a formatter function based on its name and the tree."
         if self._is_xml:
             return self.XML_FORMATTERS.get(
-                name, EntitySubstitution.substitute_xml)
+                name, self.XML_FORMATTERS["minimal"])
         else:
             return self.HTML_FORMATTERS.get(
-                name, HTMLAwareEntitySubstitution.substitute_xml)
+                name, self.HTML_FORMATTERS["minimal"])
+
+    def __getstate__(self):
+        # Tag and NavigableString keep their navigation attributes
+        # in __slots__, which need to be pickled explicitly.
+        state = dict(self.__dict__)
+        # A tag's index of its children is keyed by object ID, so
+        # it's no good in a copy.
+        state.pop('_child_positions', None)
+        for name in _slot_names(self.__class__):
+            try:
+                state[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        if '_hash' in state:
+            # String hashes may be different in another process.
+            state['_hash'] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def setup(self, parent=None, previous_element=None):
         """Sets up the initial relations between this element and
@@ -231,8 +412,13 @@ class PageElement(object):
 
     def extract(self):
         """Destructively rips this element out of the tree."""
-        if self.parent is not None:
-            del self.parent.contents[self.parent.index(self)]
+        parent = self.parent
+        if parent is not None:
+            index = parent.index(self)
+            del parent.contents[index]
+            if parent._child_positions is not None:
+                parent._child_positions.removed(index, self)
+            parent._reset_hash()
 
         #Find the two elements that would be next to each other if
         #this element (and any children) hadn't been parsed. Connect
@@ -255,6 +441,24 @@ class PageElement(object):
         self.previous_sibling = self.next_sibling = None
         return self
 
+    def _destroy(self):
+        """Break all the links between this extracted element and the
+        elements inside it.
+
+        Without the links there are no reference cycles, so each
+        element is freed as soon as nothing else refers to it, instead
+        of waiting for the garbage collector to find it.
+        """
+        element = self
+        while element is not None:
+            next_element = element.next_element
+            element.parent = element.next_element = None
+            element.previous_element = None
+            element.next_sibling = element.previous_sibling = None
+            if isinstance(element, Tag):
+                element.contents = []
+            element = next_element
+
     def _last_descendant(self, is_initialized=True):
         "Finds the last element beneath this object to be parsed."
         if is_initialized and self.next_sibling:
@@ -269,6 +473,8 @@ class PageElement(object):
     def insert(self, position, new_child):
         if new_child is self:
             raise ValueError("Cannot insert a tag into itself.")
+        if self.contents is EMPTY_CONTENTS:
+            self.contents = []
         if (isinstance(new_child, basestring)
             and not isinstance(new_child, NavigableString)):
             new_child = NavigableString(new_child)
@@ -328,7 +534,12 @@ class PageElement(object):
 
         if new_childs_last_element.next_element is not None:
             new_childs_last_element.next_element.previous_element = new_childs_last_element
+        if (self._child_positions is not None
+            and not self._child_positions.inserted(
+                self.contents, position, new_child)):
+            self._child_positions = None
         self.contents.insert(position, new_child)
+        self._reset_hash()
 
     def append(self, tag):
         """Appends the given tag to the contents of this tag."""
@@ -485,20 +696,19 @@ class PageElement(object):
             if name is True or name is None:
                 result = (element for element in generator
                           if isinstance(element, Tag))
-                ResultSet(strainer, result)
+                return ResultSet(strainer, result)
             # Optimization to find all tags with a given name.
-            elif isinstance(name, basestring):
+            elif isinstance(name, basestring) and name:
+                name = strainer.name
                 result = (element for element in generator
                           if isinstance(element, Tag)
-                            and element.name == name)
+                            and element._name == name)
+                return ResultSet(strainer, result)
         results = ResultSet(strainer)
-        while True:
-            try:
-                i = next(generator)
-            except StopIteration:
-                break
+        search = strainer.search
+        for i in generator:
             if i:
-                found = strainer.search(i)
+                found = search(i)
                 if found:
                     results.append(found)
                     if limit and len(results) >= limit:
@@ -638,6 +848,9 @@ class PageElement(object):
 
 class NavigableString(unicode, PageElement):
 
+    __slots__ = ('parent', 'next_element', 'previous_element',
+                 'next_sibling', 'previous_sibling')
+
     PREFIX = ''
     SUFFIX = ''
 
@@ -734,10 +947,103 @@ class Doctype(PreformattedString):
     SUFFIX = u'>\n'
 
 
+def _hash_attributes(attrs):
+    """Hash a tag's attributes, whatever order they're in."""
+    try:
+        return hash(frozenset(
+            (key, tuple(value) if isinstance(value, list) else value)
+            for key, value in attrs.items()))
+    except TypeError:
+        # Some attribute value can't be hashed. Equal attribute
+        # dictionaries still have the same keys.
+        return hash(frozenset(attrs))
+
+
+class _ChildPositions(object):
+    """An index of where a wide tag's children are in its contents
+    list, so that Tag.index() doesn't have to scan the list.
+
+    Each child gets a sort key, and `keys` holds the children's keys
+    in the same order as the contents list, so finding a child is a
+    dictionary lookup and a binary search. A child inserted between
+    two others gets a key between theirs, so no other keys change.
+
+    Code is allowed to change a contents list directly, so every
+    position found here is checked against the list itself, and a
+    position that doesn't check out means the index has to be rebuilt.
+    """
+
+    __slots__ = ('keys', 'key_for_id')
+
+    def __init__(self, contents):
+        self.keys = range(len(contents))
+        self.key_for_id = dict(zip(map(id, contents), self.keys))
+
+    def find(self, contents, child):
+        """Find a child's position, or return None if the index
+        doesn't know."""
+        key = self.key_for_id.get(id(child))
+        if key is None:
+            return None
+        keys = self.keys
+        i = bisect_left(keys, key)
+        if (i < len(keys) and i < len(contents) and keys[i] == key
+            and contents[i] is child):
+            return i
+        return None
+
+    def removed(self, position, child):
+        """Record that the child at `position` was removed."""
+        del self.keys[position]
+        del self.key_for_id[id(child)]
+
+    def inserted(self, contents, position, child):
+        """Record that a child is about to be inserted at `position`.
+
+        :return: False if the index can't be kept up to date, and
+            needs to be thrown away.
+        """
+        keys = self.keys
+        key_for_id = self.key_for_id
+        if position > len(keys):
+            return False
+        if position > 0:
+            before = keys[position - 1]
+            if key_for_id.get(id(contents[position - 1])) != before:
+                return False
+        if position < len(keys):
+            after = keys[position]
+            if key_for_id.get(id(contents[position])) != after:
+                return False
+
+        if not keys:
+            key = 0
+        elif position == 0:
+            key = after - 1
+        elif position == len(keys):
+            key = before + 1
+        else:
+            key = (before + after) / 2.0
+            if not before < key < after:
+                # Too many children have gone into this gap.
+                return False
+        keys.insert(position, key)
+        key_for_id[id(child)] = key
+        return True
+
+
 class Tag(PageElement):
 
     """Represents a found HTML tag with its attributes and contents."""
 
+    # Keeping these in slots instead of a per-instance dictionary
+    # makes a big difference to the size of a large tree. Other
+    # attributes can still be set on a Tag; they go into its __dict__.
+    __slots__ = ('parent', 'next_element', 'previous_element',
+                 'next_sibling', 'previous_sibling', 'parser_class',
+                 '_name', 'namespace', 'prefix', 'attrs', 'contents',
+                 'hidden', 'can_be_empty_element', '_hash')
+
     def __init__(self, parser=None, builder=None, name=None, namespace=None,
                  prefix=None, attrs=None, parent=None, previous=None):
         "Basic constructor."
@@ -750,17 +1056,21 @@ class Tag(PageElement):
             self.parser_class = parser.__class__
         if name is None:
             raise ValueError("No value provided for new tag's name.")
-        self.name = name
+        self._name = name
         self.namespace = namespace
         self.prefix = prefix
         if attrs is None:
             attrs = {}
+        elif attrs is EMPTY_ATTRIBUTES:
+            # This is a compact tree, and the tag has no attributes.
+            pass
         elif attrs and builder.cdata_list_attributes:
             attrs = builder._replace_cdata_list_attribute_values(
-                self.name, attrs)
+                name, attrs)
         else:
             attrs = dict(attrs)
         self.attrs = attrs
+        self._hash = None
         self.contents = []
         self.setup(parent, previous)
         self.hidden = False
@@ -772,6 +1082,12 @@ class Tag(PageElement):
         else:
             self.can_be_empty_element = False
 
+    # Wide tags keep an index of their children's positions. It
+    # goes in __dict__ rather than a slot since most tags never need
+    # one.
+    _child_positions = None
+    INDEXED_CHILDREN_THRESHOLD = 16
+
     parserClass = _alias("parser_class")  # BS3
 
     @property
@@ -814,23 +1130,40 @@ class Tag(PageElement):
         self.clear()
         self.append(string.__class__(string))
 
-    def _all_strings(self, strip=False, types=(NavigableString, CData)):
+    def _all_strings(self, strip=False, types=(NavigableString, CData),
+                     skip=None):
         """Yield all strings of certain classes, possibly stripping them.
 
         By default, yields only NavigableString and CData objects. So
         no comments, processing instructions, etc.
+
+        :param skip: The name of a tag, or a list of names, whose
+            strings should be left out, such as ['script', 'style'].
         """
-        for descendant in self.descendants:
-            if (
-                (types is None and not isinstance(descendant, NavigableString))
-                or
-                (types is not None and type(descendant) not in types)):
+        if not self.contents:
+            return
+        if isinstance(skip, basestring):
+            skip = [skip]
+        if skip is not None:
+            skip = frozenset(skip)
+        stop = self._last_descendant().next_element
+        descendant = self.contents[0]
+        while descendant is not stop:
+            # A failed isinstance() check is slow, so look at the
+            # type first.
+            if (type(descendant) in types if types is not None
+                else isinstance(descendant, NavigableString)):
+                if strip:
+                    stripped = descendant.strip()
+                    if stripped:
+                        yield stripped
+                else:
+                    yield descendant
+            elif skip is not None and descendant.name in skip:
+                # Strings have no name, so this must be a tag.
+                descendant = descendant._last_descendant().next_element
                 continue
-            if strip:
-                descendant = descendant.strip()
-                if len(descendant) == 0:
-                    continue
-            yield descendant
+            descendant = descendant.next_element
 
     strings = property(_all_strings)
 
@@ -840,47 +1173,171 @@ class Tag(PageElement):
             yield string
 
     def get_text(self, separator=u"", strip=False,
-                 types=(NavigableString, CData)):
+                 types=(NavigableString, CData), skip=None):
         """
         Get all child strings, concatenated using the given separator.
+
+        :param skip: The name of a tag, or a list of names, whose
+            strings should be left out, such as ['script', 'style'].
         """
-        return separator.join([s for s in self._all_strings(
-                    strip, types=types)])
+        return separator.join(self._all_strings(strip, types, skip))
+
     getText = get_text
     text = property(get_text)
 
+    def write_text(self, fileobj, separator=u"", strip=False,
+                   types=(NavigableString, CData), skip=None,
+                   encoding=DEFAULT_OUTPUT_ENCODING, buffer_size=None):
+        """Writes the text of this tag to a file-like object.
+
+        The output is the same as that of get_text(), but it's written
+        out a piece at a time, so the text of a huge document never
+        has to exist in memory as a single string.
+
+        :param encoding: The encoding to use. If this is None, Unicode
+           strings are written to `fileobj`.
+        :param buffer_size: Roughly how many characters to collect
+           before writing them out.
+        """
+        buffer = SerializationBuffer(fileobj, encoding, "strict", buffer_size)
+        strings = self._all_strings(strip, types, skip)
+        for string in strings:
+            buffer.append(string)
+            break
+        if separator:
+            for string in strings:
+                buffer.append(separator)
+                buffer.append(string)
+        else:
+            for string in strings:
+                buffer.append(string)
+        buffer.flush(final=True)
+
     def decompose(self):
         """Recursively destroys the contents of this tree."""
         self.extract()
-        i = self
-        while i is not None:
-            next = i.next_element
-            i.__dict__.clear()
-            i.contents = []
-            i = next
+        self._destroy()
 
     def clear(self, decompose=False):
         """
         Extract all children. If decompose is True, decompose instead.
         """
+        children = self.contents[:]
+        self._remove_children()
         if decompose:
-            for element in self.contents[:]:
-                if isinstance(element, Tag):
-                    element.decompose()
-                else:
-                    element.extract()
+            for element in children:
+                element._destroy()
+
+    def extend(self, new_children):
+        """Appends the given elements to the contents of this tag.
+
+        This has the same result as calling append() on each one, but
+        the elements are threaded into the tree all at once.
+        """
+        children = []
+        for child in new_children:
+            if child is self:
+                raise ValueError("Cannot insert a tag into itself.")
+            if (isinstance(child, basestring)
+                and not isinstance(child, NavigableString)):
+                child = NavigableString(child)
+            children.append(child)
+        if not children:
+            return
+        if len(set(map(id, children))) < len(children):
+            # An element that's in the list twice has to end up in the
+            # last of its positions. Let append() sort that out.
+            for child in children:
+                self.append(child)
+            return
+        for child in children:
+            if getattr(child, 'parent', None) is not None:
+                child.extract()
+        if self.contents is EMPTY_CONTENTS:
+            self.contents = []
+
+        # Find the elements that will come before and after the new
+        # children.
+        if self.contents:
+            previous_sibling = self.contents[-1]
+            previous_element = previous_sibling._last_descendant(False)
         else:
-            for element in self.contents[:]:
-                element.extract()
+            previous_sibling = None
+            previous_element = self
+        next_element = None
+        parent = self
+        while parent is not None:
+            if parent.next_sibling is not None:
+                next_element = parent.next_sibling
+                break
+            parent = parent.parent
+
+        for child in children:
+            child.parent = self
+            child.previous_sibling = previous_sibling
+            if previous_sibling is not None:
+                previous_sibling.next_sibling = child
+            child.previous_element = previous_element
+            previous_element.next_element = child
+            previous_sibling = child
+            previous_element = child._last_descendant(False)
+        previous_sibling.next_sibling = None
+        previous_element.next_element = next_element
+        if next_element is not None:
+            next_element.previous_element = previous_element
+        self.contents.extend(children)
+        self._reset_hash()
+
+    def replace_children(self, new_children):
+        """Replaces the contents of this tag with the given elements.
+
+        This has the same result as extracting every child and then
+        appending each new element, but it's done all at once.
+        """
+        new_children = list(new_children)
+        self._remove_children()
+        self.extend(new_children)
+
+    def _remove_children(self):
+        """Extract all of this tag's children at once."""
+        contents = self.contents
+        if not contents:
+            return
+        next_element = self._last_descendant(False).next_element
+        self.next_element = next_element
+        if next_element is not None:
+            next_element.previous_element = self
+        for child in contents:
+            child._last_descendant(False).next_element = None
+            child.parent = child.previous_element = None
+            child.previous_sibling = child.next_sibling = None
+        del contents[:]
+        if self._child_positions is not None:
+            self._child_positions = None
+        self._reset_hash()
 
     def index(self, element):
         """
         Find the index of a child by identity, not value. Avoids issues with
         tag.contents.index(element) getting the index of equal elements.
         """
-        for i, child in enumerate(self.contents):
-            if child is element:
+        contents = self.contents
+        positions = self._child_positions
+        if positions is not None:
+            i = positions.find(contents, element)
+            if i is not None:
+                return i
+        if len(contents) > self.INDEXED_CHILDREN_THRESHOLD:
+            self._child_positions = positions = _ChildPositions(contents)
+            i = positions.find(contents, element)
+            if i is not None:
                 return i
+        else:
+            if positions is not None:
+                self._child_positions = None
+            for i, child in enumerate(contents):
+                if child is element:
+                    return i
         raise ValueError("Tag.index: element not in tag")
 
     def get(self, key, default=None):
@@ -892,8 +1349,50 @@ class Tag(PageElement):
     def has_attr(self, key):
         return key in self.attrs
 
+    def _get_name(self):
+        return self._name
+
+    def _set_name(self, name):
+        self._name = name
+        self._reset_hash()
+    name = property(_get_name, _set_name)
+
     def __hash__(self):
-        return str(self).__hash__()
+        """A tag's hash covers its name, its attributes and the hashes
+        of its children, so equal tags have equal hashes.
+
+        The hash is cached. Renaming a tag, or changing the tree with
+        tag[key] = value, del tag[key], insert(), extract() or any of
+        the methods built on them, resets the cached hashes of the tag
+        and its parents. Changing attrs or contents directly doesn't,
+        so don't do that to a tag that's been used as a dictionary
+        key. (Comparing tags with == never relies on the cached hash.)
+        """
+        if self._hash is None:
+            # Hash the tags underneath this one first, without
+            # recursion, so a deep tree can't hit the recursion limit.
+            stack = [self]
+            while stack:
+                tag = stack[-1]
+                unhashed = [child for child in tag.contents
+                            if isinstance(child, Tag) and child._hash is None]
+                if unhashed:
+                    stack.extend(unhashed)
+                    continue
+                stack.pop()
+                tag._hash = hash((
+                    tag._name, _hash_attributes(tag.attrs),
+                    tuple([hash(child) for child in tag.contents])))
+        return self._hash
+
+    def _reset_hash(self):
+        """Forget the cached hash of this tag and its parents."""
+        # A tag's hash is only cached if its children's hashes are,
+        # so we can stop at the first tag without a cached hash.
+        tag = self
+        while tag is not None and tag._hash is not None:
+            tag._hash = None
+            tag = tag.parent
 
     def __getitem__(self, key):
         """tag[key] returns the value of the 'key' attribute for the tag,
@@ -918,11 +1417,15 @@ class Tag(PageElement):
     def __setitem__(self, key, value):
         """Setting tag[key] sets the value of the 'key' attribute for the
         tag."""
+        if self.attrs is EMPTY_ATTRIBUTES:
+            self.attrs = {}
         self.attrs[key] = value
+        self._reset_hash()
 
     def __delitem__(self, key):
         "Deleting tag[key] deletes all 'key' attributes for the tag."
         self.attrs.pop(key, None)
+        self._reset_hash()
 
     def __call__(self, *args, **kwargs):
         """Calling a tag like a function is the same as calling its
@@ -941,10 +1444,24 @@ class Tag(PageElement):
             return self.find(tag_name)
         # We special case contents to avoid recursion.
         elif not tag.startswith("__") and not tag=="contents":
-            return self.find(tag)
+            return self._find_descendant_by_name(tag)
         raise AttributeError(
             "'%s' object has no attribute '%s'" % (self.__class__, tag))
 
+    def _find_descendant_by_name(self, name):
+        """Does the same thing as find(name), without creating a
+        SoupStrainer or a ResultSet."""
+        if not self.contents:
+            return None
+        stop = self._last_descendant().next_element
+        descendant = self.contents[0]
+        while descendant is not stop:
+            # Strings have a name of None.
+            if descendant.name == name:
+                return descendant
+            descendant = descendant.next_element
+        return None
+
     def __eq__(self, other):
         """Returns true iff this tag has the same name, the same attributes,
         and the same contents (recursively) as the given tag."""
@@ -988,13 +1505,6 @@ class Tag(PageElement):
         u = self.decode(indent_level, encoding, formatter)
         return u.encode(encoding, errors)
 
-    def _should_pretty_print(self, indent_level):
-        """Should this tag be pretty-printed?"""
-        return (
-            indent_level is not None and
-            (self.name not in HTMLAwareEntitySubstitution.preformatted_tags
-             or self._is_xml))
-
     def decode(self, indent_level=None,
                eventual_encoding=DEFAULT_OUTPUT_ENCODING,
                formatter="minimal"):
@@ -1007,32 +1517,54 @@ class Tag(PageElement):
            document contains a <META> tag that mentions the document's
            encoding.
         """
+        buffer = SerializationBuffer()
+        self._serialize(buffer, indent_level, eventual_encoding, formatter)
+        return buffer.getvalue()
+
+    def write(self, fileobj, encoding=DEFAULT_OUTPUT_ENCODING,
+              formatter="minimal", pretty_print=False,
+              errors="xmlcharrefreplace", buffer_size=None):
+        """Writes this tag and its contents to a file-like object.
+
+        The output is the same as that of encode() (or prettify(), if
+        `pretty_print` is true), but it's written out a piece at a
+        time, so the whole document never has to exist in memory as a
+        single string.
+
+        :param encoding: The encoding to use. If this is None, Unicode
+           strings are written to `fileobj`.
+        :param buffer_size: Roughly how many characters to collect
+           before writing them out.
+        """
+        if pretty_print:
+            indent_level = True
+        else:
+            indent_level = None
+        self._write(fileobj, indent_level, encoding, formatter, errors,
+                    buffer_size)
+
+    def _write(self, fileobj, indent_level, encoding, formatter, errors,
+               buffer_size):
+        buffer = SerializationBuffer(fileobj, encoding, errors, buffer_size)
+        self._serialize(buffer, indent_level, encoding, formatter)
+        buffer.flush(final=True)
+
+    def _should_pretty_print(self, indent_level):
+        """Should this tag be pretty-printed?"""
+        return (
+            indent_level is not None and
+            (self.name not in HTMLAwareEntitySubstitution.preformatted_tags
+             or self._is_xml))
+
+    def _serialize(self, buffer, indent_level, eventual_encoding, formatter):
+        """Appends a Unicode representation of this tag and its
+        contents to a SerializationBuffer."""
 
         # First off, turn a string formatter into a function. This
         # will stop the lookup from happening over and over again.
         if not callable(formatter):
             formatter = self._formatter_for_name(formatter)
 
-        attrs = []
-        if self.attrs:
-            for key, val in sorted(self.attrs.items()):
-                if val is None:
-                    decoded = key
-                else:
-                    if isinstance(val, list) or isinstance(val, tuple):
-                        val = ' '.join(val)
-                    elif not isinstance(val, basestring):
-                        val = unicode(val)
-                    elif (
-                        isinstance(val, AttributeValueWithCharsetSubstitution)
-                        and eventual_encoding is not None):
-                        val = val.encode(eventual_encoding)
-
-                    text = self.format_string(val, formatter)
-                    decoded = (
-                        unicode(key) + '='
-                        + EntitySubstitution.quoted_attribute_value(text))
-                attrs.append(decoded)
         close = ''
         closeTag = ''
 
@@ -1055,38 +1587,62 @@ class Tag(PageElement):
             indent_contents = indent_level + 1
         else:
             indent_contents = None
-        contents = self.decode_contents(
-            indent_contents, eventual_encoding, formatter)
 
         if self.hidden:
             # This is the 'document root' object.
-            s = contents
-        else:
-            s = []
-            attribute_string = ''
-            if attrs:
-                attribute_string = ' ' + ' '.join(attrs)
-            if indent_level is not None:
-                # Even if this particular tag is not pretty-printed,
-                # we should indent up to the start of the tag.
-                s.append(indent_space)
-            s.append('<%s%s%s%s>' % (
-                    prefix, self.name, attribute_string, close))
-            if pretty_print:
-                s.append("\n")
-            s.append(contents)
-            if pretty_print and contents and contents[-1] != "\n":
-                s.append("\n")
-            if pretty_print and closeTag:
-                s.append(space)
-            s.append(closeTag)
-            if indent_level is not None and closeTag and self.next_sibling:
-                # Even if this particular tag is not pretty-printed,
-                # we're now done with the tag, and we should add a
-                # newline if appropriate.
-                s.append("\n")
-            s = ''.join(s)
-        return s
+            self._serialize_contents(
+                buffer, indent_contents, eventual_encoding, formatter)
+            return
+
+        attribute_string = self._attribute_string(
+            eventual_encoding, formatter)
+        if indent_level is not None:
+            # Even if this particular tag is not pretty-printed,
+            # we should indent up to the start of the tag.
+            buffer.append(indent_space)
+        buffer.append('<%s%s%s%s>' % (
+                prefix, self.name, attribute_string, close))
+        if pretty_print:
+            buffer.append("\n")
+        contents_start = buffer.count
+        self._serialize_contents(
+            buffer, indent_contents, eventual_encoding, formatter)
+        if (pretty_print and buffer.count > contents_start
+            and buffer.last[-1] != "\n"):
+            buffer.append("\n")
+        if pretty_print and closeTag:
+            buffer.append(space)
+        buffer.append(closeTag)
+        if indent_level is not None and closeTag and self.next_sibling:
+            # Even if this particular tag is not pretty-printed,
+            # we're now done with the tag, and we should add a
+            # newline if appropriate.
+            buffer.append("\n")
+
+    def _attribute_string(self, eventual_encoding, formatter):
+        """Renders this tag's attributes as they'd appear in its start tag."""
+        if not self.attrs:
+            return ''
+        attrs = []
+        for key, val in sorted(self.attrs.items()):
+            if val is None:
+                decoded = key
+            else:
+                if isinstance(val, list) or isinstance(val, tuple):
+                    val = ' '.join(val)
+                elif not isinstance(val, basestring):
+                    val = unicode(val)
+                elif (
+                    isinstance(val, AttributeValueWithCharsetSubstitution)
+                    and eventual_encoding is not None):
+                    val = val.encode(eventual_encoding)
+
+                text = self.format_string(val, formatter)
+                decoded = (
+                    unicode(key) + '='
+                    + EntitySubstitution.quoted_attribute_value(text))
+            attrs.append(decoded)
+        return ' ' + ' '.join(attrs)
 
     def prettify(self, encoding=None, formatter="minimal"):
         if encoding is None:
@@ -1106,29 +1662,47 @@ class Tag(PageElement):
            document contains a <META> tag that mentions the document's
            encoding.
         """
+        buffer = SerializationBuffer()
+        self._serialize_contents(
+            buffer, indent_level, eventual_encoding, formatter)
+        return buffer.getvalue()
+
+    def _serialize_contents(self, buffer, indent_level, eventual_encoding,
+                            formatter):
+        """Appends a Unicode representation of this tag's contents to
+        a SerializationBuffer."""
         # First off, turn a string formatter into a function. This
         # will stop the lookup from happening over and over again.
         if not callable(formatter):
             formatter = self._formatter_for_name(formatter)
 
+        # For the built-in formatters, decide once whether the plain
+        # strings inside this tag need entity substitution at all.
+        fast_strings = isinstance(formatter, Formatter)
+        if fast_strings:
+            substitute = formatter.string_substitution_for(self)
+
         pretty_print = (indent_level is not None)
-        s = []
         for c in self:
             text = None
-            if isinstance(c, NavigableString):
+            if fast_strings and c.__class__ is NavigableString:
+                if substitute is None:
+                    text = c
+                else:
+                    text = substitute(c)
+            elif isinstance(c, NavigableString):
                 text = c.output_ready(formatter)
             elif isinstance(c, Tag):
-                s.append(c.decode(indent_level, eventual_encoding,
-                                  formatter))
+                c._serialize(buffer, indent_level, eventual_encoding,
+                             formatter)
             if text and indent_level and not self.name == 'pre':
                 text = text.strip()
             if text:
                 if pretty_print and not self.name == 'pre':
-                    s.append(" " * (indent_level - 1))
-                s.append(text)
+                    buffer.append(" " * (indent_level - 1))
+                buffer.append(text)
                 if pretty_print and not self.name == 'pre':
-                    s.append("\n")
-        return ''.join(s)
+                    buffer.append("\n")
 
     def encode_contents(
         self, indent_level=None, encoding=DEFAULT_OUTPUT_ENCODING,
@@ -1440,6 +2014,7 @@ class SoupStrainer(object):
 
         self.attrs = normalized_attrs
         self.text = self._normalize_search_value(text)
+        self._compile()
 
     def _normalize_search_value(self, value):
         # Leave it alone if it's a Unicode string, a callable, a
@@ -1477,43 +2052,127 @@ class SoupStrainer(object):
         else:
             return "%s|%s" % (self.name, self.attrs)
 
+    def _compile(self):
+        """Turn the search criteria into functions, so that nothing
+        has to be figured out about them again for each element that's
+        checked."""
+        if self.name:
+            self._name_matcher = self._matcher(self.name)
+        else:
+            self._name_matcher = None
+        self._name_is_callable = isinstance(
+            self.name, collections.Callable)
+        self._attr_matchers = [(attr, self._matcher(match_against))
+                               for attr, match_against in self.attrs.items()]
+        self._text_matcher = self._matcher(self.text)
+        self._searches_tags = bool(not self.text or self.name or self.attrs)
+        self._searches_strings = not self.name and not self.attrs
+
+    def __getstate__(self):
+        # The compiled functions can't be pickled, but they can be
+        # compiled again.
+        state = dict(self.__dict__)
+        for key in ('_name_matcher', '_attr_matchers', '_text_matcher'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def _matcher(self, match_against):
+        """Create a function that says whether a value from the markup
+        (a tag, tag name, attribute value or string) matches a
+        normalized search value."""
+        if match_against is True:
+            # True matches any non-None value.
+            match_one = lambda markup: markup is not None
+        elif isinstance(match_against, collections.Callable):
+            match_one = match_against
+        else:
+            # Custom callables take the tag as an argument, but all
+            # other ways of matching match the tag name as a string.
+            if isinstance(match_against, unicode):
+                # Exact string match
+                test = lambda markup: markup == match_against
+            elif hasattr(match_against, 'match'):
+                # Regexp match
+                test = match_against.search
+            elif hasattr(match_against, '__iter__'):
+                # The markup must be an exact match against something
+                # in the iterable.
+                if all(isinstance(v, unicode) for v in match_against):
+                    match_against = frozenset(match_against)
+                test = match_against.__contains__
+            else:
+                test = lambda markup: None
+            # None matches None, False, an empty string, an empty
+            # list, and so on.
+            none_matches = not match_against
+            normalize = self._normalize_search_value
+
+            def match_one(markup):
+                if isinstance(markup, Tag):
+                    markup = markup._name
+                elif markup is not None and not isinstance(markup, unicode):
+                    markup = normalize(markup)
+                if markup is None:
+                    return none_matches
+                return test(markup)
+
+        if isinstance(match_against, unicode) and ' ' in match_against:
+            # If they try to match "foo bar" on a multivalue
+            # attribute's value, only accept the literal value
+            # "foo bar".
+            words = whitespace_re.split(match_against)
+            match_list = lambda markup: markup == words
+        else:
+            def match_list(markup):
+                for item in markup:
+                    if match(item):
+                        return True
+                return False
+
+        def match(markup):
+            if isinstance(markup, (list, tuple)):
+                # This should only happen when searching a
+                # multi-valued attribute like 'class'.
+                return match_list(markup)
+            return match_one(markup)
+        return match
+
     def search_tag(self, markup_name=None, markup_attrs={}):
-        found = None
         markup = None
         if isinstance(markup_name, Tag):
             markup = markup_name
-            markup_attrs = markup
-        call_function_with_tag_data = (
-            isinstance(self.name, collections.Callable)
-            and not isinstance(markup_name, Tag))
-
-        if ((not self.name)
-            or call_function_with_tag_data
-            or (markup and self._matches(markup, self.name))
-            or (not markup and self._matches(markup_name, self.name))):
-            if call_function_with_tag_data:
-                match = self.name(markup_name, markup_attrs)
-            else:
-                match = True
-                markup_attr_map = None
-                for attr, match_against in list(self.attrs.items()):
-                    if not markup_attr_map:
-                        if hasattr(markup_attrs, 'get'):
-                            markup_attr_map = markup_attrs
-                        else:
-                            markup_attr_map = {}
-                            for k, v in markup_attrs:
-                                markup_attr_map[k] = v
-                    attr_value = markup_attr_map.get(attr)
-                    if not self._matches(attr_value, match_against):
-                        match = False
-                        break
-            if match:
-                if markup:
-                    found = markup
-                else:
-                    found = markup_name
-        if found and self.text and not self._matches(found.string, self.text):
+            markup_attrs = markup.attrs
+
+        if self._name_matcher is not None:
+            if self._name_is_callable:
+                if markup is None:
+                    # Call the function with the tag data, and don't
+                    # bother checking the attributes.
+                    if not self.name(markup_name, markup_attrs):
+                        return None
+                    markup_attrs = None
+                elif not self.name(markup):
+                    return None
+            elif not self._name_matcher(
+                markup_name if markup is None else markup._name):
+                return None
+
+        if self._attr_matchers and markup_attrs is not None:
+            if not hasattr(markup_attrs, 'get'):
+                markup_attrs = dict(markup_attrs)
+            for attr, matcher in self._attr_matchers:
+                if not matcher(markup_attrs.get(attr)):
+                    return None
+
+        if markup is not None:
+            found = markup
+        else:
+            found = markup_name
+        if found and self.text and not self._text_matcher(found.string):
             found = None
         return found
     searchTag = search_tag
@@ -1521,82 +2180,30 @@ class SoupStrainer(object):
     def search(self, markup):
         # print 'looking for %s in %s' % (self, markup)
         found = None
+        # If it's a Tag, make sure its name or attributes match.
+        # Don't bother with Tags if we're searching for text.
+        if isinstance(markup, Tag):
+            if self._searches_tags:
+                found = self.search_tag(markup)
+        # If it's text, make sure the text matches.
+        elif isinstance(markup, basestring):
+            if self._searches_strings and self._text_matcher(markup):
+                found = markup
         # If given a list of items, scan it for a text element that
         # matches.
-        if hasattr(markup, '__iter__') and not isinstance(markup, (Tag, basestring)):
+        elif hasattr(markup, '__iter__'):
             for element in markup:
                 if isinstance(element, NavigableString) \
                        and self.search(element):
                     found = element
                     break
-        # If it's a Tag, make sure its name or attributes match.
-        # Don't bother with Tags if we're searching for text.
-        elif isinstance(markup, Tag):
-            if not self.text or self.name or self.attrs:
-                found = self.search_tag(markup)
-        # If it's text, make sure the text matches.
-        elif isinstance(markup, NavigableString) or \
-                 isinstance(markup, basestring):
-            if not self.name and not self.attrs and self._matches(markup, self.text):
-                found = markup
         else:
             raise Exception(
                 "I don't know how to match against a %s" % markup.__class__)
         return found
 
     def _matches(self, markup, match_against):
-        # print u"Matching %s against %s" % (markup, match_against)
-        result = False
-        if isinstance(markup, list) or isinstance(markup, tuple):
-            # This should only happen when searching a multi-valued attribute
-            # like 'class'.
-            if (isinstance(match_against, unicode)
-                and ' ' in match_against):
-                # A bit of a special case. If they try to match "foo
-                # bar" on a multivalue attribute's value, only accept
-                # the literal value "foo bar"
-                #
-                # XXX This is going to be pretty slow because we keep
-                # splitting match_against. But it shouldn't come up
-                # too often.
-                return (whitespace_re.split(match_against) == markup)
-            else:
-                for item in markup:
-                    if self._matches(item, match_against):
-                        return True
-                return False
-
-        if match_against is True:
-            # True matches any non-None value.
-            return markup is not None
-
-        if isinstance(match_against, collections.Callable):
-            return match_against(markup)
-
-        # Custom callables take the tag as an argument, but all
-        # other ways of matching match the tag name as a string.
-        if isinstance(markup, Tag):
-            markup = markup.name
-
-        # Ensure that `markup` is either a Unicode string, or None.
-        markup = self._normalize_search_value(markup)
-
-        if markup is None:
-            # None matches None, False, an empty string, an empty list, and so on.
-            return not match_against
-
-        if isinstance(match_against, unicode):
-            # Exact string match
-            return markup == match_against
-
-        if hasattr(match_against, 'match'):
-            # Regexp match
-            return match_against.search(markup)
-
-        if hasattr(match_against, '__iter__'):
-            # The markup must be an exact match against something
-            # in the iterable.
-            return markup in match_against
+        return self._matcher(match_against)(markup)
 
 
 class ResultSet(list):
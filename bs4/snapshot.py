@@ -0,0 +1,406 @@
+"""Compact, picklable snapshots of parsed documents.
+
+A Beautiful Soup tree is a web of objects linked in every direction,
+which makes it slow to pickle and impossible to pickle at all once
+it's deep enough to hit the recursion limit. A Snapshot stores the
+same tree as a handful of flat arrays--what kind of node each one is,
+the index of its parent, and its name or text--plus a table of
+strings. It can be saved, loaded and pickled quickly, and a saved
+snapshot can be memory-mapped, so any number of worker processes can
+build trees from one copy of it in the page cache.
+
+    snapshot = Snapshot.from_soup(soup)
+    snapshot.save("page.bs4")
+    ...
+    soup = Snapshot.load("page.bs4", mmap=True).to_soup()
+
+Only the document itself is kept: which parser built it, the
+encoding it was found in, and the tags and strings. Attributes set on
+individual Tag objects, and subclasses of Tag, are not.
+"""
+
+import array
+import mmap as mmap_module
+import struct
+import sys
+
+from bs4 import BeautifulSoup, FeatureNotFound
+from bs4.builder import builder_registry
+from bs4.element import (
+    CData,
+    Comment,
+    Declaration,
+    Doctype,
+    EMPTY_ATTRIBUTES,
+    EMPTY_CONTENTS,
+    NamespacedAttribute,
+    NavigableString,
+    ProcessingInstruction,
+    Tag,
+    )
+
+__all__ = ['Snapshot']
+
+# The arrays are stored little-endian no matter what machine wrote them.
+SWAP_BYTES = (sys.byteorder == 'big')
+
+
+def _to_bytes(a):
+    if SWAP_BYTES:
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    if hasattr(a, 'tobytes'):
+        return a.tobytes()
+    return a.tostring()
+
+
+def _from_bytes(typecode, data, start, count):
+    """Read an array out of a bytestring (or an mmap).
+
+    :return: A 2-tuple (array, position just after the array).
+    """
+    a = array.array(typecode)
+    end = start + count * a.itemsize
+    if end > len(data):
+        raise ValueError("Snapshot data is truncated.")
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data[start:end])
+    else:
+        a.fromstring(data[start:end])
+    if SWAP_BYTES:
+        a.byteswap()
+    return a, end
+
+
+class Snapshot(object):
+    """A parsed document, stored as flat arrays.
+
+    The data is a bytestring laid out like this, with integers in
+    little-endian order:
+
+     HEADER: the magic number, flags, and the sizes of what follows.
+     offsets: one unsigned int per string, where it ends in the blob.
+     blob: every distinct string in the tree, encoded as UTF-8.
+     kinds: one byte per node: 0 for a tag, otherwise which kind of
+       string it is (see STRING_CLASSES).
+     parents: one int per node, the index of its parent, or -1 for a
+       child of the BeautifulSoup object itself.
+     values: one int per node, the string-table index of its name or text.
+     extras: one int per node. For a tag with a namespace, a prefix
+       or attributes, this is where they start in `extra_items`;
+       otherwise it's -1.
+     extra_items: for each such tag, its namespace, its prefix, the
+       number of attributes, and then each attribute's key and value.
+
+    Nodes are stored in document order, so a node's parent always
+    comes before it. Index 0 of the string table stands for None. An
+    attribute key of -1 is followed by the prefix, name and namespace
+    of a NamespacedAttribute. A negative attribute value -(n+1) is
+    followed by the n items of a list, such as the value of "class".
+    """
+
+    MAGIC = b'BS4SNAP1'
+
+    # magic, flags, builder features, original encoding, declared
+    # encoding, number of strings, size of blob, number of nodes,
+    # number of extra items.
+    HEADER = struct.Struct('<8sB3i4I')
+
+    IS_XML = 1
+    CONTAINS_REPLACEMENT_CHARACTERS = 2
+
+    TAG = 0
+    STRING_CLASSES = (
+        None, NavigableString, CData, ProcessingInstruction, Comment,
+        Declaration, Doctype)
+
+    def __init__(self, data):
+        """:param data: A bytestring, or an mmap, as created by
+        from_soup() or save().
+        """
+        if data[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError("This is not a Beautiful Soup snapshot.")
+        self.data = data
+
+    @classmethod
+    def from_soup(cls, soup):
+        """Take a snapshot of a BeautifulSoup object."""
+        return cls(b''.join(cls._sections(soup)))
+
+    @classmethod
+    def load(cls, source, mmap=False):
+        """Load a snapshot saved by save().
+
+        :param source: A filename or an open binary file.
+        :param mmap: If true, the file is memory-mapped rather than
+            read into memory. Processes that map the same file share
+            the pages the operating system reads in.
+        """
+        if not hasattr(source, 'read'):
+            with open(source, 'rb') as fh:
+                return cls.load(fh, mmap)
+        if mmap:
+            return cls(mmap_module.mmap(
+                    source.fileno(), 0, access=mmap_module.ACCESS_READ))
+        return cls(source.read())
+
+    def save(self, destination):
+        """Write this snapshot to a filename or an open binary file."""
+        if not hasattr(destination, 'write'):
+            with open(destination, 'wb') as fh:
+                return self.save(fh)
+        destination.write(self.data[:])
+
+    def close(self):
+        """Release the memory map, if this snapshot was loaded with one."""
+        if isinstance(self.data, mmap_module.mmap):
+            self.data.close()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __reduce__(self):
+        return (self.__class__, (self.data[:],))
+
+    @classmethod
+    def _sections(cls, soup):
+        """Turn a tree into the pieces of a snapshot."""
+        string_indexes = {}
+        strings = [None]
+
+        def index(s):
+            if s is None:
+                return 0
+            i = string_indexes.get(s)
+            if i is None:
+                i = string_indexes[s] = len(strings)
+                strings.append(s)
+            return i
+
+        string_kinds = {}
+        for kind, klass in enumerate(cls.STRING_CLASSES):
+            if klass is not None:
+                string_kinds[klass] = kind
+
+        kinds = array.array('B')
+        parents = array.array('i')
+        values = array.array('i')
+        extras = array.array('i')
+        extra_items = array.array('i')
+
+        # Walk the tree without recursion, so a deep tree is no problem.
+        iterators = [iter(soup.contents)]
+        parent_indexes = [-1]
+        while iterators:
+            for node in iterators[-1]:
+                node_index = len(kinds)
+                parents.append(parent_indexes[-1])
+                if isinstance(node, Tag):
+                    kinds.append(cls.TAG)
+                    values.append(index(node.name))
+                    if (node.namespace is None and node.prefix is None
+                        and not node.attrs):
+                        extras.append(-1)
+                    else:
+                        extras.append(len(extra_items))
+                        cls._add_extras(node, extra_items, index)
+                    if node.contents:
+                        iterators.append(iter(node.contents))
+                        parent_indexes.append(node_index)
+                        break
+                else:
+                    kind = string_kinds.get(node.__class__)
+                    if kind is None:
+                        kind = cls._kind_for_subclass(node, string_kinds)
+                    kinds.append(kind)
+                    values.append(index(unicode(node)))
+                    extras.append(-1)
+            else:
+                iterators.pop()
+                parent_indexes.pop()
+
+        flags = 0
+        if soup.is_xml:
+            flags |= cls.IS_XML
+        if getattr(soup, 'contains_replacement_characters', False):
+            flags |= cls.CONTAINS_REPLACEMENT_CHARACTERS
+        features = index(u' '.join(soup.builder.features))
+        original_encoding = index(getattr(soup, 'original_encoding', None))
+        declared_encoding = index(getattr(soup, 'declared_html_encoding', None))
+
+        offsets = array.array('I')
+        encoded = [b'']
+        end = 0
+        for s in strings:
+            if s is not None:
+                # Convert to a plain string first: encoding a
+                # CharsetMetaAttributeValue gives the name of the
+                # encoding.
+                s = unicode(s).encode("utf8")
+                encoded.append(s)
+                end += len(s)
+            offsets.append(end)
+        blob = b''.join(encoded)
+
+        yield cls.HEADER.pack(
+            cls.MAGIC, flags, features, original_encoding,
+            declared_encoding, len(strings), len(blob), len(kinds),
+            len(extra_items))
+        yield _to_bytes(offsets)
+        yield blob
+        for a in (kinds, parents, values, extras, extra_items):
+            yield _to_bytes(a)
+
+    @classmethod
+    def _add_extras(cls, tag, extra_items, index):
+        extra_items.append(index(tag.namespace))
+        extra_items.append(index(tag.prefix))
+        extra_items.append(len(tag.attrs))
+        for key, value in tag.attrs.items():
+            if isinstance(key, NamespacedAttribute):
+                extra_items.extend(
+                    (-1, index(key.prefix), index(key.name),
+                     index(key.namespace)))
+            else:
+                extra_items.append(index(key))
+            if isinstance(value, (list, tuple)):
+                extra_items.append(-(len(value) + 1))
+                extra_items.extend(index(item) for item in value)
+            else:
+                if not isinstance(value, basestring):
+                    value = unicode(value)
+                extra_items.append(index(value))
+
+    @classmethod
+    def _kind_for_subclass(cls, node, string_kinds):
+        for klass in node.__class__.__mro__:
+            if klass in string_kinds:
+                return string_kinds[klass]
+        raise ValueError(
+            "Can't take a snapshot of %r: it's not a Tag or a "
+            "NavigableString." % node)
+
+    def to_soup(self, compact=False):
+        """Build a BeautifulSoup object from this snapshot.
+
+        The tree builder is looked up by the features of the one that
+        originally built the tree. If that parser isn't installed here,
+        any HTML or XML tree builder will do.
+
+        :param compact: Build a compact tree, as with the `compact`
+            argument to the BeautifulSoup constructor.
+        """
+        data = self.data
+        (magic, flags, features, original_encoding, declared_encoding,
+         num_strings, blob_size, num_nodes, num_extra_items) = (
+            self.HEADER.unpack(data[:self.HEADER.size]))
+
+        offsets, pos = _from_bytes('I', data, self.HEADER.size, num_strings)
+        blob = data[pos:pos + blob_size]
+        pos += blob_size
+        strings = [None]
+        start = 0
+        for end in offsets[1:]:
+            strings.append(blob[start:end].decode("utf8"))
+            start = end
+        del blob
+        kinds, pos = _from_bytes('B', data, pos, num_nodes)
+        parents, pos = _from_bytes('i', data, pos, num_nodes)
+        values, pos = _from_bytes('i', data, pos, num_nodes)
+        extras, pos = _from_bytes('i', data, pos, num_nodes)
+        extra_items, pos = _from_bytes('i', data, pos, num_extra_items)
+
+        is_xml = bool(flags & self.IS_XML)
+        builder = self._builder_for(strings[features], is_xml)
+        soup = BeautifulSoup("", builder=builder, compact=compact)
+        # Throw away whatever the builder made out of the empty string.
+        soup.reset()
+        soup.builder.soup = None
+        soup.original_encoding = strings[original_encoding]
+        soup.declared_html_encoding = strings[declared_encoding]
+        soup.contains_replacement_characters = bool(
+            flags & self.CONTAINS_REPLACEMENT_CHARACTERS)
+
+        string_classes = self.STRING_CLASSES
+        nodes = []
+        # As in a parsed tree, the BeautifulSoup object isn't part of
+        # the next_element chain.
+        previous = None
+        for i in xrange(num_nodes):
+            parent_index = parents[i]
+            if parent_index == -1:
+                parent = soup
+            else:
+                parent = nodes[parent_index]
+            kind = kinds[i]
+            if kind == self.TAG:
+                extra = extras[i]
+                if extra == -1:
+                    namespace = prefix = None
+                    if compact:
+                        attrs = EMPTY_ATTRIBUTES
+                    else:
+                        attrs = None
+                else:
+                    namespace, prefix, attrs = self._extras(
+                        extra_items, extra, strings)
+                node = Tag(soup, builder, strings[values[i]], namespace,
+                           prefix, attrs, parent, previous)
+            else:
+                node = string_classes[kind](strings[values[i]])
+                node.setup(parent, previous)
+            parent.contents.append(node)
+            nodes.append(node)
+            previous = node
+
+        if compact:
+            for node in nodes:
+                if isinstance(node, Tag) and not node.contents:
+                    node.contents = EMPTY_CONTENTS
+        return soup
+
+    def _extras(self, extra_items, pos, strings):
+        """Read a tag's namespace, prefix and attributes."""
+        namespace = strings[extra_items[pos]]
+        prefix = strings[extra_items[pos + 1]]
+        num_attrs = extra_items[pos + 2]
+        pos += 3
+        attrs = {}
+        for j in range(num_attrs):
+            key = extra_items[pos]
+            if key == -1:
+                key = NamespacedAttribute(
+                    strings[extra_items[pos + 1]],
+                    strings[extra_items[pos + 2]],
+                    strings[extra_items[pos + 3]])
+                pos += 4
+            else:
+                key = strings[key]
+                pos += 1
+            value = extra_items[pos]
+            pos += 1
+            if value < 0:
+                num_items = -value - 1
+                value = [strings[item]
+                         for item in extra_items[pos:pos + num_items]]
+                pos += num_items
+            else:
+                value = strings[value]
+            attrs[key] = value
+        return namespace, prefix, attrs
+
+    @classmethod
+    def _builder_for(cls, features, is_xml):
+        builder_class = None
+        if features:
+            builder_class = builder_registry.lookup(*features.split(u' '))
+        if builder_class is None:
+            if is_xml:
+                builder_class = builder_registry.lookup('xml')
+            else:
+                builder_class = builder_registry.lookup('html')
+        if builder_class is None:
+            raise FeatureNotFound(
+                "Couldn't find a tree builder to rebuild this snapshot "
+                "with: %s" % features)
+        return builder_class()
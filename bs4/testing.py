@@ -2,8 +2,10 @@
 
 import copy
 import functools
+from io import BytesIO
 import unittest
 from unittest import TestCase
+import warnings
 from bs4 import BeautifulSoup
 from bs4.element import (
     CharsetMetaAttributeValue,
@@ -14,6 +16,7 @@ from bs4.element import (
 )
 
 from bs4.builder import HTMLParserTreeBuilder
+from bs4.snapshot import Snapshot
 default_builder = HTMLParserTreeBuilder
 
 
@@ -142,6 +145,12 @@ class HTMLTreeBuilderSmokeTest(object):
 
         self.assertSoupEquals("<br>", "<br/>")
 
+    def test_unmatched_end_tag_is_ignored(self):
+        """An end tag that doesn't match any open tag doesn't close
+        the tags that are open."""
+        soup = self.soup("<div><b></i>text</b>more</div>")
+        self.assertEqual("<div><b>text</b>more</div>", soup.div.decode())
+
     def test_br_is_always_empty_element_tag(self):
         """A <br> tag is designated as an empty-element tag.
 
@@ -461,6 +470,77 @@ class HTMLTreeBuilderSmokeTest(object):
         data.a['foo'] = 'bar'
         self.assertEqual('<a foo="bar">text</a>', data.a.decode())
 
+    def test_stream_from_file(self):
+        # A large document with a declared encoding is parsed a
+        # chunk at a time, and comes out the same as if it had been
+        # read into memory.
+        markup = (
+            u'<html><head><meta charset="utf-8"></head><body>'
+            + u'<p class="x">Sacr\N{LATIN SMALL LETTER E WITH ACUTE} bleu!</p>' * 2000
+            + u'</body></html>').encode("utf-8")
+        streamed = self.soup(BytesIO(markup), stream=True)
+        self.assertEqual(streamed.original_encoding, "utf-8")
+        self.assertEqual(streamed.decode(), self.soup(markup).decode())
+
+    def test_iterparse(self):
+        markup = b"<html><body>" + b"".join(
+            b'<div><a class="internal" href="/%d">%d</a><a href="/">home</a></div>' % (i, i)
+            for i in range(1000)) + b"</body></html>"
+        hrefs = []
+        with warnings.catch_warnings(record=True):
+            # Don't let a builder's warning about parse_only keep
+            # other tests from seeing it.
+            warnings.simplefilter("always")
+            links = BeautifulSoup.iterparse(
+                BytesIO(markup), SoupStrainer("a", class_="internal"),
+                builder=self.default_builder)
+            for link in links:
+                # Each match has been taken out of the tree.
+                self.assertEqual(link.parent, None)
+                self.assertEqual(link.previous_element, None)
+                self.assertEqual(link.next_element, link.string)
+                self.assertEqual(link.string.next_element, None)
+                hrefs.append(link['href'])
+                link.decompose()
+        self.assertEqual(hrefs, ["/%d" % i for i in range(1000)])
+
+    def test_builder_can_be_reused(self):
+        builder = self.default_builder
+        documents = [
+            b'<p class="a">Sacr\xc3\xa9 bleu!</p>',
+            u'<table><tr><td>Unicode</td></tr></table>',
+            b'<?xml version="1.0" encoding="latin1"?><p>Sacr\xe9 bleu!</p>',
+            b'<div><span>unclosed',
+            ]
+        expected = [self.soup(markup).decode() for markup in documents]
+
+        # Abandon an iterparse() partway through the document.
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter("always")
+            links = BeautifulSoup.iterparse(
+                b"<a>1</a><a>2</a><a>3</a>", SoupStrainer("a"),
+                builder=builder)
+            next(links)
+            links.close()
+
+        for i in range(2):
+            self.assertEqual(
+                expected,
+                [BeautifulSoup(markup, builder=builder).decode()
+                 for markup in documents])
+
+    def test_snapshot(self):
+        markup = (b'<!DOCTYPE html><html><head><meta charset="utf-8"></head>'
+                  b'<body><p class="a b" id="x">Sacr\xc3\xa9 bleu!<!--comment-->'
+                  b'<br/></p></body></html>')
+        soup = self.soup(markup)
+        loaded = Snapshot.from_soup(soup).to_soup()
+        self.assertEqual(loaded.builder.__class__, soup.builder.__class__)
+        self.assertEqual(loaded.original_encoding, soup.original_encoding)
+        self.assertEqual(loaded.decode(), soup.decode())
+        self.assertEqual(loaded.encode("latin1"), soup.encode("latin1"))
+        self.assertEqual(["a", "b"], loaded.p['class'])
+
 class XMLTreeBuilderSmokeTest(object):
 
     def test_docstring_generated(self):
@@ -509,6 +589,54 @@ class XMLTreeBuilderSmokeTest(object):
             soup.encode("latin1"),
             b'<?xml version="1.0" encoding="latin1"?>\n<root/>')
 
+    def test_write_includes_xml_declaration(self):
+        soup = self.soup("<root/>")
+        out = BytesIO()
+        soup.write(out, "latin1")
+        self.assertEqual(out.getvalue(), soup.encode("latin1"))
+
+    def test_stream_from_file(self):
+        markup = (
+            b'<?xml version="1.0" encoding="latin1"?>\n<root>'
+            + b'<a>Sacr\xe9 bleu!</a>' * 2000 + b'</root>')
+        streamed = self.soup(BytesIO(markup), stream=True)
+        self.assertEqual(streamed.original_encoding, "latin1")
+        self.assertEqual(streamed.decode(), self.soup(markup).decode())
+
+    def test_iterparse(self):
+        markup = b"<feed>" + b"".join(
+            b"<entry><id>%d</id><title>Entry %d</title></entry>" % (i, i)
+            for i in range(1000)) + b"</feed>"
+        titles = [title.string for title in BeautifulSoup.iterparse(
+                BytesIO(markup), SoupStrainer("title"),
+                builder=self.default_builder)]
+        self.assertEqual(titles, ["Entry %d" % i for i in range(1000)])
+
+    def test_builder_can_be_reused(self):
+        builder = self.default_builder
+        documents = [
+            b'<?xml version="1.0" encoding="latin1"?><root>Sacr\xe9 bleu!</root>',
+            u'<root xmlns:a="http://example.com/"><a:foo/></root>',
+            b'<root><unclosed>',
+            ]
+        expected = [self.soup(markup).decode() for markup in documents]
+        for i in range(2):
+            self.assertEqual(
+                expected,
+                [BeautifulSoup(markup, builder=builder).decode()
+                 for markup in documents])
+
+    def test_snapshot(self):
+        markup = (b'<?xml version="1.0" encoding="utf-8"?>\n'
+                  b'<root xmlns:a="http://example.com/"><a:foo a:bar="1">'
+                  b'<![CDATA[<data>]]></a:foo><?pi data?></root>')
+        soup = self.soup(markup)
+        loaded = Snapshot.from_soup(soup).to_soup()
+        self.assertTrue(loaded.is_xml)
+        self.assertEqual(loaded.decode(), soup.decode())
+        self.assertEqual("http://example.com/", loaded.foo.namespace)
+        self.assertEqual("a", loaded.foo.prefix)
+
     def test_large_xml_document(self):
         """A large XML document should come out the same as it went in."""
         markup = (b'<?xml version="1.0" encoding="utf-8"?>\n<root>'
@@ -1,13 +1,25 @@
 """Tests of the builder registry."""
 
+import importlib
+import os
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
+import bs4
 from bs4 import BeautifulSoup
+from bs4.benchmark import benchmark, save_profile
 from bs4.builder import (
+    _BUNDLED_BUILDERS,
+    builder_pool,
     builder_registry as registry,
     HTMLParserTreeBuilder,
+    TreeBuilderPool,
     TreeBuilderRegistry,
 )
+from bs4.element import SoupStrainer
 
 try:
     from bs4.builder import HTML5TreeBuilder
@@ -28,6 +40,15 @@ except ImportError:
 class BuiltInRegistryTest(unittest.TestCase):
     """Test the built-in registry with the default builders registered."""
 
+    def setUp(self):
+        # Whatever parser profile this environment has, these tests
+        # run without one.
+        self.profile_path = registry.profile_path
+        registry.use_profile(None)
+
+    def tearDown(self):
+        registry.use_profile(self.profile_path)
+
     def test_combination(self):
         if LXML_PRESENT:
             self.assertEqual(registry.lookup('fast', 'html'),
@@ -77,6 +98,30 @@ class BuiltInRegistryTest(unittest.TestCase):
         self.assertRaises(ValueError, BeautifulSoup,
                           "", features="no-such-feature")
 
+    def test_bundled_builders_are_declared_correctly(self):
+        # The registry knows each bundled builder's name and features
+        # before importing it. They'd better match the real class.
+        for module_name, class_name, name, features, is_xml in _BUNDLED_BUILDERS:
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError:
+                continue
+            cls = getattr(module, class_name)
+            self.assertEqual(name, cls.NAME)
+            self.assertEqual(list(features), list(cls.features))
+            self.assertEqual(is_xml, cls.is_xml)
+
+    def test_import_does_not_load_builders(self):
+        # Importing bs4 doesn't import any parser library.
+        code = ("import sys, bs4; print(sorted(m for m, module in "
+                "sys.modules.items() if module is not None and "
+                "(m.startswith('bs4.builder.') or m in "
+                "('lxml', 'html5lib', 'HTMLParser'))))")
+        output = subprocess.check_output(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(bs4.__file__))))
+        self.assertEqual("[]", output.strip())
+
 class RegistryTest(unittest.TestCase):
     """Test the TreeBuilderRegistry class in general."""
 
@@ -139,3 +184,206 @@ class RegistryTest(unittest.TestCase):
         builder1 = self.builder_for_features('foo', 'bar')
         builder2 = self.builder_for_features('foo', 'baz')
         self.assertEqual(self.registry.lookup('bar', 'baz'), None)
+
+
+class LazyRegistrationTest(unittest.TestCase):
+    """Test builders registered without importing their modules."""
+
+    def setUp(self):
+        self.registry = TreeBuilderRegistry()
+        self.registry.register_lazy(
+            'bs4.builder._htmlparser', 'HTMLParserTreeBuilder',
+            'html.parser', ['html.parser', 'html', 'strict'])
+        self.registry.register_lazy(
+            'bs4.tests.no_such_module', 'MissingTreeBuilder',
+            'missing', ['missing', 'html'])
+
+    def test_missing_module_is_skipped(self):
+        # The most recently registered builder can't be imported, so
+        # the lookup goes on to the next one.
+        self.assertEqual(
+            HTMLParserTreeBuilder, self.registry.lookup('html'))
+        self.assertEqual(None, self.registry.lookup('missing'))
+        self.assertEqual([HTMLParserTreeBuilder], self.registry.builders)
+
+    def test_loaded_builder_keeps_its_priority(self):
+        class Later(object):
+            features = ['html']
+        self.registry.register(Later)
+        self.assertEqual(
+            HTMLParserTreeBuilder, self.registry.lookup('strict'))
+        self.assertEqual(Later, self.registry.lookup('html'))
+        self.assertEqual(
+            [Later, HTMLParserTreeBuilder], self.registry.builders)
+
+    def test_concurrent_first_lookup(self):
+        found = []
+        def lookup():
+            found.append(self.registry.lookup('html'))
+        threads = [threading.Thread(target=lookup) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([HTMLParserTreeBuilder] * 8, found)
+        self.assertEqual(
+            [HTMLParserTreeBuilder], self.registry.candidates('html'))
+
+
+class ProfileTest(unittest.TestCase):
+    """Test the use of a parser profile to pick the fastest builder."""
+
+    def setUp(self):
+        self.registry = TreeBuilderRegistry()
+        self.slow = self.builder('slow', 'html', 'fast')
+        self.quick = self.builder('quick', 'html')
+        self.unmeasured = self.builder('unmeasured', 'html')
+        self.xml = self.builder('xml', 'xml', 'fast', is_xml=True)
+
+    def builder(self, name, *features, **kwargs):
+        cls = type('Builder_' + name, (object,), dict(
+                NAME=name, features=[name] + list(features),
+                is_xml=kwargs.get('is_xml', False)))
+        self.registry.register(cls)
+        return cls
+
+    def profile(self, **scores):
+        return dict(builders=dict(
+                (name, dict(score=score)) for name, score in scores.items()))
+
+    def test_no_profile(self):
+        self.assertEqual(self.registry.profile, None)
+        self.assertEqual(self.registry.lookup('fast'), self.xml)
+        self.assertEqual(self.registry.lookup('html', 'fast'), self.slow)
+
+    def test_fastest_builder_wins(self):
+        self.registry.profile = self.profile(
+            slow=10, quick=100, unmeasured=1, xml=1000)
+        # 'quick' doesn't advertise the 'fast' feature, but the
+        # profile shows it's faster.
+        self.assertEqual(self.registry.lookup('html', 'fast'), self.quick)
+        # The profile doesn't affect lookups that don't ask for speed.
+        self.assertEqual(self.registry.lookup('html'), self.unmeasured)
+
+    def test_markup_type_is_respected(self):
+        # Without the profile, lookup('fast') finds the XML builder,
+        # so the fastest XML builder wins even though an HTML builder
+        # is faster.
+        self.registry.profile = self.profile(slow=10, quick=10000, xml=1)
+        self.assertEqual(self.registry.lookup('fast'), self.xml)
+
+    def test_unscored_builders_cannot_win(self):
+        self.registry.profile = self.profile(slow=None, unmeasured=None)
+        self.assertEqual(self.registry.lookup('html', 'fast'), self.slow)
+
+    def test_partial_profile_is_ignored(self):
+        # The profile doesn't know about 'unmeasured', so it can't say
+        # that 'quick' is the fastest builder installed.
+        self.registry.profile = self.profile(slow=10, quick=100, xml=1000)
+        self.assertEqual(self.registry.lookup('html', 'fast'), self.slow)
+
+    def test_profile_is_opt_in(self):
+        # A profile in the default location isn't used unless
+        # BS4_PARSER_PROFILE names it.
+        home = tempfile.mkdtemp()
+        profile_path = os.path.join(home, '.bs4_parser_profile.json')
+        save_profile(self.profile(**{'html.parser': 100}), profile_path)
+        code = "import bs4.builder; print(bs4.builder.builder_registry.profile is None)"
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(bs4.__file__)))
+        env = dict(os.environ, HOME=home)
+        try:
+            env.pop('BS4_PARSER_PROFILE', None)
+            self.assertEqual("True", subprocess.check_output(
+                    [sys.executable, "-c", code], cwd=cwd, env=env).strip())
+            env['BS4_PARSER_PROFILE'] = profile_path
+            self.assertEqual("False", subprocess.check_output(
+                    [sys.executable, "-c", code], cwd=cwd, env=env).strip())
+        finally:
+            os.unlink(profile_path)
+            os.rmdir(home)
+
+    def test_profile_is_loaded_from_file(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            profile = benchmark(
+                num_elements=20, times=1, builders=[HTMLParserTreeBuilder])
+            results = profile['builders']['html.parser']
+            self.assertTrue(results['score'] > 0)
+            self.assertEqual(
+                set(['small', 'large', 'nested', 'malformed', 'windows-1252']),
+                set(results['shapes']))
+            save_profile(profile, filename)
+
+            registry = TreeBuilderRegistry(filename)
+            registry.register(HTMLParserTreeBuilder)
+            self.assertEqual(profile, registry.profile)
+            self.assertEqual(results['score'], registry.score(HTMLParserTreeBuilder))
+        finally:
+            os.unlink(filename)
+
+    def test_unreadable_profile_is_ignored(self):
+        registry = TreeBuilderRegistry("/no/such/profile.json")
+        registry.register(HTMLParserTreeBuilder)
+        self.assertEqual(None, registry.profile)
+        self.assertEqual(HTMLParserTreeBuilder, registry.lookup('html', 'fast'))
+
+
+class PoolTest(unittest.TestCase):
+    """Test the TreeBuilderPool class."""
+
+    def setUp(self):
+        self.registry = TreeBuilderRegistry()
+        self.registry.register(HTMLParserTreeBuilder)
+        self.pool = TreeBuilderPool(self.registry)
+
+    def test_released_builder_is_reused(self):
+        builder = self.pool.acquire('html')
+        self.assertTrue(isinstance(builder, HTMLParserTreeBuilder))
+        # A builder that's in use isn't handed out again.
+        other = self.pool.acquire('html')
+        self.assertFalse(other is builder)
+        self.pool.release(builder)
+        self.assertTrue(self.pool.acquire('html') is builder)
+
+    def test_unknown_features(self):
+        self.assertEqual(None, self.pool.acquire('no-such-feature'))
+
+    def test_idle_builders_are_limited(self):
+        builders = [self.pool.acquire('html')
+                    for i in range(self.pool.MAX_IDLE_BUILDERS + 2)]
+        for builder in builders:
+            self.pool.release(builder)
+        self.assertEqual(self.pool.MAX_IDLE_BUILDERS,
+                         len(self.pool.idle[HTMLParserTreeBuilder]))
+
+    def test_each_thread_has_its_own_pool(self):
+        builder = self.pool.acquire('html')
+        self.pool.release(builder)
+        from_thread = []
+        def acquire():
+            from_thread.append(self.pool.acquire('html'))
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join()
+        self.assertFalse(from_thread[0] is builder)
+        self.assertTrue(self.pool.acquire('html') is builder)
+
+    def test_pooled_beautifulsoup(self):
+        first = BeautifulSoup("<p>foo</p>", "html.parser", pooled=True)
+        second = BeautifulSoup("<b>bar</b>", "html.parser", pooled=True)
+        self.assertTrue(first.builder is second.builder)
+        self.assertEqual("<p>foo</p>", first.decode())
+        self.assertEqual("<b>bar</b>", second.decode())
+
+    def test_pooled_iterparse_keeps_its_builder(self):
+        found = []
+        for tag in BeautifulSoup.iterparse(
+            "<a>1</a><a>2</a>", SoupStrainer("a"), "html.parser",
+            pooled=True):
+            # Parsing another document in the middle of the iteration
+            # gets a different builder.
+            soup = BeautifulSoup("<b>x</b>", "html.parser", pooled=True)
+            self.assertEqual("<b>x</b>", soup.decode())
+            found.append(tag.decode())
+        self.assertEqual(["<a>1</a>", "<a>2</a>"], found)
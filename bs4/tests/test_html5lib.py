@@ -70,3 +70,22 @@ class HTML5LibBuilderSmokeTest(SoupTest, HTML5TreeBuilderSmokeTest):
         soup = self.soup(markup)
         # Verify that we can reach the <p> tag; this means the tree is connected.
         self.assertEqual(b"<p>foo</p>", soup.p.encode())
+
+    def test_adjacent_strings_are_combined(self):
+        # html5lib drops the stray end tags and hands over the text
+        # piece by piece. The pieces become one string.
+        soup = self.soup("<p>a</a>b</a>c</a><b>d</b>e</a>f</p>")
+        p = soup.p
+        self.assertEqual(["abc", "ef"], [s for s in p.strings if s != "d"])
+        self.assertEqual(3, len(p.contents))
+        abc, b, ef = p.contents
+        self.assertEqual(abc.next_element, b)
+        self.assertEqual(b.previous_element, abc)
+        self.assertEqual(b.string.next_element, ef)
+        self.assertEqual(ef.previous_element, b.string)
+        self.assertEqual(ef.next_element, None)
+
+    def test_adjacent_strings_in_foster_parented_text(self):
+        soup = self.soup("<table>a</a>b<tr><td>c</td></tr></table>")
+        self.assertEqual(["ab"], soup.body.find_all(text=True, recursive=False))
+        self.assertEqual("c", soup.body.table.tbody.tr.td.string)
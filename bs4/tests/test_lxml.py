@@ -1,6 +1,8 @@
 """Tests to ensure that the lxml tree builder generates good trees."""
 
+from io import BytesIO
 import re
+import tempfile
 import warnings
 
 try:
@@ -88,3 +90,27 @@ class LXMLXMLTreeBuilderSmokeTest(SoupTest, XMLTreeBuilderSmokeTest):
     @property
     def default_builder(self):
         return LXMLTreeBuilderForXML()
+
+    def test_chunk_size_can_be_set(self):
+        builder = LXMLTreeBuilderForXML(chunk_size=7)
+        self.assertEqual(7, builder.chunk_size_for(b"<root/>" * 10000))
+        markup = b'<root>' + b'<a>foo</a>' * 100 + b'</root>'
+        soup = self.soup(markup, builder=builder)
+        self.assertEqual(100, len(soup.find_all('a')))
+
+    def test_chunk_size_grows_with_document_size(self):
+        builder = self.default_builder
+        self.assertEqual(builder.CHUNK_SIZE, builder.chunk_size_for(b"<a/>"))
+        big = b"0" * (builder.CHUNK_SIZE * builder.CHUNKS_PER_DOCUMENT * 4)
+        self.assertEqual(builder.CHUNK_SIZE * 4, builder.chunk_size_for(big))
+        huge = b"0" * (builder.MAX_CHUNK_SIZE * builder.CHUNKS_PER_DOCUMENT * 2)
+        self.assertEqual(builder.MAX_CHUNK_SIZE, builder.chunk_size_for(huge))
+
+    def test_chunk_size_for_file_uses_file_size(self):
+        builder = self.default_builder
+        with tempfile.TemporaryFile() as f:
+            f.write(b"0" * (builder.CHUNK_SIZE * builder.CHUNKS_PER_DOCUMENT * 2))
+            f.flush()
+            self.assertEqual(builder.CHUNK_SIZE * 2, builder.chunk_size_for(f))
+        self.assertEqual(
+            builder.MAX_CHUNK_SIZE, builder.chunk_size_for(BytesIO(b"<a/>")))
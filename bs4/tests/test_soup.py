@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 """Tests of Beautiful Soup as a whole."""
 
+from io import BytesIO
 import logging
+import os
+import random
+import re
+import subprocess
 import unittest
 import sys
 import tempfile
@@ -9,6 +14,8 @@ import tempfile
 from bs4 import (
     BeautifulSoup,
     BeautifulStoneSoup,
+    ParseFailure,
+    parse_many,
 )
 from bs4.element import (
     CharsetMetaAttributeValue,
@@ -18,7 +25,10 @@ from bs4.element import (
     )
 import bs4.dammit
 from bs4.dammit import (
+    EncodingDetectingReader,
+    EncodingDetector,
     EntitySubstitution,
+    PrefixEncodingDetector,
     UnicodeDammit,
 )
 from bs4.testing import (
@@ -105,6 +115,45 @@ class TestSelectiveParsing(SoupTest):
         self.assertEqual(soup.encode(), b"<b>Yes</b><b>Yes <c>Yes</c></b>")
 
 
+class TestTreeBuilding(SoupTest):
+
+    def test_end_tag_must_match_prefix(self):
+        # An end tag only closes an open tag with the same name and
+        # namespace prefix.
+        soup = self.soup("")
+        soup.handle_starttag("root", None, None, {})
+        soup.handle_starttag("foo", None, None, {})
+        soup.handle_starttag("b", None, None, {})
+        soup.handle_endtag("foo", "ns")
+        self.assertEqual("b", soup.currentTag.name)
+
+        soup.handle_starttag("foo", "http://ns/", "ns", {})
+        soup.handle_starttag("i", None, None, {})
+        soup.handle_endtag("foo", "ns")
+        self.assertEqual("b", soup.currentTag.name)
+        soup.handle_endtag("foo")
+        self.assertEqual("root", soup.currentTag.name)
+
+
+class TestWhitespaceStrings(SoupTest):
+
+    def test_ascii_whitespace_is_collapsed(self):
+        soup = self.soup("<p>  \t </p><p> \n\r\n </p>")
+        self.assertEqual([u" ", u"\n"], [p.string for p in soup.find_all('p')])
+
+    def test_other_whitespace_is_preserved(self):
+        soup = self.soup(u"<p> \xa0 </p>")
+        self.assertEqual(u" \xa0 ", soup.p.string)
+
+    def test_whitespace_in_preformatted_tag_is_preserved(self):
+        soup = self.soup("<pre>  \n  </pre>")
+        self.assertEqual(u"  \n  ", soup.pre.string)
+
+    def test_string_in_several_chunks(self):
+        soup = self.soup("<p>a &amp; b &lt; c</p>")
+        self.assertEqual(u"a & b < c", soup.p.string)
+
+
 class TestEntitySubstitution(unittest.TestCase):
     """Standalone tests of the EntitySubstitution class."""
     def setUp(self):
@@ -117,6 +166,21 @@ class TestEntitySubstitution(unittest.TestCase):
         self.assertEqual(self.sub.substitute_html(s),
                           u"foo&forall;\N{SNOWMAN}&otilde;bar")
 
+    def test_substitution_leaves_clean_strings_alone(self):
+        # A string with nothing to escape is returned as-is, not copied.
+        s = u"Nothing to see here"
+        self.assertTrue(self.sub.substitute_html(s) is s)
+        self.assertTrue(self.sub.substitute_xml(s) is s)
+
+    def test_heavy_substitution(self):
+        s = u"\u00e9t\u00e9 & \u00e0 <b> \u2014 \u00a9" * 3
+        self.assertEqual(
+            self.sub.substitute_html(s),
+            u"&eacute;t&eacute; &amp; &agrave; &lt;b&gt; &mdash; &copy;" * 3)
+        self.assertEqual(
+            self.sub.substitute_xml(s),
+            u"\u00e9t\u00e9 &amp; \u00e0 &lt;b&gt; \u2014 \u00a9" * 3)
+
     def test_smart_quote_substitution(self):
         # MS smart quotes are a common source of frustration, so we
         # give them a special test.
@@ -261,6 +325,35 @@ class TestUnicodeDammit(unittest.TestCase):
         self.assertEqual(
             dammit.unicode_markup, """<foo>''""</foo>""")
 
+    def test_smart_quotes_undefined_in_windows_1252(self):
+        # \x81 and \x8d can't be decoded as Windows-1252, but they
+        # still get replaced.
+        markup = b"<foo>\x80\x81\x8d</foo>"
+        for smart_quotes_to, expect in (
+            ("html", u"<foo>&euro; ?</foo>"),
+            ("xml", u"<foo>&#x20AC; ?</foo>"),
+            ("ascii", u"<foo>EUR ?</foo>")):
+            dammit = UnicodeDammit(
+                markup, ["windows-1252"], smart_quotes_to=smart_quotes_to)
+            self.assertEqual(expect, dammit.unicode_markup)
+
+    def test_smart_quotes_in_other_single_byte_encoding(self):
+        # The rest of the document is decoded as ISO-8859-2.
+        markup = b"<foo>\xb1\x93</foo>"
+        dammit = UnicodeDammit(
+            markup, ["iso-8859-2"], smart_quotes_to="html")
+        self.assertEqual(u"<foo>\N{LATIN SMALL LETTER A WITH OGONEK}&ldquo;</foo>",
+                         dammit.unicode_markup)
+        self.assertEqual("iso-8859-2", dammit.original_encoding)
+
+    def test_smart_quotes_after_wrong_encoding(self):
+        # The document claims to be UTF-8, but it's Windows-1252.
+        data = b"<p>\x93caf\xe9\x94</p>" * 100
+        dammit = UnicodeDammit(data, ["utf-8"], smart_quotes_to="html")
+        self.assertEqual("windows-1252", dammit.original_encoding)
+        self.assertEqual(u"<p>&ldquo;caf\xe9&rdquo;</p>" * 100,
+                         dammit.unicode_markup)
+
     def test_detect_utf8(self):
         utf8 = b"\xc3\xa9"
         dammit = UnicodeDammit(utf8)
@@ -382,6 +475,347 @@ class TestUnicodeDammit(unittest.TestCase):
             output = UnicodeDammit.detwingle(input)
             self.assertEqual(output, input)
 
+    def test_detwingle_returns_unchanged_input(self):
+        doc = u"<p>\N{SNOWMAN}</p>".encode("utf8")
+        self.assertTrue(UnicodeDammit.detwingle(doc) is doc)
+
+    def test_detwingle_matches_bytewise_implementation(self):
+        # Random mixtures of ASCII, UTF-8, stray high bytes, and
+        # truncated multibyte characters give the same results as the
+        # original byte-at-a-time algorithm.
+        from bs4.diagnose import detwingle_bytewise
+        rand = random.Random(0)
+        pieces = [b"a", b"<p>", b"\x93", b"\x80", b"\x81", b"\xe1",
+                  b"\xc5", b"\xe2\x82", b"\xf0\x90",
+                  u"\N{SNOWMAN}".encode("utf8"),
+                  u"\N{LATIN SMALL LIGATURE OE}".encode("utf8"),
+                  u"\U00010413".encode("utf8")]
+        for i in range(500):
+            doc = b"".join(rand.choice(pieces)
+                           for j in range(rand.randint(0, 20)))
+            self.assertEqual(
+                detwingle_bytewise(doc), UnicodeDammit.detwingle(doc))
+
+    def test_detwingle_chunks(self):
+        doc = (u"\N{SNOWMAN}\N{LATIN SMALL LIGATURE OE}".encode("utf8")
+               + u"\N{LEFT DOUBLE QUOTATION MARK}Hi!".encode("windows-1252")
+               + u"\U00010413\N{SNOWMAN}".encode("utf8")
+               + b"\x93\xe2\x82")
+        expect = UnicodeDammit.detwingle(doc)
+        for size in range(1, len(doc) + 1):
+            chunks = [doc[i:i+size] for i in range(0, len(doc), size)]
+            self.assertEqual(
+                expect, b"".join(UnicodeDammit.detwingle_chunks(chunks)))
+
+    def test_detwingle_chunks_after_windows_1252_lead_bytes(self):
+        # A Windows-1252 byte like \xe9 looks like the start of a
+        # multibyte character, and swallows the bytes after it. Where
+        # a chunk gets split has to agree with that.
+        import random
+        rand = random.Random(35)
+        pieces = [b"a", b"\x93", b"\xe9", b"\xc3", b"\xe0", b"\xff",
+                  u"\N{SNOWMAN}".encode("utf8"),
+                  u"\N{LATIN SMALL LIGATURE OE}".encode("utf8"),
+                  u"\U00010413".encode("utf8")]
+        for doc in [b"\xe9" + u"\N{SNOWMAN}".encode("utf8") * 2] + [
+            b"".join(rand.choice(pieces) for j in range(rand.randint(0, 12)))
+            for i in range(500)]:
+            expect = UnicodeDammit.detwingle(doc)
+            for size in range(1, 5):
+                chunks = [doc[i:i+size] for i in range(0, len(doc), size)]
+                self.assertEqual(
+                    expect, b"".join(UnicodeDammit.detwingle_chunks(chunks)))
+
+class TestEncodingDetector(unittest.TestCase):
+    """Standalone tests of EncodingDetector."""
+
+    def setUp(self):
+        self.chardet = bs4.dammit.chardet_dammit
+        self.chardet_calls = []
+        def fake_chardet(s):
+            self.chardet_calls.append(s)
+            return "iso-8859-8"
+        bs4.dammit.chardet_dammit = fake_chardet
+
+    def tearDown(self):
+        bs4.dammit.chardet_dammit = self.chardet
+        EncodingDetector.chardet_cache = None
+
+    def test_utf8_skips_chardet(self):
+        for markup in (b"<p>ascii</p>", u"<p>\N{SNOWMAN}</p>".encode("utf8")):
+            detector = EncodingDetector(markup)
+            self.assertEqual("utf-8", next(detector.encodings))
+            self.assertEqual([], self.chardet_calls)
+
+    def test_unicode_dammit_reuses_utf8_check(self):
+        markup = u"<p>\N{SNOWMAN}</p>".encode("utf8")
+        decoded = []
+        class Detector(EncodingDetector):
+            def _decode_utf8(self, markup):
+                decoded.append(markup)
+                return EncodingDetector._decode_utf8(self, markup)
+        old_detector = bs4.dammit.EncodingDetector
+        bs4.dammit.EncodingDetector = Detector
+        try:
+            dammit = UnicodeDammit(markup)
+        finally:
+            bs4.dammit.EncodingDetector = old_detector
+        self.assertEqual("utf-8", dammit.original_encoding)
+        self.assertEqual(u"<p>\N{SNOWMAN}</p>", dammit.unicode_markup)
+        self.assertEqual([markup], decoded)
+        # Once UnicodeDammit has the text, the detector lets go of it.
+        self.assertEqual(None, dammit.detector.utf8_markup)
+
+    def test_utf8_check_keeps_no_decoded_text(self):
+        markup = u"<p>\N{SNOWMAN}</p>".encode("utf8")
+        detector = EncodingDetector(markup)
+        self.assertEqual("utf-8", next(detector.encodings))
+        self.assertEqual(None, detector.utf8_markup)
+
+    def test_utf8_check_across_chunks(self):
+        old_size = EncodingDetector.UTF8_CHECK_CHUNK_SIZE
+        EncodingDetector.UTF8_CHECK_CHUNK_SIZE = 2
+        try:
+            snowmen = u"\N{SNOWMAN}".encode("utf8") * 5
+            detector = EncodingDetector(b"")
+            self.assertTrue(detector._is_utf8(snowmen))
+            self.assertFalse(detector._is_utf8(snowmen[:-1]))
+            self.assertFalse(detector._is_utf8(snowmen + b"\xe9"))
+            # Unless the markup is complete, it may end partway
+            # through a character.
+            self.assertTrue(PrefixEncodingDetector(b"")._is_utf8(snowmen[:-1]))
+        finally:
+            EncodingDetector.UTF8_CHECK_CHUNK_SIZE = old_size
+
+    def test_chardet_sees_sample_starting_at_non_ascii(self):
+        markup = b"<p>" + b"a" * 100 + b"\xed\xe5\xec\xf9" * 100 + b"</p>"
+        old_size = EncodingDetector.CHARDET_SAMPLE_SIZE
+        EncodingDetector.CHARDET_SAMPLE_SIZE = 8
+        try:
+            encodings = list(EncodingDetector(markup).encodings)
+        finally:
+            EncodingDetector.CHARDET_SAMPLE_SIZE = old_size
+        self.assertEqual(["iso-8859-8", "utf-8", "windows-1252"], encodings)
+        # 103 rounds down to 100.
+        self.assertEqual([b"aaa\xed\xe5\xec\xf9\xed"], self.chardet_calls)
+
+    def test_chardet_cache(self):
+        EncodingDetector.chardet_cache = {}
+        page = b"<p>Page one: \xed\xe5\xec\xf9</p>"
+        self.assertEqual("iso-8859-8", UnicodeDammit(page).original_encoding)
+        self.assertEqual(1, len(self.chardet_calls))
+
+        # The same page doesn't need to go through chardet again.
+        self.assertEqual("iso-8859-8", UnicodeDammit(page).original_encoding)
+        self.assertEqual(1, len(self.chardet_calls))
+
+        # A different page does.
+        UnicodeDammit(b"<p>Page two: \xed\xe5\xec\xf9</p>")
+        self.assertEqual(2, len(self.chardet_calls))
+
+    def test_chardet_cache_uses_start_of_document(self):
+        EncodingDetector.chardet_cache = {}
+        old_size = EncodingDetector.FINGERPRINT_SIZE
+        EncodingDetector.FINGERPRINT_SIZE = len(b"<p>Page")
+        try:
+            UnicodeDammit(b"<p>Page one: \xed\xe5\xec\xf9</p>")
+            UnicodeDammit(b"<p>Page two: \xed\xe5\xec\xf9</p>")
+        finally:
+            EncodingDetector.FINGERPRINT_SIZE = old_size
+        self.assertEqual(1, len(self.chardet_calls))
+
+class UnseekableFile(object):
+    """A file-like object that can't be rewound, like a socket."""
+
+    def __init__(self, data):
+        self.file = BytesIO(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+class TestEncodingDetectingReader(unittest.TestCase):
+    """Standalone tests of EncodingDetectingReader."""
+
+    def test_encoding_detected_from_prefix(self):
+        markup = b'<meta charset="euc-jp"><p>\xa4\xb3\xa4\xec</p>'
+        reader = EncodingDetectingReader(BytesIO(markup), is_html=True)
+        self.assertEqual(reader.original_encoding, "euc-jp")
+        self.assertEqual(reader.declared_html_encoding, "euc-jp")
+        self.assertEqual(reader.read(), markup.decode("euc-jp"))
+
+    def test_chunks_may_split_characters(self):
+        snowmen = u"\N{SNOWMAN}" * 100
+        reader = EncodingDetectingReader(
+            BytesIO(snowmen.encode("utf-8")), prefix_size=4)
+        self.assertEqual(reader.original_encoding, "utf-8")
+        chunks = []
+        data = reader.read(5)
+        while data:
+            chunks.append(data)
+            data = reader.read(5)
+        self.assertEqual(u"".join(chunks), snowmen)
+
+    def test_ascii_prefix_is_treated_as_utf8(self):
+        markup = b"x" * 100 + u"\N{SNOWMAN}".encode("utf-8")
+        reader = EncodingDetectingReader(BytesIO(markup), prefix_size=10)
+        self.assertEqual(reader.original_encoding, "utf-8")
+        self.assertEqual(reader.read(), markup.decode("utf-8"))
+
+    def test_undecodable_data_after_prefix(self):
+        markup = b"x" * 100 + b"\xff"
+        reader = EncodingDetectingReader(BytesIO(markup), prefix_size=10)
+        self.assertRaises(UnicodeDecodeError, reader.read)
+
+        reader = EncodingDetectingReader(
+            BytesIO(markup), prefix_size=10, errors="replace")
+        self.assertEqual(reader.read(), u"x" * 100 + u"\ufffd")
+
+    def test_undecoded_data_has_byte_order_mark_stripped(self):
+        markup = b'\xef\xbb\xbf<root/>'
+        reader = EncodingDetectingReader(BytesIO(markup), decode=False)
+        self.assertEqual(reader.original_encoding, "utf-8")
+        self.assertEqual(reader.read(), b'<root/>')
+
+    def test_unicode_file(self):
+        from StringIO import StringIO
+        reader = EncodingDetectingReader(StringIO(u"<p>caf\xe9</p>"))
+        self.assertEqual(reader.original_encoding, None)
+        self.assertEqual(reader.read(), u"<p>caf\xe9</p>")
+
+class TestIterparse(SoupTest):
+
+    def iterparse(self, markup, parse_only, **kwargs):
+        return BeautifulSoup.iterparse(
+            markup, parse_only, builder=self.default_builder, **kwargs)
+
+    def test_matches_are_yielded_in_document_order(self):
+        markup = "<p>1</p><div><p>2</p><b><p>3</p></b></div><p>4</p>"
+        matches = self.iterparse(markup, SoupStrainer("p"))
+        self.assertEqual(
+            [p.decode() for p in matches],
+            ["<p>1</p>", "<p>2</p>", "<p>3</p>", "<p>4</p>"])
+
+    def test_nested_matches_are_part_of_the_outer_match(self):
+        markup = "<div id='1'><div id='2'></div></div>"
+        matches = list(self.iterparse(markup, SoupStrainer("div")))
+        self.assertEqual(1, len(matches))
+        self.assertEqual("2", matches[0].div['id'])
+
+    def test_strings_can_be_matched(self):
+        markup = "<p>foo</p><p>bar</p><p>baz</p>"
+        matches = self.iterparse(markup, SoupStrainer(text=["foo", "baz"]))
+        self.assertEqual(list(matches), ["foo", "baz"])
+
+    def test_matches_from_file_are_yielded_before_end_of_file(self):
+        chunk_size = self.default_builder.CHUNK_SIZE
+        markup = BytesIO(b"<p>first</p>" + b" " * chunk_size * 2 + b"<p>last</p>")
+        matches = self.iterparse(markup, SoupStrainer("p"))
+        self.assertEqual(next(matches).string, "first")
+        self.assertTrue(markup.tell() < len(markup.getvalue()))
+        self.assertEqual(next(matches).string, "last")
+
+class TestStreaming(SoupTest):
+
+    def test_file_read_into_memory_by_default(self):
+        markup = BytesIO(b"<p>foo</p>")
+        soup = self.soup(markup)
+        self.assertEqual(soup.p.string, "foo")
+
+    def test_rewind_when_prefix_guess_is_wrong(self):
+        # The first ten bytes look like UTF-8, but the document is
+        # actually in Windows-1252. Since the file can be rewound,
+        # the whole thing gets run through Unicode, Dammit.
+        markup = b"<p>" + b"x" * 20 + b"\x93Hi!\x94</p>"
+        reader_prefix_size = EncodingDetectingReader.PREFIX_SIZE
+        EncodingDetectingReader.PREFIX_SIZE = 10
+        try:
+            soup = self.soup(BytesIO(markup), stream=True)
+        finally:
+            EncodingDetectingReader.PREFIX_SIZE = reader_prefix_size
+        self.assertEqual(soup.original_encoding, "windows-1252")
+        self.assertEqual(soup.p.string, u"x" * 20 + u"\u201cHi!\u201d")
+
+    def test_replacement_characters_in_unseekable_file(self):
+        markup = b"<p>" + b"x" * 20 + u"\N{SNOWMAN}".encode("utf8") + b"\xff</p>"
+        reader_prefix_size = EncodingDetectingReader.PREFIX_SIZE
+        EncodingDetectingReader.PREFIX_SIZE = 10
+        try:
+            soup = self.soup(UnseekableFile(markup), stream=True)
+        finally:
+            EncodingDetectingReader.PREFIX_SIZE = reader_prefix_size
+        self.assertEqual(soup.original_encoding, "utf-8")
+        self.assertEqual(soup.p.string, u"x" * 20 + u"\N{SNOWMAN}\ufffd")
+
+def link_targets(soup):
+    # parse_many() extractors have to be picklable.
+    if soup.find('a', href='bad') is not None:
+        raise ValueError("Bad link.")
+    if soup.find('a', href='caf\xc3\xa9') is not None:
+        # A message that's a non-ASCII bytestring.
+        raise ValueError(b"Bad caf\xc3\xa9.")
+    return [a['href'] for a in soup.find_all('a')]
+
+class TestParseMany(SoupTest):
+
+    documents = ['<a href="%d">' % i for i in range(10)]
+
+    def test_results_in_document_order(self):
+        results = list(parse_many(
+            self.documents, "html.parser", extract=link_targets, workers=2))
+        self.assertEqual([[str(i)] for i in range(10)], results)
+
+    def test_in_process(self):
+        results = parse_many(
+            iter(self.documents), "html.parser", extract=link_targets,
+            workers=0)
+        self.assertEqual(['0'], next(results))
+        self.assertEqual(9, len(list(results)))
+
+    def test_failure_does_not_stop_batch(self):
+        documents = ['<a href="1">', '<a href="bad">', '<a href="3">']
+        for workers in (0, 2):
+            results = list(parse_many(
+                documents, "html.parser", extract=link_targets,
+                workers=workers))
+            self.assertEqual(['1'], results[0])
+            self.assertEqual(['3'], results[2])
+            failure = results[1]
+            self.assertTrue(isinstance(failure, ParseFailure))
+            self.assertEqual(1, failure.index)
+            self.assertEqual("ValueError", failure.error_class)
+            self.assertEqual("Bad link.", failure.message)
+            self.assertTrue("link_targets" in failure.traceback)
+
+    def test_failure_with_non_ascii_message(self):
+        documents = [u'<a href="caf\N{LATIN SMALL LETTER E WITH ACUTE}">']
+        for workers in (0, 2):
+            [failure] = list(parse_many(
+                documents, "html.parser", extract=link_targets,
+                workers=workers))
+            self.assertEqual(
+                u"Bad caf\N{LATIN SMALL LETTER E WITH ACUTE}.",
+                failure.message)
+
+    def test_import_does_not_load_multiprocessing(self):
+        code = "import sys, bs4; print('multiprocessing' in sys.modules)"
+        output = subprocess.check_output(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(bs4.__file__))))
+        self.assertEqual("False", output.strip())
+
+    def test_parse_only(self):
+        strainer = SoupStrainer('a', href=re.compile("[02468]"))
+        results = list(parse_many(
+            self.documents, "html.parser", parse_only=strainer,
+            extract=link_targets, workers=2))
+        self.assertEqual(['0'], results[0])
+        self.assertEqual([], results[1])
+
+    def test_whole_trees_by_default(self):
+        [soup] = list(parse_many(['<p>foo</p>'], "html.parser", workers=2))
+        self.assertTrue(isinstance(soup, BeautifulSoup))
+        self.assertEqual("foo", soup.p.string)
+
 class TestNamedspacedAttribute(SoupTest):
 
     def test_name_may_be_none(self):
@@ -10,9 +10,15 @@ methods tested here.
 """
 
 import copy
+import gc
+from io import BytesIO, StringIO
+import os
 import pickle
+import random
 import re
+import tempfile
 import warnings
+import weakref
 from bs4 import BeautifulSoup
 from bs4.builder import (
     builder_registry,
@@ -22,10 +28,13 @@ from bs4.element import (
     CData,
     Comment,
     Doctype,
+    EMPTY_ATTRIBUTES,
+    EMPTY_CONTENTS,
     NavigableString,
     SoupStrainer,
     Tag,
 )
+from bs4.snapshot import Snapshot
 from bs4.testing import (
     SoupTest,
     skipIf,
@@ -115,6 +124,19 @@ class TestFindAll(TreeTest):
         # recursion.
         self.assertEqual([], soup.find_all(l))
 
+    def test_find_all_with_no_criteria_finds_every_tag(self):
+        soup = self.soup("<a>1</a><b>2<a id='foo'>3</a></b>")
+        self.assertEqual(['a', 'b', 'a'], [tag.name for tag in soup.find_all()])
+        self.assertEqual(['a', 'b', 'a'], [tag.name for tag in soup.find_all(True)])
+
+    def test_strainer_can_be_pickled(self):
+        soup = self.soup("<a class='x y'>1</a><a class='x'>2</a><b>3</b>")
+        strainer = SoupStrainer(
+            ["a", "b"], class_="x y", text=re.compile("[0-9]"))
+        copied = pickle.loads(pickle.dumps(strainer, 2))
+        self.assertSelects(soup.find_all(strainer), ["1"])
+        self.assertSelects(soup.find_all(copied), ["1"])
+
     def test_find_all_resultset(self):
         """All find_all calls return a ResultSet"""
         soup = self.soup("<a></a>")
@@ -403,6 +425,41 @@ class TestIndex(TreeTest):
             self.assertEqual(i, div.index(element))
         self.assertRaises(ValueError, tree.index, 1)
 
+    def test_index_of_wide_tag_survives_modification(self):
+        soup = self.soup("<div>" + "<a>x</a>" * 100 + "</div>")
+        div = soup.div
+        rng = random.Random(0)
+        for i in range(500):
+            child = rng.choice(div.contents)
+            action = rng.randint(0, 4)
+            if i % 100 == 0:
+                action = 5
+            if action == 0:
+                child.extract()
+            elif action == 1:
+                child.replace_with(soup.new_tag("b"))
+            elif action == 2:
+                child.insert_after(soup.new_tag("c"))
+            elif action == 3:
+                div.insert(0, soup.new_tag("d"))
+            elif action == 4:
+                # Code that changes the contents list directly must
+                # not confuse the index.
+                position = rng.randint(0, len(div) - 1)
+                div.contents.insert(position, soup.new_tag("e"))
+                self.assertEqual(position + 1, div.index(div.contents[position + 1]))
+                del div.contents[position]
+            else:
+                # Lots of insertions in the same place.
+                for j in range(60):
+                    child.insert_after(soup.new_tag("f"))
+            for position, child in enumerate(div.contents):
+                self.assertEqual(position, div.index(child))
+        self.assertRaises(ValueError, div.index, soup.new_tag("a"))
+        self.assertEqual(
+            [child.name for child in div.contents],
+            [child.name for child in div.find_all(recursive=False)])
+
 
 class TestParentOperations(TreeTest):
     """Test navigation and searching through an element's parents."""
@@ -1071,6 +1128,90 @@ class TestTreeModification(SoupTest):
         a.clear(decompose=True)
         self.assertEqual(0, len(em.contents))
 
+    def navigation(self, soup):
+        """Describe how every element in a tree is linked to the others."""
+        elements = [soup] + list(soup.descendants)
+        positions = dict((id(element), i) for i, element in enumerate(elements))
+        def position(element):
+            if element is None:
+                return None
+            return positions[id(element)]
+        return [(position(element.parent),
+                 position(element.previous_element),
+                 position(element.next_element),
+                 position(element.previous_sibling),
+                 position(element.next_sibling))
+                for element in elements]
+
+    def test_extend(self):
+        markup = "<div><p>a<b>b</b></p><p><i>i</i>c</p></div><span>tail</span>"
+        one_at_a_time = self.soup(markup)
+        for child in [one_at_a_time.b, "new", one_at_a_time.i.string,
+                      one_at_a_time.span]:
+            one_at_a_time.p.append(child)
+
+        soup = self.soup(markup)
+        soup.p.extend([soup.b, "new", soup.i.string, soup.span])
+        self.assertEqual(one_at_a_time.decode(), soup.decode())
+        self.assertEqual(
+            self.navigation(one_at_a_time), self.navigation(soup))
+
+    def test_extend_with_element_twice(self):
+        soup = self.soup("<p><a>1</a><b>2</b></p>")
+        soup.p.extend([soup.a, soup.b, soup.a])
+        self.assertEqual("<p><b>2</b><a>1</a></p>", soup.decode())
+
+    def test_extend_into_itself(self):
+        soup = self.soup("<p><a>1</a></p>")
+        self.assertRaises(ValueError, soup.a.extend, [soup.a])
+
+    def test_replace_children(self):
+        markup = "<div><p>a<b>b</b><i>i</i></p>c</div><span>tail</span>"
+        one_at_a_time = self.soup(markup)
+        new_children = [one_at_a_time.i, one_at_a_time.b.string, "new"]
+        one_at_a_time.p.clear()
+        for child in new_children:
+            one_at_a_time.p.append(child)
+
+        soup = self.soup(markup)
+        soup.p.replace_children([soup.i, soup.b.string, "new"])
+        self.assertEqual(
+            "<div><p><i>i</i>bnew</p>c</div><span>tail</span>", soup.decode())
+        self.assertEqual(one_at_a_time.decode(), soup.decode())
+        self.assertEqual(
+            self.navigation(one_at_a_time), self.navigation(soup))
+
+    def test_replace_children_can_reorder(self):
+        soup = self.soup("<p><a>1</a><b>2</b><c>3</c></p>")
+        soup.p.replace_children(reversed(soup.p.contents))
+        self.assertEqual("<p><c>3</c><b>2</b><a>1</a></p>", soup.decode())
+        self.assertEqual(soup.c, soup.p.next_element)
+        self.assertEqual(None, soup.a.next_sibling)
+
+    def test_decompose_frees_elements_without_garbage_collection(self):
+        soup = self.soup("<p><a>String <em>Italicized</em></a> and another</p>")
+        em = weakref.ref(soup.em)
+        a = weakref.ref(soup.a)
+        gc.disable()
+        try:
+            soup.a.decompose()
+            self.assertEqual(None, em())
+            self.assertEqual(None, a())
+        finally:
+            gc.enable()
+        self.assertEqual("<p> and another</p>", soup.decode())
+
+    def test_clear_with_decompose_destroys_children(self):
+        soup = self.soup("<p><a>String <em>Italicized</em></a> and another</p>")
+        a = soup.a
+        string = soup.p.contents[-1]
+        soup.p.clear(decompose=True)
+        self.assertEqual("<p></p>", soup.decode())
+        self.assertEqual(None, soup.p.next_element)
+        self.assertEqual([], a.contents)
+        self.assertEqual(None, a.next_element)
+        self.assertEqual(None, string.previous_element)
+
     def test_string_set(self):
         """Tag.string = 'string'"""
         soup = self.soup("<a></a> <b><c></c></b>")
@@ -1114,6 +1255,81 @@ class TestElementObjects(SoupTest):
         self.assertEqual(soup.b.i, soup.find('b').find('i'))
         self.assertEqual(soup.a, None)
 
+    def test_equal_tags_have_equal_hashes(self):
+        soup = self.soup(
+            '<p><a class="x y" id="1">text<b>bold</b></a></p>'
+            '<p><a id="1" class="x y">text<b>bold</b></a></p>'
+            '<p><a id="1" class="x y">text<b>BOLD</b></a></p>')
+        one, two, three = soup.find_all('p')
+        self.assertEqual(one, two)
+        self.assertEqual(hash(one), hash(two))
+        self.assertNotEqual(one, three)
+        self.assertEqual(2, len(set([one, two, three])))
+
+    def test_changing_tag_resets_hashes(self):
+        soup = self.soup('<p><a><b>bold</b></a></p><p><a><b>bold</b></a></p>')
+        one, two = soup.find_all('p')
+        self.assertEqual(hash(one), hash(two))
+
+        two.b.string = "BOLD"
+        self.assertNotEqual(hash(one), hash(two))
+        self.assertNotEqual(one, two)
+        one.b.string.replace_with("BOLD")
+        self.assertEqual(hash(one), hash(two))
+        self.assertEqual(one, two)
+
+        one.a['href'] = 'http://example.com/'
+        self.assertNotEqual(hash(one), hash(two))
+        self.assertNotEqual(one, two)
+        del one.a['href']
+        self.assertEqual(hash(one), hash(two))
+
+        two.a.append(soup.new_tag("i"))
+        self.assertNotEqual(one, two)
+        two.i.extract()
+        self.assertEqual(one, two)
+
+    def test_renamed_tag_compares_correctly(self):
+        soup = self.soup('<p><b>text</b></p><p><i>text</i></p>')
+        b, i = soup.b, soup.i
+        hash(b), hash(i)
+        b.name = 'i'
+        self.assertEqual(str(b), str(i))
+        self.assertEqual(b, i)
+
+    def test_renaming_tag_resets_hashes(self):
+        soup = self.soup('<div><b>x</b></div>')
+        other = self.soup('<div><i>x</i></div>')
+        hash(soup.div)
+        soup.b.name = 'i'
+        self.assertEqual(soup.div, other.div)
+        self.assertEqual(hash(soup.div), hash(other.div))
+        self.assertTrue(other.div in set([soup.div]))
+        self.assertEqual(hash(soup.i), hash(other.i))
+
+    def test_attribute_changed_in_place_compares_correctly(self):
+        soup = self.soup('<p class="a">text</p><p class="a x">text</p>')
+        one, two = soup.find_all('p')
+        hash(one), hash(two)
+        one['class'].append('x')
+        self.assertEqual(str(one), str(two))
+        self.assertEqual(one, two)
+
+    def test_hash_of_deep_tree(self):
+        soup = self.soup("<div>" * 2000)
+        self.assertEqual(hash(soup), hash(copy.copy(soup)))
+
+    def test_member_access_matches_find(self):
+        soup = self.soup(
+            '<html><body><div><p>a<b>b</b></p><!--b--><b>c</b></div>'
+            '<p>d</p></body></html>')
+        for tag in [soup] + soup.find_all(True):
+            for name in ["html", "body", "div", "p", "b", "i", "em"]:
+                self.assertTrue(getattr(tag, name) is tag.find(name))
+        soup.div.p.extract()
+        self.assertEqual("c", soup.div.b.string)
+        self.assertEqual(None, soup.div.p)
+
     def test_deprecated_member_access(self):
         soup = self.soup('<b><i></i></b>')
         with warnings.catch_warnings(record=True) as w:
@@ -1200,6 +1416,37 @@ class TestElementObjects(SoupTest):
         soup = self.soup("foo<!--IGNORE-->bar")
         self.assertEqual(['foo', 'bar'], list(soup.strings))
 
+    def test_get_text_can_skip_tags(self):
+        soup = self.soup(
+            "<p>a<script>b<i>c</i></script>d<style>e</style><i>f</i></p>g")
+        self.assertEqual("adfg", soup.get_text(skip=["script", "style"]))
+        self.assertEqual("ad", soup.p.get_text(skip=["script", "style", "i"]))
+        # Only tags inside this one are skipped.
+        self.assertEqual("e", soup.style.get_text(skip=["style"]))
+
+    def test_get_text_can_skip_a_single_tag_name(self):
+        # A bare string is a tag name, not a set of letters.
+        soup = self.soup(
+            "<div>a<i>b</i><p>c</p><script>x</script><s>d</s></div>")
+        self.assertEqual("abcd", soup.div.get_text(skip="script"))
+        output = StringIO()
+        soup.div.write_text(output, skip="script", encoding=None)
+        self.assertEqual("abcd", output.getvalue())
+
+    def test_write_text(self):
+        soup = self.soup(u"<a>a<b>r</b>   <r> t\N{SNOWMAN} </r></a><script>x</script>")
+        for args in [(), (u",",), (u",", True)]:
+            output = BytesIO()
+            soup.a.write_text(output, *args)
+            self.assertEqual(
+                soup.a.get_text(*args).encode("utf8"), output.getvalue())
+
+        output = StringIO()
+        soup.write_text(
+            output, u"|", skip=["script"], encoding=None, buffer_size=1)
+        self.assertEqual(
+            soup.get_text(u"|", skip=["script"]), output.getvalue())
+
 class TestCDAtaListAttributes(SoupTest):
 
     """Testing cdata-list attributes like 'class'.
@@ -1284,6 +1531,140 @@ class TestPersistence(SoupTest):
         self.assertEqual(loaded.decode(), soup.decode())
 
 
+    def test_pickle_protocol_0(self):
+        dumped = pickle.dumps(self.tree, 0)
+        loaded = pickle.loads(dumped)
+        self.assertEqual(loaded.decode(), self.tree.decode())
+
+    def test_navigation_attributes_are_not_in_instance_dict(self):
+        tag = self.tree.a
+        self.assertFalse('parent' in tag.__dict__)
+        self.assertFalse('next_element' in tag.string.__dict__)
+        # But arbitrary attributes can still be set.
+        tag.custom = "value"
+        self.assertEqual("value", tag.custom)
+        self.assertEqual("value", pickle.loads(pickle.dumps(tag, 2)).custom)
+
+
+class TestSnapshot(SoupTest):
+
+    markup = ('<div><p class="a">foo<b>bar</b></p><p>baz<br/></p>'
+              '<span></span>tail</div><!--end-->')
+
+    def assertSameTree(self, expect, got):
+        self.assertEqual(expect.decode(), got.decode())
+        expect_elements = list(expect.descendants)
+        got_elements = list(got.descendants)
+        self.assertEqual(len(expect_elements), len(got_elements))
+        for a, b in zip([expect] + expect_elements, [got] + got_elements):
+            for name in ('parent', 'next_element', 'previous_element',
+                         'next_sibling', 'previous_sibling'):
+                self.assertEqual(
+                    getattr(a, name) is None, getattr(b, name) is None)
+            self.assertEqual(a.__class__, b.__class__)
+            self.assertEqual(a.name, b.name)
+
+    def test_navigation_is_rebuilt(self):
+        soup = self.soup(self.markup)
+        loaded = Snapshot.from_soup(soup).to_soup()
+        self.assertSameTree(soup, loaded)
+        self.assertEqual(loaded.b, loaded.p.b)
+        self.assertEqual("bar", loaded.b.next_element)
+        self.assertEqual(
+            loaded.find_all('p')[1], loaded.b.next_element.next_element)
+        self.assertEqual(u"tail", loaded.span.next_sibling)
+
+    def test_pickle(self):
+        soup = self.soup(self.markup)
+        snapshot = Snapshot.from_soup(soup)
+        loaded = pickle.loads(pickle.dumps(snapshot, 2))
+        self.assertEqual(snapshot.data, loaded.data)
+        self.assertSameTree(soup, loaded.to_soup())
+
+    def test_deep_tree(self):
+        # A tree too deep to pickle can still be snapshotted.
+        soup = self.soup("<div>" * 2000 + "deep" + "</div>" * 2000)
+        self.assertRaises(RuntimeError, pickle.dumps, soup, 2)
+        loaded = Snapshot.from_soup(soup).to_soup()
+        self.assertEqual(2001, len(list(loaded.descendants)))
+        # 2000 <div> tags and the BeautifulSoup object.
+        self.assertEqual(2001, len(list(loaded.find(text="deep").parents)))
+
+    def test_compact(self):
+        soup = self.soup(self.markup)
+        loaded = Snapshot.from_soup(soup).to_soup(compact=True)
+        self.assertTrue(loaded.div.attrs is EMPTY_ATTRIBUTES)
+        self.assertTrue(loaded.span.contents is EMPTY_CONTENTS)
+        self.assertEqual(soup.decode(), loaded.decode())
+
+    def test_save_and_load(self):
+        soup = self.soup(u'<p class="x">Sacr\N{LATIN SMALL LETTER E WITH ACUTE} bleu!</p>')
+        snapshot = Snapshot.from_soup(soup)
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            snapshot.save(filename)
+            for mmap in (False, True):
+                loaded = Snapshot.load(filename, mmap=mmap)
+                self.assertEqual(soup.decode(), loaded.to_soup().decode())
+                loaded.close()
+        finally:
+            os.unlink(filename)
+
+        out = BytesIO()
+        snapshot.save(out)
+        out.seek(0)
+        self.assertEqual(soup.decode(), Snapshot.load(out).to_soup().decode())
+
+    def test_not_a_snapshot(self):
+        self.assertRaises(ValueError, Snapshot, b"<p>not a snapshot</p>")
+        data = Snapshot.from_soup(self.soup(self.markup)).data
+        self.assertRaises(ValueError, Snapshot(data[:-10]).to_soup)
+
+
+class TestCompactTree(SoupTest):
+
+    markup = '<div><p class="a">foo</p><p>bar<br/></p><span></span></div>'
+
+    def test_compact_tree_is_equivalent_to_normal_tree(self):
+        normal = self.soup(self.markup)
+        compact = self.soup(self.markup, compact=True)
+        self.assertEqual(normal.decode(), compact.decode())
+        self.assertEqual(
+            [t.name for t in normal.find_all(True)],
+            [t.name for t in compact.find_all(True)])
+        self.assertEqual(normal.p.next_sibling, compact.p.next_sibling)
+
+    def test_empty_attributes_and_contents_are_shared(self):
+        soup = self.soup(self.markup, compact=True)
+        self.assertTrue(soup.div.attrs is EMPTY_ATTRIBUTES)
+        self.assertTrue(soup.span.contents is EMPTY_CONTENTS)
+        self.assertTrue(soup.p.contents is not EMPTY_CONTENTS)
+        self.assertEqual({'class': ['a']}, soup.p.attrs)
+
+    def test_shared_objects_are_replaced_on_modification(self):
+        soup = self.soup(self.markup, compact=True)
+        soup.div['id'] = 'x'
+        soup.span.append("baz")
+        self.assertEqual({}, soup.br.attrs)
+        self.assertEqual([], soup.br.contents)
+        self.assertEqual(
+            '<div id="x"><p class="a">foo</p><p>bar<br/></p>'
+            '<span>baz</span></div>', soup.decode())
+
+    def test_shared_objects_cannot_be_modified_in_place(self):
+        soup = self.soup(self.markup, compact=True)
+        self.assertRaises(TypeError, soup.div.attrs.__setitem__, 'id', 'x')
+        self.assertRaises(TypeError, soup.span.contents.append, 'baz')
+
+    def test_shared_objects_survive_pickling(self):
+        soup = self.soup(self.markup, compact=True)
+        loaded = pickle.loads(pickle.dumps(soup, 2))
+        self.assertTrue(loaded.div.attrs is EMPTY_ATTRIBUTES)
+        self.assertTrue(loaded.span.contents is EMPTY_CONTENTS)
+        self.assertEqual(soup.decode(), loaded.decode())
+
+
 class TestSubstitutions(SoupTest):
 
     def test_default_formatter_is_minimal(self):
@@ -1350,6 +1731,47 @@ class TestSubstitutions(SoupTest):
         expect_upper = u'<a href="HTTP://A.COM?A=B&C=É">E</a>'
         self.assertEqual(expect_upper, a.decode(formatter=lambda x: x.upper()))
 
+    def test_builtin_formatter_leaves_clean_strings_alone(self):
+        soup = self.soup("<b>foo</b>")
+        formatter = soup._formatter_for_name("minimal")
+        clean = soup.b.string
+        self.assertTrue(formatter(clean) is clean)
+        self.assertEqual(u"&lt;foo&gt;", formatter(u"<foo>"))
+
+        formatter = soup._formatter_for_name("html")
+        self.assertTrue(formatter(clean) is clean)
+        self.assertEqual(u"&eacute;", formatter(u"\N{LATIN SMALL LETTER E WITH ACUTE}"))
+
+    def test_serialization_leaves_nothing_on_the_tags(self):
+        # Rendered output isn't kept around on the tags.
+        from bs4.element import _slot_names
+        soup = self.soup('<a class="foo" href="bar">e</a>')
+        a = soup.a
+        def state():
+            return [(name, getattr(a, name, None))
+                    for name in _slot_names(Tag)] + [a.__dict__.copy()]
+        before = state()
+        a.decode()
+        a.encode("utf8")
+        self.assertEqual(before, state())
+
+    def test_serialization_reflects_attribute_changes(self):
+        soup = self.soup('<a class="foo" href="bar">e</a>')
+        a = soup.a
+        self.assertEqual(u'<a class="foo" href="bar">e</a>', a.decode())
+
+        a['class'].append('baz')
+        self.assertEqual(u'<a class="foo baz" href="bar">e</a>', a.decode())
+
+        a['href'] = 'a&b'
+        self.assertEqual(
+            u'<a class="foo baz" href="a&amp;b">e</a>', a.decode())
+        self.assertEqual(
+            u'<a class="foo baz" href="a&b">e</a>', a.decode(formatter=None))
+
+        del a['class']
+        self.assertEqual(u'<a href="a&amp;b">e</a>', a.decode())
+
     def test_formatter_skips_script_tag_for_html_documents(self):
         doc = """
   <script type="text/javascript">
@@ -1474,6 +1896,61 @@ class TestEncoding(SoupTest):
         self.assertEqual(
             u"\N{SNOWMAN}".encode("utf8"), soup.b.renderContents())
 
+    def test_write_matches_encode(self):
+        html = u"<p class='x'>\N{SNOWMAN} &amp; <b>bold</b></p><br/>"
+        soup = self.soup(html)
+        out = BytesIO()
+        soup.write(out)
+        self.assertEqual(soup.encode(), out.getvalue())
+
+        out = BytesIO()
+        soup.p.write(out, "ascii")
+        self.assertEqual(soup.p.encode("ascii"), out.getvalue())
+
+    def test_write_pretty_print_matches_prettify(self):
+        soup = self.soup("<div>  foo  <pre>  bar  </pre><p>baz</p></div>")
+        out = BytesIO()
+        soup.write(out, pretty_print=True)
+        self.assertEqual(soup.prettify("utf8"), out.getvalue())
+
+        out = BytesIO()
+        soup.div.write(out, pretty_print=True)
+        self.assertEqual(soup.div.prettify("utf8"), out.getvalue())
+
+    def test_write_without_encoding_writes_unicode(self):
+        soup = self.soup(u"<b>\N{SNOWMAN}</b>")
+        out = StringIO()
+        soup.write(out, None)
+        self.assertEqual(soup.decode(), out.getvalue())
+
+    def test_write_flushes_when_buffer_is_full(self):
+        soup = self.soup("<p>" + "<b>foo</b>" * 100 + "</p>")
+
+        class CountingFile(BytesIO):
+            writes = 0
+            def write(self, data):
+                self.writes += 1
+                return BytesIO.write(self, data)
+
+        out = CountingFile()
+        soup.write(out, buffer_size=20)
+        self.assertEqual(soup.encode(), out.getvalue())
+        self.assertTrue(out.writes > 10)
+
+    def test_write_with_stateful_encoding_matches_encode(self):
+        # The document is written in lots of pieces, but only the
+        # first one starts with a byte-order mark.
+        soup = self.soup(u"<p>" + u"<b>\N{SNOWMAN}</b>" * 100 + u"</p>")
+        for encoding in ("utf-16", "utf-32"):
+            out = BytesIO()
+            soup.write(out, encoding, buffer_size=20)
+            self.assertEqual(soup.encode(encoding), out.getvalue())
+
+            out = BytesIO()
+            soup.p.write_text(out, encoding=encoding, buffer_size=2)
+            self.assertEqual(
+                soup.p.get_text().encode(encoding), out.getvalue())
+
 class TestNavigableStringSubclasses(SoupTest):
 
     def test_cdata(self):